@@ -1,12 +1,17 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify
 from datetime import datetime
 import os
-import uuid
-from werkzeug.utils import secure_filename
-from models import db, QuestionPaper, Question, Subject, ExamBoard, PaperCategory, QuestionTopic, Explanation, UserQuery, StudentAnswer, UserFeedback
+from models import db, QuestionPaper, Question, Subject, ExamBoard, PaperCategory, QuestionTopic, Explanation, UserQuery, StudentAnswer, UserFeedback, PregenerationRun, QuestionImageHash, MissingAsset
 from flask_login import login_required, current_user
 from generate_mock_questions import generate_mock_paper
 from generate_simple_mock import generate_simple_mock_paper
+from utils.pregeneration import create_run, resume_run, SCOPES, MODES
+from utils.perceptual_hash import index_questions
+from utils.question_images import question_images
+from utils.image_derivatives import generate_derivatives_safely
+from utils.missing_assets import clear_missing_asset
+from utils.blob_store import store_bytes, discard
+from utils.vision_payloads import vision_payloads
 
 # Create admin blueprint
 admin_bp = Blueprint('admin', __name__, template_folder='templates/admin')
@@ -385,40 +390,10 @@ def add_question(paper_id):
                 flash('Invalid file type. Only PNG, JPG, and GIF are allowed.', 'danger')
                 return redirect(url_for('admin.add_question', paper_id=paper_id))
                 
-            # Create paper directory if it doesn't exist
-            paper_dir = os.path.join(get_data_folder(), f'paper_{paper_id}')
-            if not os.path.exists(paper_dir):
-                os.makedirs(paper_dir)
-                current_app.logger.info(f"Created directory: {paper_dir}")
-            
-            # Generate a unique filename
-            filename = f"q{secure_filename(question_number)}_{uuid.uuid4().hex}.png"
-            image_path = os.path.join(paper_dir, filename)
-            
-            # Log the attempt to save
-            current_app.logger.info(f"Attempting to save image to: {image_path}")
-            
-            # Save the image
+            # Store the image in the content-addressed blob store (identical uploads share one file)
             try:
-                question_image.save(image_path)
-                current_app.logger.info(f"Image saved successfully to: {image_path}")
-                
-                # Verify the file exists after saving
-                if os.path.exists(image_path):
-                    current_app.logger.info(f"Verified: File exists at {image_path}")
-                    
-                    # Also create a copy with a simple name for easier debugging
-                    debug_path = os.path.join(paper_dir, f"q{question_number}_debug.png")
-                    try:
-                        import shutil
-                        shutil.copy(image_path, debug_path)
-                        current_app.logger.info(f"Created debug copy at: {debug_path}")
-                    except Exception as copy_err:
-                        current_app.logger.warning(f"Failed to create debug copy: {str(copy_err)}")
-                else:
-                    current_app.logger.error(f"Error: File was not found at {image_path} after saving!")
-                    flash("Error: Question image was not saved correctly. Please try again.", "danger")
-                    return redirect(url_for('admin.add_question', paper_id=paper_id))
+                image_path = store_bytes(question_image.read())
+                current_app.logger.info(f"Image stored at: {image_path}")
             except Exception as save_error:
                 current_app.logger.error(f"Failed to save image: {str(save_error)}")
                 flash(f"Error saving image: {str(save_error)}", "danger")
@@ -459,10 +434,20 @@ def add_question(paper_id):
                 current_app.logger.info(f"Question {question_number} added successfully to paper {paper_id}")
                 current_app.logger.info(f"Image URL set to: {question.image_url}")
                 
+                # Index the image file, render its responsive derivatives and vision payload,
+                # and hash it so student photos of this question can be matched to it
+                image_path = question_images.refresh(question)
+                if image_path:
+                    generate_derivatives_safely(image_path)
+                    vision_payloads.prepare_safely(*question_images.version(question))
+                    clear_missing_asset(question.id)
+                index_questions([question])
+                
                 flash(f'Question {question_number} added successfully', 'success')
                 return redirect(url_for('admin.manage_questions', paper_id=paper_id))
             except Exception as e:
                 db.session.rollback()
+                discard(image_path)
                 current_app.logger.error(f"Error adding question: {str(e)}")
                 flash(f'Error adding question: {str(e)}', 'danger')
                 return redirect(url_for('admin.add_question', paper_id=paper_id))
@@ -492,8 +477,10 @@ def auto_generate_questions(paper_id):
         )
         
         if result.returncode == 0:
-            # Count how many questions were added
-            question_count = Question.query.filter_by(paper_id=paper_id).count()
+            # Count how many questions were added, hashing any new ones
+            questions = Question.query.filter_by(paper_id=paper_id).all()
+            question_count = len(questions)
+            index_questions(questions)
             return jsonify({
                 'success': True, 
                 'message': f'Successfully generated questions for this paper. New question count: {question_count}'
@@ -530,11 +517,9 @@ def delete_question(question_id):
         flash('Error cleaning up question dependencies', 'danger')
         return redirect(url_for('admin.manage_questions', paper_id=paper_id))
     
-    # Delete the image file
+    # Release the image (a shared blob is kept while other rows use it)
     try:
-        if question.image_path and os.path.exists(question.image_path):
-            os.remove(question.image_path)
-            current_app.logger.info(f"Deleted question image: {question.image_path}")
+        discard(question_images.resolve(question) or question.image_path)
     except Exception as e:
         current_app.logger.error(f"Error deleting question image: {str(e)}")
     
@@ -542,6 +527,7 @@ def delete_question(question_id):
     try:
         db.session.delete(question)
         db.session.commit()
+        question_images.forget(question_id)
         current_app.logger.info(f"Question {question_id} deleted successfully")
         flash('Question deleted successfully', 'success')
     except Exception as e:
@@ -677,11 +663,9 @@ def delete_paper(paper_id):
             # Clean up dependencies for each question
             clean_up_question_dependencies(question.id)
             
-            # Delete the image file
+            # Release the image (a shared blob is kept while other rows use it)
             try:
-                if question.image_path and os.path.exists(question.image_path):
-                    os.remove(question.image_path)
-                    current_app.logger.info(f"Deleted question image: {question.image_path}")
+                discard(question_images.resolve(question) or question.image_path)
             except Exception as e:
                 current_app.logger.error(f"Error deleting question image for question {question.id}: {str(e)}")
         
@@ -702,6 +686,8 @@ def delete_paper(paper_id):
         # Delete the paper itself
         db.session.delete(paper)
         db.session.commit()
+        for question in questions:
+            question_images.forget(question.id)
         
         current_app.logger.info(f"Paper {paper_id} '{paper_title}' deleted successfully")
         flash(f'Paper "{paper_title}" and all its questions deleted successfully', 'success')
@@ -733,6 +719,12 @@ def clean_up_question_dependencies(question_id):
         # Delete all question topics associations
         QuestionTopic.query.filter_by(question_id=question_id).delete()
         
+        # Delete the perceptual hashes (re-computed if the question is kept)
+        QuestionImageHash.query.filter_by(question_id=question_id).delete()
+        
+        # Delete any missing-image record
+        MissingAsset.query.filter_by(question_id=question_id).delete()
+        
         db.session.commit()
         current_app.logger.info(f"Successfully cleaned up dependencies for question {question_id}")
         return True
@@ -778,55 +770,28 @@ def edit_question(question_id):
                 return redirect(url_for('admin.edit_question', question_id=question_id))
         
         # Check if a new image was uploaded
+        file_path = replaced_image_path = replaced_version = None
         if 'question_image' in request.files and request.files['question_image'].filename:
             file = request.files['question_image']
             if file and allowed_file(file.filename):
-                # Generate a unique filename with UUID
-                filename = secure_filename(file.filename)
-                name, ext = os.path.splitext(filename)
-                unique_filename = f"q{question_number}_{uuid.uuid4().hex.lower()}{ext}"
-                
-                # Create the paper directory if it doesn't exist
-                paper_dir = os.path.join(get_data_folder(), f"paper_{paper.id}")
-                if not os.path.exists(paper_dir):
-                    os.makedirs(paper_dir)
-                    current_app.logger.info(f"Created directory: {paper_dir}")
-                
-                # Save the file
-                file_path = os.path.join(paper_dir, unique_filename)
-                current_app.logger.info(f"Attempting to save edited image to: {file_path}")
-                
                 try:
-                    file.save(file_path)
-                    current_app.logger.info(f"Image saved successfully to: {file_path}")
-                    
-                    # Verify the file exists after saving
-                    if os.path.exists(file_path):
-                        current_app.logger.info(f"Verified: File exists at {file_path}")
-                        
-                        # Delete old image file if it exists
-                        if question.image_path and os.path.exists(question.image_path):
-                            try:
-                                os.remove(question.image_path)
-                                current_app.logger.info(f"Deleted old image: {question.image_path}")
-                            except Exception as e:
-                                current_app.logger.warning(f"Failed to delete old image: {str(e)}")
-                        
-                        # Update the question with the new image path
-                        question.image_path = file_path
-                        
-                        # Update the image URL to point to the new image
-                        domain = os.environ.get('REPLIT_DEV_DOMAIN') or os.environ.get('REPLIT_DOMAINS', 'localhost:5000').split(',')[0]
-                        question.image_url = f"https://{domain}/user/question-image/{question.id}"
-                        current_app.logger.info(f"Updated image URL to: {question.image_url}")
-                    else:
-                        current_app.logger.error(f"Error: File was not found at {file_path} after saving!")
-                        flash("Error: Question image was not saved correctly. Please try again.", "danger")
-                        return redirect(url_for('admin.edit_question', question_id=question_id))
+                    file_path = store_bytes(file.read())
+                    current_app.logger.info(f"Edited image stored at: {file_path}")
                 except Exception as e:
                     current_app.logger.error(f"Error saving image: {str(e)}")
                     flash(f"Error saving image: {str(e)}", "danger")
                     return redirect(url_for('admin.edit_question', question_id=question_id))
+                
+                # The old image is released (and its cached vision payload dropped) once the
+                # change is committed
+                replaced_version = question_images.version(question)
+                replaced_image_path = replaced_version[0] if replaced_version else question.image_path
+                question.image_path = file_path
+                
+                # Update the image URL to point to the new image
+                domain = os.environ.get('REPLIT_DEV_DOMAIN') or os.environ.get('REPLIT_DOMAINS', 'localhost:5000').split(',')[0]
+                question.image_url = f"https://{domain}/user/question-image/{question.id}"
+                current_app.logger.info(f"Updated image URL to: {question.image_url}")
         
         # Update other question fields
         if question_number:
@@ -854,12 +819,145 @@ def edit_question(question_id):
         
         try:
             db.session.commit()
+            if replaced_image_path:
+                discard(replaced_image_path)
+            if replaced_version:
+                vision_payloads.forget(replaced_version[1])
+            # Re-index the image file, render derivatives and the vision payload of a new
+            # image, and re-hash it if it changed or its hashes were cleaned up
+            image_path = question_images.refresh(question)
+            if image_path:
+                generate_derivatives_safely(image_path)
+                vision_payloads.prepare_safely(*question_images.version(question))
+                clear_missing_asset(question.id)
+            index_questions([question])
             flash('Question updated successfully', 'success')
             return redirect(url_for('admin.manage_questions', paper_id=paper.id))
         except Exception as e:
             db.session.rollback()
+            if file_path:
+                discard(file_path)
             flash(f'Error updating question: {str(e)}', 'danger')
     
     return render_template('admin/edit_question.html', 
                           question=question, 
                           paper=paper)
+
+@admin_bp.route('/pregenerate', methods=['GET', 'POST'])
+@login_required
+def pregenerate_explanations():
+    """Start and monitor bulk pre-generation of explanations"""
+    if not current_user.is_admin:
+        flash('You do not have permission to access the admin area.', 'danger')
+        return redirect(url_for('user.index'))
+    
+    if request.method == 'POST':
+        scope = request.form.get('scope')
+        scope_id = request.form.get('scope_id', type=int)
+        mode = request.form.get('mode', 'concurrent')
+        
+        if scope not in SCOPES or not scope_id or mode not in MODES:
+            flash('Please choose a paper, category or board to pre-generate.', 'danger')
+            return redirect(url_for('admin.pregenerate_explanations'))
+        
+        try:
+            run = create_run(scope, scope_id, mode=mode, user_id=current_user.id)
+            flash(f'Pre-generation run {run.id} started for {scope} {scope_id}.', 'success')
+        except Exception as e:
+            current_app.logger.error(f"Error starting pre-generation for {scope} {scope_id}: {str(e)}")
+            flash(f'Error starting pre-generation: {str(e)}', 'danger')
+        return redirect(url_for('admin.pregenerate_explanations'))
+    
+    runs = PregenerationRun.query.order_by(PregenerationRun.created_at.desc()).limit(50).all()
+    papers = QuestionPaper.query.order_by(QuestionPaper.title).all()
+    categories = PaperCategory.query.order_by(PaperCategory.name).all()
+    boards = ExamBoard.query.order_by(ExamBoard.name).all()
+    
+    return render_template('admin/pregenerate.html',
+                          runs=runs,
+                          papers=papers,
+                          categories=categories,
+                          boards=boards)
+
+@admin_bp.route('/pregenerate/<int:run_id>/resume', methods=['POST'])
+@login_required
+def resume_pregeneration(run_id):
+    """Resume a stopped run, or collect the results of its submitted batch"""
+    if not current_user.is_admin:
+        flash('You do not have permission to access the admin area.', 'danger')
+        return redirect(url_for('user.index'))
+    
+    try:
+        resume_run(run_id, user_id=current_user.id)
+        flash(f'Pre-generation run {run_id} resumed.', 'success')
+    except Exception as e:
+        current_app.logger.error(f"Error resuming pre-generation run {run_id}: {str(e)}")
+        flash(f'Error resuming pre-generation: {str(e)}', 'danger')
+    return redirect(url_for('admin.pregenerate_explanations'))
+
+@admin_bp.route('/api/pregenerate/<int:run_id>')
+@login_required
+def pregeneration_status(run_id):
+    """API endpoint reporting the progress of a pre-generation run"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Not authorized'}), 403
+    
+    run = PregenerationRun.query.get(run_id)
+    if not run:
+        return jsonify({'error': 'Run not found'}), 404
+    return jsonify(run.to_dict())
+
+@admin_bp.route('/openai-usage')
+@login_required
+def openai_usage():
+    """Latency percentiles, token usage and cost of OpenAI calls per endpoint per day"""
+    if not current_user.is_admin:
+        flash('You do not have permission to access the admin area.', 'danger')
+        return redirect(url_for('user.index'))
+    
+    days = request.args.get('days', 7, type=int)
+    days = min(max(days, 1), 90)
+    
+    from utils.openai_telemetry import usage_report, variant_report
+    from utils.openai_helper import ANSWER_FEEDBACK_PROMPT_VERSION
+    report = usage_report(days)
+    # Separate against composite question/answer images (see utils/answer_composite.py)
+    layouts = variant_report(ANSWER_FEEDBACK_PROMPT_VERSION, days)
+    
+    return render_template('admin/openai_usage.html', report=report, layouts=layouts, days=days)
+
+@admin_bp.route('/missing-assets')
+@login_required
+def missing_assets():
+    """Questions whose image files could not be found when students requested them"""
+    if not current_user.is_admin:
+        flash('You do not have permission to access the admin area.', 'danger')
+        return redirect(url_for('user.index'))
+    
+    assets = MissingAsset.query.order_by(MissingAsset.hit_count.desc()).all()
+    
+    # Drop records for questions whose image has turned up since
+    fixed = [asset for asset in assets if question_images.refresh(asset.question)]
+    for asset in fixed:
+        db.session.delete(asset)
+    if fixed:
+        db.session.commit()
+        current_app.logger.info(f"Cleared {len(fixed)} missing-image records whose images now exist")
+    
+    return render_template('admin/missing_assets.html',
+                          assets=[asset for asset in assets if asset not in fixed])
+
+@admin_bp.route('/api/openai-rate-limit')
+@login_required
+def openai_rate_limit_status():
+    """API endpoint exposing the shared OpenAI rate limiter buckets and this worker's queue depth"""
+    if not current_user.is_admin:
+        current_app.logger.warning(f"Unauthorized access attempt to openai_rate_limit_status by user {current_user.id}")
+        return jsonify({'error': 'Not authorized'}), 403
+
+    try:
+        from utils.rate_limiter import rate_limiter
+        return jsonify(rate_limiter.status())
+    except Exception as e:
+        current_app.logger.error(f"Error reading OpenAI rate limiter status: {str(e)}")
+        return jsonify({'error': f'Error reading rate limiter status: {str(e)}'}), 500
@@ -28,6 +28,10 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
 }
 
+# Reject oversized request bodies (413) before they are read; covers photo uploads,
+# including the legacy base64-in-JSON form
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+
 # Initialize the app with the extension
 db.init_app(app)
 
@@ -49,7 +53,19 @@ with app.app_context():
     # Create all tables
     db.create_all()
     logger.info("Database tables created")
-    
+
+    # create_all does not add columns or indexes to existing tables; those come from migrate.py
+    from utils.migrations import pending_migrations
+    try:
+        pending = pending_migrations()
+        if pending:
+            logger.warning(
+                f"{len(pending)} schema migration(s) pending, run `python migrate.py`: "
+                f"{', '.join(migration_id for migration_id, _ in pending)}"
+            )
+    except Exception as e:
+        logger.error(f"Could not check for pending schema migrations: {str(e)}")
+
     # Validate the OpenAI API key
     openai_api_key = os.environ.get('OPENAI_API_KEY')
     if openai_api_key:
@@ -74,6 +90,22 @@ app.register_blueprint(test_bp, url_prefix='')
 app.register_blueprint(simple_test_bp, url_prefix='')
 app.register_blueprint(direct_test_bp, url_prefix='')
 
+# Resolve every question's image file once, so image requests are a dict lookup
+with app.app_context():
+    from utils.question_images import question_images
+    try:
+        question_images.load()
+    except Exception as e:
+        logger.error(f"Could not build the question image index: {str(e)}")
+
+# Keep temp_uploads/, the blob store and abandoned chunked uploads from growing without bound
+from utils.temp_sweeper import temp_sweeper
+from utils.blob_store import collect_garbage, BLOB_GC_INTERVAL_SECONDS
+from utils.chunked_uploads import expire_upload_sessions, UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS
+temp_sweeper.add_task('blob garbage collection', collect_garbage, BLOB_GC_INTERVAL_SECONDS)
+temp_sweeper.add_task('upload session expiry', expire_upload_sessions, UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS)
+temp_sweeper.start(app)
+
 # Log registered routes
 logger.info("Registered routes:")
 routes = []
@@ -105,17 +137,43 @@ def landing():
     # Otherwise show the landing page
     return render_template('landing.html')
 
+@app.before_request
+def reject_oversized_requests():
+    """
+    Refuse a body whose declared length is over the limit before the view runs;
+    werkzeug only checks when the body is first parsed, inside the views'
+    catch-all error handling
+    """
+    from flask import request, abort
+    limit = app.config["MAX_CONTENT_LENGTH"]
+    if limit and request.content_length and request.content_length > limit:
+        abort(413)
+
+@app.errorhandler(413)
+def request_too_large(error):
+    """Answer oversized uploads to the API in the JSON shape its clients expect"""
+    from flask import request, jsonify
+    limit_mb = app.config["MAX_CONTENT_LENGTH"] / (1024 * 1024)
+    message = f"The upload is too large. Images must be smaller than {limit_mb:.0f} MB."
+    if request.path.startswith('/api/'):
+        return jsonify({'success': False, 'message': message, 'error': message}), 413
+    return message, 413
+
 # Route for the mobile app design showcase
 @app.route('/mobile')
 def mobile_design():
-    from flask import send_from_directory
-    return send_from_directory('mobile_design', 'index.html')
+    return mobile_design_files('index.html')
 
 # Serve mobile design static files
 @app.route('/mobile/<path:filename>')
 def mobile_design_files(filename):
-    from flask import send_from_directory
-    return send_from_directory('mobile_design', filename)
+    from flask import abort
+    from werkzeug.security import safe_join
+    from utils.file_offload import send_asset
+    path = safe_join(os.path.join(app.root_path, 'mobile_design'), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return send_asset(path, conditional=True)
 
 # Terms and Privacy routes
 @app.route('/terms')
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Script to generate the responsive WebP/AVIF derivatives of existing question images.
+Usage: python generate_image_derivatives.py [--paper ID] [--dir DIR ...] [--workers N]
+Example: python generate_image_derivatives.py --dir attached_assets
+
+New images get their derivatives when they are added; run this once to backfill the
+existing corpus. Images that already have all their derivatives are skipped, so the
+script can be interrupted and run again.
+"""
+
+import os
+import sys
+import logging
+import argparse
+from app import app
+from models import Question
+from utils.question_images import question_images
+from utils.image_derivatives import backfill_derivatives
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+def images_in_directory(directory):
+    """All image files under a directory"""
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.abspath(os.path.join(root, name))
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate responsive derivatives of question images")
+    parser.add_argument('--paper', type=int, help="Only process the questions of this paper")
+    parser.add_argument('--dir', action='append', default=[], help="Also process every image under this directory")
+    parser.add_argument('--workers', type=int, help="Number of worker processes (default: CPU count)")
+    args = parser.parse_args()
+
+    with app.app_context():
+        query = Question.query
+        if args.paper:
+            query = query.filter_by(paper_id=args.paper)
+        paths = {question_images.resolve(question) for question in query.all()}
+    paths.discard(None)
+    for directory in args.dir:
+        paths.update(images_in_directory(directory))
+
+    print(f"Generating derivatives for {len(paths)} images...")
+    counts = backfill_derivatives(sorted(paths), workers=args.workers)
+    print(f"Wrote {counts['written']} derivative files, {counts['failed']} images failed")
+    return 0 if not counts['failed'] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
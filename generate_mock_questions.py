@@ -12,6 +12,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
+from utils.image_derivatives import generate_derivatives_safely
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -445,6 +446,9 @@ def generate_mock_paper(source_paper_id, mock_paper_name, num_questions=5, trans
             )
             
             if question_path:
+                # Render the WebP/AVIF derivatives served to phones
+                generate_derivatives_safely(question_path)
+                
                 # Create entry in database
                 marks = random.randint(3, 7) if source_question.marks is None else source_question.marks
                 difficulty = random.randint(1, 5) if source_question.difficulty_level is None else source_question.difficulty_level
@@ -495,6 +499,8 @@ def generate_mock_paper(source_paper_id, mock_paper_name, num_questions=5, trans
                     )
                     
                     if ms_path:
+                        generate_derivatives_safely(ms_path)
+                        
                         # Add mark scheme as another "question" with MS prefix
                         ms_question = Question(
                             question_number=f"MS{question_number}",
@@ -8,6 +8,7 @@ import uuid
 import logging
 from datetime import datetime
 from PIL import Image, ImageDraw, ImageFont
+from utils.image_derivatives import generate_derivatives_safely
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -638,6 +639,9 @@ def generate_simple_mock_paper(source_paper_id, mock_paper_name, num_questions=5
             )
             
             if question_path:
+                # Render the WebP/AVIF derivatives served to phones
+                generate_derivatives_safely(question_path)
+                
                 # Create entry in database
                 marks = transform_level + 1  # Marks based on transform level
                 difficulty = transform_level  # Difficulty matches transform level
@@ -679,6 +683,8 @@ def generate_simple_mock_paper(source_paper_id, mock_paper_name, num_questions=5
                     )
                     
                     if ms_path:
+                        generate_derivatives_safely(ms_path)
+                        
                         # Add mark scheme as another "question" with MS prefix
                         ms_question = Question(
                             question_number=f"MS{question_number}",
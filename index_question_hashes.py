@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Script to compute the perceptual hashes used to match student photos to existing questions.
+Usage: python index_question_hashes.py [--paper ID] [--force]
+Example: python index_question_hashes.py --paper 73
+
+Questions added through the admin pages are hashed automatically; run this once to
+backfill existing questions and after bulk-importing questions with other scripts.
+Questions already hashed from their current image are skipped unless --force is given.
+"""
+
+import sys
+import logging
+import argparse
+from app import app
+from models import Question
+from utils.perceptual_hash import index_questions
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute perceptual hashes of question images")
+    parser.add_argument('--paper', type=int, help="Only hash the questions of this paper")
+    parser.add_argument('--force', action='store_true', help="Re-hash questions that are already hashed")
+    args = parser.parse_args()
+
+    with app.app_context():
+        query = Question.query
+        if args.paper:
+            query = query.filter_by(paper_id=args.paper)
+        counts = index_questions(query.order_by(Question.id).all(), force=args.force)
+
+    print(
+        f"Hashed {counts['indexed']} questions, {counts['unchanged']} already up to date, "
+        f"{counts['failed']} without a readable image"
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
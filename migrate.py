@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Script to apply the pending schema migrations (see utils/migrations.py).
+Usage: python migrate.py [--status] [--dry-run]
+Example: python migrate.py --status
+
+Safe to run against the live database while the app is serving: indexes are
+built without blocking writes on PostgreSQL, and a migration that was
+interrupted is completed by running the script again.
+"""
+
+import sys
+import logging
+import argparse
+from app import app
+from utils.migrations import MIGRATIONS, applied_migrations, apply_migrations
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument('--status', action='store_true', help="List every migration and whether it is applied")
+    parser.add_argument('--dry-run', action='store_true', help="Report the pending migrations without applying them")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.status:
+            applied = applied_migrations()
+            for migration_id, description, _ in MIGRATIONS:
+                print(f"[{'x' if migration_id in applied else ' '}] {migration_id}: {description}")
+            return 0
+        try:
+            migrated = apply_migrations(dry_run=args.dry_run)
+        except Exception as e:
+            logger.error(f"Migration failed, fix the cause and run again: {str(e)}")
+            return 1
+        if not migrated:
+            print("Database schema is up to date")
+        else:
+            print(f"{'Would apply' if args.dry_run else 'Applied'} {len(migrated)} migration(s): {', '.join(migrated)}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Script to move existing images into the content-addressed blob store and maintain it.
+Usage: python migrate_to_blob_store.py [--dry-run] [--delete-originals] [--recount] [--gc [--grace-hours H]]
+Example: python migrate_to_blob_store.py --dry-run
+
+Every question image, user query image, student answer image and feedback screenshot
+that is not yet in the store is copied into it (identical files are stored once) and
+its row is pointed at the blob. With --delete-originals the old files under data/,
+temp_uploads/ and static/uploads/ are removed once every row that used them has moved.
+Rows already in the store are skipped, so the script can be interrupted and run again.
+
+--recount rebuilds the reference counts from the database; --gc deletes blobs that
+have been unreferenced for longer than the grace period, and abandoned chunked uploads.
+"""
+
+import os
+import sys
+import logging
+import argparse
+from sqlalchemy import select, update
+from app import app, db
+from models import Question
+from utils.question_images import probe_image_path
+from utils.image_derivatives import file_digest
+from utils.blob_store import (
+    BLOB_REFERENCES, BLOB_GC_GRACE_SECONDS, is_blob_path, blob_digest, store_file, add_reference,
+    recount_references, collect_garbage
+)
+from utils.chunked_uploads import expire_upload_sessions
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Only uploaded and generated files are deleted; bundled assets (attached_assets, static/images) stay
+DELETABLE_FOLDERS = tuple(
+    os.path.abspath(folder) + os.sep for folder in ('data', 'temp_uploads', os.path.join('static', 'uploads'))
+)
+
+def locate(model, row, path):
+    """The file a row's path refers to, or None"""
+    if model is Question:
+        return probe_image_path(path, row.paper_id, row.question_number)
+    return os.path.abspath(path) if os.path.isfile(path) else None
+
+def migrate(dry_run=False, delete_originals=False):
+    """
+    Point every referencing row at a blob
+
+    Returns:
+        dict: Counts of rows 'moved', 'missing' files, distinct 'blobs', and bytes 'before'/'after'
+    """
+    counts = {'moved': 0, 'missing': 0, 'blobs': 0, 'before': 0, 'after': 0}
+    # original file -> blob path (or digest in a dry run)
+    stored = {}
+    digests = set()
+    # Original files that some row could not be moved away from
+    kept = set()
+
+    for model, column_name in BLOB_REFERENCES:
+        table = model.__table__
+        column = table.c[column_name]
+        columns = [table.c.id, column]
+        if model is Question:
+            columns += [table.c.paper_id, table.c.question_number]
+        with db.engine.connect() as conn:
+            rows = conn.execute(select(*columns).where(column.isnot(None), column != '')).all()
+
+        for row in rows:
+            path = row[1]
+            if is_blob_path(path):
+                continue
+            source = locate(model, row, path)
+            if source is None:
+                counts['missing'] += 1
+                logger.warning(f"{model.__name__} {row.id}: no file at {path}")
+                continue
+            try:
+                if source not in stored:
+                    if dry_run:
+                        stored[source] = file_digest(source)
+                        digest = stored[source]
+                    else:
+                        stored[source] = store_file(source)
+                        digest = blob_digest(stored[source])
+                    counts['before'] += os.path.getsize(source)
+                    if digest not in digests:
+                        digests.add(digest)
+                        counts['after'] += os.path.getsize(source)
+                elif not dry_run:
+                    add_reference(stored[source])
+                if not dry_run:
+                    with db.engine.begin() as conn:
+                        conn.execute(update(table).where(table.c.id == row.id).values({column_name: stored[source]}))
+                counts['moved'] += 1
+            except Exception as e:
+                kept.add(source)
+                logger.error(f"{model.__name__} {row.id}: could not move {source}: {str(e)}")
+
+    counts['blobs'] = len(digests)
+    if delete_originals and not dry_run:
+        for source in stored:
+            if source in kept or not source.startswith(DELETABLE_FOLDERS):
+                continue
+            try:
+                os.remove(source)
+            except OSError as e:
+                logger.warning(f"Could not delete {source}: {str(e)}")
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Move images into the content-addressed blob store")
+    parser.add_argument('--dry-run', action='store_true', help="Report what would be moved without changing anything")
+    parser.add_argument('--delete-originals', action='store_true', help="Delete the old files after moving them")
+    parser.add_argument('--recount', action='store_true', help="Rebuild the blob reference counts")
+    parser.add_argument('--gc', action='store_true', help="Delete blobs nothing has referred to for the grace period")
+    parser.add_argument('--grace-hours', type=float, default=BLOB_GC_GRACE_SECONDS / 3600,
+                        help="Grace period for --gc (default: %(default)s)")
+    args = parser.parse_args()
+
+    with app.app_context():
+        counts = migrate(dry_run=args.dry_run, delete_originals=args.delete_originals)
+        print(
+            f"{'Would move' if args.dry_run else 'Moved'} {counts['moved']} rows into {counts['blobs']} blobs "
+            f"({counts['before'] / 1e6:.1f} MB of files -> {counts['after'] / 1e6:.1f} MB); "
+            f"{counts['missing']} rows have no file"
+        )
+        if args.recount and not args.dry_run:
+            print(f"Corrected {recount_references()} reference counts")
+        if args.gc:
+            if not args.dry_run:
+                print(f"Removed {expire_upload_sessions()} abandoned uploads")
+            gc_counts = collect_garbage(args.grace_hours * 3600, dry_run=args.dry_run)
+            print(
+                f"{'Would delete' if args.dry_run else 'Deleted'} {gc_counts['deleted']} unreferenced blobs "
+                f"({gc_counts['bytes'] / 1e6:.1f} MB)"
+            )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -65,6 +65,9 @@ class QuestionPaper(db.Model):
     # Relationship with Question
     questions = db.relationship('Question', backref='paper', lazy=True, order_by='Question.question_number')
     
+    # Papers of a category
+    __table_args__ = (db.Index('ix_question_paper_category', 'category_id'),)
+    
     def __repr__(self):
         return f'<QuestionPaper {self.title}>'
 
@@ -83,6 +86,9 @@ class Question(db.Model):
     # Relationships
     topics = db.relationship('QuestionTopic', back_populates='question')
     
+    # A paper's questions in order
+    __table_args__ = (db.Index('ix_question_paper_number', 'paper_id', 'question_number'),)
+    
     def __repr__(self):
         return f'<Question {self.question_number} - Paper {self.paper_id}>'
         
@@ -101,6 +107,12 @@ class Explanation(db.Model):
     # Relationship with questions
     question = db.relationship('Question', backref='explanations')
     
+    # Latest explanation of a question; one explanation per question
+    __table_args__ = (
+        db.Index('ix_explanation_question_generated', 'question_id', 'generated_at'),
+        db.Index('uq_explanation_question', 'question_id', unique=True),
+    )
+    
     def __repr__(self):
         return f'<Explanation for Question {self.question_id}>'
 
@@ -172,6 +184,9 @@ class CreditTransaction(db.Model):
     stripe_payment_id = db.Column(db.String(100), nullable=True)  # For purchases via Stripe
     transaction_date = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Stripe webhook and checkout return look up a payment to avoid crediting it twice
+    __table_args__ = (db.Index('ix_credit_transaction_stripe_payment', 'stripe_payment_id'),)
+    
     def __repr__(self):
         return f'<CreditTransaction {self.transaction_type} {self.amount} for User {self.user_id}>'
 
@@ -280,6 +295,13 @@ class UserQuery(db.Model):
     user = db.relationship('User', backref='queries')
     question = db.relationship('Question', backref='user_queries')
     
+    __table_args__ = (
+        # A user's latest explanation of a question (cached explanation lookups)
+        db.Index('ix_user_query_user_question_type', 'user_id', 'question_id', 'query_type', 'created_at'),
+        # A user's history, newest first
+        db.Index('ix_user_query_user_created', 'user_id', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<UserQuery {self.query_type} by User {self.user_id}>'
     
@@ -308,6 +330,9 @@ class StudentAnswer(db.Model):
     question = db.relationship('Question', backref='student_answers')
     user_query = db.relationship('UserQuery', backref='student_answers')
     
+    # A user's answers, newest first
+    __table_args__ = (db.Index('ix_student_answer_user_created', 'user_id', 'created_at'),)
+    
     def __repr__(self):
         return f'<StudentAnswer by User {self.user_id} for Question {self.question_id or self.user_query_id}>'
     
@@ -379,3 +404,244 @@ class MockStudentAnswer(db.Model):
     
     def __repr__(self):
         return f'<MockStudentAnswer {self.id} for Question {self.question_id}>'
+
+
+class CachedExplanation(db.Model):
+    """Content-addressed cache of AI explanations, shared across all users.
+
+    Entries are keyed by the SHA-256 of the normalized image bytes combined with
+    the subject, model and prompt version, so identical photos of the same page
+    reuse one explanation regardless of who uploaded them.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), nullable=False, unique=True, index=True)
+    image_sha256 = db.Column(db.String(64), nullable=False)
+    subject = db.Column(db.String(50), nullable=False)
+    model = db.Column(db.String(50), nullable=False)
+    prompt_version = db.Column(db.String(50), nullable=False)
+    response_text = db.Column(db.Text, nullable=False)
+    size_bytes = db.Column(db.Integer, nullable=False, default=0)
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_accessed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CachedExplanation {self.cache_key[:12]} ({self.prompt_version})>'
+
+
+class AIJob(db.Model):
+    """Model for a queued AI request processed by the background job workers"""
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex, returned to the client as the job id
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # None for system jobs
+    job_type = db.Column(db.String(50), nullable=False)  # 'explain_question', 'analyze_captured_image', ...
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running', 'succeeded', 'failed'
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON-encoded job arguments
+    result = db.Column(db.Text, nullable=True)  # JSON-encoded response body once finished
+    http_status = db.Column(db.Integer, nullable=True)  # Status code the synchronous endpoint would have returned
+    error = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    # Relationships
+    user = db.relationship('User', backref='ai_jobs')
+    
+    def __repr__(self):
+        return f'<AIJob {self.id} {self.job_type} {self.status}>'
+    
+    def get_payload(self):
+        """Decode the JSON job arguments"""
+        return json.loads(self.payload) if self.payload else {}
+    
+    def get_result(self):
+        """Decode the JSON result, if the job has finished"""
+        return json.loads(self.result) if self.result else None
+    
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+    
+    def to_dict(self):
+        """Serialize the job for the status endpoint"""
+        return {
+            'job_id': self.id,
+            'job_type': self.job_type,
+            'status': self.status,
+            'http_status': self.http_status,
+            'result': self.get_result(),
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S') if self.started_at else None,
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None
+        }
+
+
+class RateLimitBucket(db.Model):
+    """Token bucket shared by every worker that calls OpenAI (see utils/rate_limiter.py)"""
+    name = db.Column(db.String(64), primary_key=True)  # e.g. 'openai:gpt-4o:rpm', 'openai:gpt-4o:tpm'
+    tokens = db.Column(db.Float, nullable=False)  # Current level; may go negative after a usage correction
+    capacity = db.Column(db.Float, nullable=False)
+    refill_per_second = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)  # Unix timestamp of the last refill
+    
+    def __repr__(self):
+        return f'<RateLimitBucket {self.name} {self.tokens:.0f}/{self.capacity:.0f}>'
+
+
+class OpenAICallLog(db.Model):
+    """Latency, token and cost telemetry for one OpenAI chat completion (see utils/openai_telemetry.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    endpoint = db.Column(db.String(100), nullable=False, index=True)  # Flask endpoint, or 'job:<type>' for background jobs
+    model = db.Column(db.String(50), nullable=False)
+    prompt_version = db.Column(db.String(50), nullable=True)
+    streamed = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(20), nullable=False)  # 'ok' or 'error'
+    error_type = db.Column(db.String(100), nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=1)  # Retries are attempts - 1
+    input_tokens = db.Column(db.Integer, nullable=True)
+    output_tokens = db.Column(db.Integer, nullable=True)
+    cached_tokens = db.Column(db.Integer, nullable=True)
+    queue_wait_ms = db.Column(db.Integer, nullable=False, default=0)  # Time spent waiting on the rate limiter
+    first_token_ms = db.Column(db.Integer, nullable=True)  # Streamed calls only
+    duration_ms = db.Column(db.Integer, nullable=False)  # Wall time including retries and queueing
+    cost_usd = db.Column(db.Float, nullable=True)
+    
+    def __repr__(self):
+        return f'<OpenAICallLog {self.endpoint} {self.model} {self.status} {self.duration_ms}ms>'
+
+
+class PregenerationRun(db.Model):
+    """Bulk pre-generation of explanations for a paper, category or board (see utils/pregeneration.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(20), nullable=False)  # 'paper', 'category' or 'board'
+    scope_id = db.Column(db.Integer, nullable=False)
+    mode = db.Column(db.String(20), nullable=False, default='concurrent')  # 'concurrent' or 'batch'
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running', 'submitted', 'completed', 'failed'
+    total = db.Column(db.Integer, nullable=False, default=0)  # Questions in scope
+    skipped = db.Column(db.Integer, nullable=False, default=0)  # Already had an explanation
+    generated = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    batch_id = db.Column(db.String(100), nullable=True)  # OpenAI (or local stand-in) batch id in batch mode
+    error = db.Column(db.Text, nullable=True)  # Last failure, for the admin page
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<PregenerationRun {self.id} {self.scope} {self.scope_id} {self.status}>'
+    
+    @property
+    def is_active(self):
+        return self.status in ('queued', 'running', 'submitted')
+    
+    @property
+    def progress_percent(self):
+        """Share of questions in scope that have been dealt with"""
+        if not self.total:
+            return 100 if self.status == 'completed' else 0
+        return int(100 * (self.skipped + self.generated + self.failed) / self.total)
+    
+    def to_dict(self):
+        """Serialize the run for the progress endpoint"""
+        return {
+            'run_id': self.id,
+            'scope': self.scope,
+            'scope_id': self.scope_id,
+            'mode': self.mode,
+            'status': self.status,
+            'total': self.total,
+            'skipped': self.skipped,
+            'generated': self.generated,
+            'failed': self.failed,
+            'progress_percent': self.progress_percent,
+            'batch_id': self.batch_id,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None
+        }
+
+
+class QuestionImageHash(db.Model):
+    """Perceptual hashes of a question's image, for matching student photos (see utils/perceptual_hash.py)"""
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True)
+    phash = db.Column(db.BigInteger, nullable=False)  # 64-bit DCT hash, stored signed
+    dhash = db.Column(db.BigInteger, nullable=False)  # 64-bit gradient hash, stored signed
+    image_path = db.Column(db.String(255), nullable=False)  # Path the hashes were computed from
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<QuestionImageHash question={self.question_id} phash={self.phash & 0xFFFFFFFFFFFFFFFF:016x}>'
+
+
+class MissingAsset(db.Model):
+    """A question whose image file could not be found when it was requested (see utils/missing_assets.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), nullable=False, unique=True)
+    paper_id = db.Column(db.Integer, nullable=True)
+    image_path = db.Column(db.String(255), nullable=True)  # Path recorded on the question when it was missed
+    hit_count = db.Column(db.Integer, default=0)  # Requests that got a sample or placeholder instead
+    first_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    question = db.relationship('Question', backref=db.backref('missing_asset', uselist=False))
+    
+    def __repr__(self):
+        return f'<MissingAsset question={self.question_id} hits={self.hit_count}>'
+
+
+class Blob(db.Model):
+    """A file in the content-addressed image store (see utils/blob_store.py)"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    extension = db.Column(db.String(10), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # Rows pointing at the file
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # Last stored, referenced or released
+    
+    def __repr__(self):
+        return f'<Blob {self.sha256[:12]} refs={self.ref_count}>'
+
+
+class UploadSession(db.Model):
+    """A resumable chunked image upload (see utils/chunked_uploads.py)"""
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex, returned to the client as the upload id
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    size = db.Column(db.Integer, nullable=False)  # Declared total size in bytes
+    sha256 = db.Column(db.String(64), nullable=False)  # Declared checksum of the whole file
+    chunk_size = db.Column(db.Integer, nullable=False)
+    received_chunks = db.Column(db.Integer, nullable=False, default=0)  # Chunks are accepted in order
+    status = db.Column(db.String(20), nullable=False, default='open')  # 'open', 'complete'
+    blob_path = db.Column(db.String(255), nullable=True)  # Assembled file in the blob store, once complete
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.received_chunks}/{self.total_chunks} {self.status}>'
+    
+    @property
+    def total_chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+    
+    def to_dict(self):
+        """Serialize the session for the upload endpoints"""
+        return {
+            'upload_id': self.id,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'total_chunks': self.total_chunks,
+            'received_chunks': self.received_chunks,
+            'status': self.status
+        }
+
+
+class SchemaMigration(db.Model):
+    """A schema migration that has been applied to this database (see utils/migrations.py)"""
+    id = db.Column(db.String(100), primary_key=True)  # e.g. '0003_hot_path_indexes'
+    description = db.Column(db.String(255), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    duration_ms = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<SchemaMigration {self.id}>'
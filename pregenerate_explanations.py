@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Script to pre-generate explanations for every question in a paper, category or board,
+so students never wait on the model when they open a question.
+Usage: python pregenerate_explanations.py (--paper ID | --category ID | --board ID) [--batch]
+       python pregenerate_explanations.py --resume RUN_ID
+       python pregenerate_explanations.py --list
+Example: python pregenerate_explanations.py --paper 73
+
+Questions that already have an explanation are skipped, so an interrupted run can
+be resumed (or simply started again). With --batch the requests are submitted to the
+OpenAI Batch API; run --resume RUN_ID later to collect the results. Set
+OPENAI_BATCH_BACKEND=local to test batch mode without the Batch API.
+"""
+
+import sys
+import asyncio
+import logging
+import argparse
+from app import app
+from models import PregenerationRun
+from utils.pregeneration import create_run, resume_run, execute_run
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def print_run(run):
+    """Print a one-line summary of a run"""
+    print(
+        f"Run {run['run_id']}: {run['scope']} {run['scope_id']} ({run['mode']}) {run['status']} - "
+        f"{run['progress_percent']}% of {run['total']} questions: {run['generated']} generated, "
+        f"{run['skipped']} already explained, {run['failed']} failed"
+    )
+    if run['error']:
+        print(f"  Last error: {run['error']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-generate question explanations")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--paper', type=int, help="Paper ID")
+    target.add_argument('--category', type=int, help="Paper category ID")
+    target.add_argument('--board', type=int, help="Exam board ID")
+    target.add_argument('--resume', type=int, metavar='RUN_ID', help="Resume a run, or collect its batch results")
+    target.add_argument('--list', action='store_true', help="List recent runs")
+    parser.add_argument('--batch', action='store_true', help="Submit through the OpenAI Batch API")
+    args = parser.parse_args()
+    
+    with app.app_context():
+        if args.list:
+            for run in PregenerationRun.query.order_by(PregenerationRun.id.desc()).limit(20):
+                print_run(run.to_dict())
+            return 0
+        
+        if args.resume:
+            try:
+                run_id = resume_run(args.resume, enqueue=False).id
+            except ValueError as e:
+                print(f"Error: {str(e)}")
+                return 1
+        else:
+            scope, scope_id = next(
+                (scope, getattr(args, scope)) for scope in ('paper', 'category', 'board')
+                if getattr(args, scope) is not None
+            )
+            run_id = create_run(scope, scope_id, mode='batch' if args.batch else 'concurrent', enqueue=False).id
+        
+        try:
+            run = asyncio.run(execute_run(run_id))
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            return 1
+        
+        print_run(run)
+        if run['status'] == 'submitted':
+            print(f"Batch submitted. Collect the results later with: python pregenerate_explanations.py --resume {run_id}")
+        return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,7 +3,8 @@ Module for handling "Snap Any Paper" functionality, which allows users to
 upload or capture photos of any A-Level question for AI analysis.
 """
 import os
-import base64
+import asyncio
+import hashlib
 import json
 import logging
 import re
@@ -14,7 +15,17 @@ from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 from PIL import Image
 from models import db, UserQuery, User
-from utils.openai_helper import check_openai_key, call_openai_with_retry
+from utils.openai_helper import check_openai_key, call_openai_with_retry, call_openai_async
+from utils.explanation_cache import explanation_cache, make_cache_key
+from utils.image_preparation import prepare_vision_image, decode_image_data
+from utils.perceptual_hash import find_question_explanation
+from utils.ai_jobs import register_job_type, enqueue_job, async_requested, job_accepted_response
+from utils.uploads import (
+    is_multipart_upload, request_fields, uploaded_image, read_stored_image, oversized_image_message
+)
+from utils.blob_store import store_bytes, is_blob_path
+from utils.image_quality import quality_rejection
+from utils.page_rectification import rectify_page
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -26,104 +37,148 @@ snap_paper_bp = Blueprint('snap_paper', __name__)
 # Constants
 REQUIRED_CREDITS = 10
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-MAX_IMAGE_SIZE = 4 * 1024 * 1024  # 4MB
-TEMP_FOLDER = 'temp_uploads'
-
-# Ensure temp folder exists
-if not os.path.exists(TEMP_FOLDER):
-    os.makedirs(TEMP_FOLDER)
+SNAP_MODEL = "gpt-4o"
+SNAP_PROMPT_VERSION = "snap-v1"  # Bump when the snap prompts change to invalidate cached analyses
 
 def allowed_file(filename):
     """Check if uploaded file has an allowed extension"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def save_temp_image(image_data):
-    """Save image data to temporary file and return the path"""
+def decode_snap_image(image_data):
+    """
+    Decode an uploaded snap once, in memory
+    
+    The bytes are handed as they are to the matcher and to prepare_vision_image,
+    which does the only re-encode (upright, resized, metadata stripped); nothing
+    is written to disk unless a background job needs the image later.
+    
+    Args:
+        image_data: Raw bytes (multipart upload), a data URI or a bare base64 string
+    
+    Returns:
+        bytes: The image file, or None if it is not a readable image
+    """
     try:
-        logger.info("="*50)
-        logger.info("SAVE TEMP IMAGE FUNCTION DEBUGGING")
-        logger.info("="*50)
-        logger.info(f"Image data type: {type(image_data)}")
-        logger.info(f"Image data length: {len(image_data) if image_data else 0}")
-        
-        if not image_data:
-            logger.error("Image data is empty or None")
-            return None
-            
-        # Log the first 100 chars to see what we're dealing with
-        sample = image_data[:100] if isinstance(image_data, str) else "Non-string data"
-        logger.info(f"First 100 chars of image_data: {sample}")
-        
-        # Check if it's a data URL
-        if isinstance(image_data, str) and image_data.startswith('data:image'):
-            logger.info("Detected data URL format, processing as base64")
-            # Extract the base64 part
-            image_data = re.sub('^data:image/.+;base64,', '', image_data)
-            try:
-                image_data = base64.b64decode(image_data)
-                logger.info(f"Successfully decoded base64 data, length: {len(image_data)}")
-            except Exception as b64_error:
-                logger.error(f"Base64 decoding error: {str(b64_error)}")
-                return None
-                
-            try:
-                img = Image.open(BytesIO(image_data))
-                logger.info(f"Successfully opened image from bytes, format: {img.format}, size: {img.size}, mode: {img.mode}")
-            except Exception as img_error:
-                logger.error(f"Error opening image from bytes: {str(img_error)}")
-                return None
-        else:
-            # Handle direct binary data
-            logger.info("Not a data URL, treating as direct binary image data")
-            try:
-                if isinstance(image_data, str):
-                    logger.warning("Data is string but not a data URL, attempting to convert to bytes")
-                    try:
-                        # Last resort - try to decode as base64 anyway
-                        image_data = base64.b64decode(image_data)
-                    except:
-                        logger.error("Failed to treat string as base64")
-                        return None
-                        
-                img = Image.open(BytesIO(image_data))
-                logger.info(f"Successfully opened image from bytes, format: {img.format}, size: {img.size}")
-            except Exception as img_error:
-                logger.error(f"Error opening image from binary: {str(img_error)}")
-                return None
-        
-        # Create a unique filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"snap_any_paper_{timestamp}.jpg"
-        file_path = os.path.join(TEMP_FOLDER, filename)
-        logger.info(f"Created temp file path: {file_path}")
-        
-        # Save the image
-        try:
-            # Convert RGBA images (with transparency) to RGB mode before saving as JPEG
-            if img.mode == 'RGBA':
-                logger.info("Converting RGBA image to RGB mode for JPEG compatibility")
-                # Create a white background
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                # Paste the image on the background using the alpha channel
-                background.paste(img, mask=img.split()[3])  # 3 is the alpha channel
-                # Save the RGB image
-                background.save(file_path, "JPEG")
-            else:
-                # Save the image directly if it's already in a compatible mode
-                img.save(file_path, "JPEG")
-                
-            logger.info(f"Successfully saved image to {file_path}")
-            return file_path
-        except Exception as save_error:
-            logger.error(f"Error saving image to file: {str(save_error)}")
-            return None
+        image_bytes, _ = decode_image_data(image_data)
+        # Only parses the header; the pixels are decoded once, in prepare_vision_image
+        with Image.open(BytesIO(image_bytes)) as img:
+            logger.info(f"Received {img.format} image, size: {img.size}, mode: {img.mode}, {len(image_bytes)} bytes")
+        return image_bytes
     except Exception as e:
-        logger.error(f"Error in save_temp_image: {str(e)}")
-        logger.exception("Detailed traceback:")
+        logger.error(f"Could not read the uploaded image: {str(e)}")
         return None
 
-def process_image_with_openai(image_path, analysis_type, subject):
+def build_snap_messages(image_data, analysis_type, subject):
+    """Build the OpenAI messages for a snapped paper image"""
+    # Set system prompt based on subject and analysis type
+    if analysis_type == "question_only":
+        system_prompt = f"""You are an expert A-Level {subject} tutor.
+        Analyze the uploaded image which contains an A-Level {subject} question.
+        Clearly identify what the question is asking, explain key concepts involved,
+        and provide a detailed step-by-step solution.
+        
+        If the image contains handwritten work alongside the question,
+        focus on explaining the question itself rather than evaluating the work.
+        
+        Format your response with clear section headings and use mathematical notation
+        where appropriate, using LaTeX format with $ delimiters for inline math 
+        and $$ delimiters for display math.
+        """
+    else:  # answer_feedback
+        system_prompt = f"""You are an expert A-Level {subject} tutor.
+        Analyze the uploaded image which contains both an A-Level {subject} question 
+        and a student's handwritten solution attempt.
+        
+        1. Identify the question being asked
+        2. Evaluate the student's work, noting what they did correctly and where they made mistakes
+        3. Provide the correct solution with clear explanations
+        4. Offer specific advice to help the student improve
+        
+        Format your response with clear section headings and use mathematical notation
+        where appropriate, using LaTeX format with $ delimiters for inline math 
+        and $$ delimiters for display math.
+        """
+    
+    # Build the API request
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": [
+            {"type": "text", "text": f"Please analyze this A-Level {subject} question and provide detailed help."},
+            {"type": "image_url", "image_url": prepare_vision_image(image_data)}
+        ]}
+    ]
+
+def prepare_snap_request(image_bytes, analysis_type, subject):
+    """
+    Compute the cache key of a snapped image
+    
+    Returns:
+        dict: image bytes, image hash, prompt version and cache key
+    """
+    # Identical uploads (same image, subject and prompt) reuse the shared explanation cache
+    image_sha256 = hashlib.sha256(image_bytes).hexdigest()
+    prompt_version = f"{SNAP_PROMPT_VERSION}-{analysis_type}"
+    return {
+        # Raw bytes: the matcher and prepare_vision_image decode them once, with no base64 round trip
+        "image_bytes": image_bytes,
+        "image_sha256": image_sha256,
+        "prompt_version": prompt_version,
+        "cache_key": make_cache_key(image_sha256, subject, SNAP_MODEL, prompt_version)
+    }
+
+def extract_snap_content(response):
+    """
+    Extract the model output from an OpenAI response
+    
+    Returns:
+        tuple: (content, True if the content is genuine model output worth caching)
+    """
+    if response is None:
+        return "No response received from AI service.", False
+    if isinstance(response, dict):
+        # Handle dictionary response
+        choices = response.get("choices", [])
+        if choices and len(choices) > 0:
+            if isinstance(choices[0], dict):
+                message = choices[0].get("message", {})
+                if isinstance(message, dict):
+                    content = message.get("content", "")
+                    return content, bool(content)
+                return str(message), False
+            return str(choices[0]), False
+        return "No content in AI response.", False
+    
+    # Handle if response is not a dictionary (OpenAI response object)
+    try:
+        return response.choices[0].message.content, False
+    except (AttributeError, IndexError) as e:
+        logger.error(f"Error extracting content: {str(e)}")
+        return "Unable to extract content from response", False
+
+def format_snap_result(content):
+    """Build the API result for an analysis"""
+    # Parse content to identify sections
+    # This is a simple implementation; enhance as needed
+    title = "Analysis Results"
+    analysis = content
+    steps = []
+    
+    # Look for section headings and split content
+    section_pattern = r'#{1,3}\s+([^\n]+)'
+    sections = re.findall(section_pattern, content)
+    if sections:
+        title = sections[0]
+    
+    # Format result
+    return {
+        "success": True,
+        "title": title,
+        "analysis": analysis,
+        "steps": steps
+    }
+
+def process_image_with_openai(image_bytes, analysis_type, subject):
     """Process image with OpenAI's vision model"""
     try:
         # Check if OpenAI key is configured
@@ -135,54 +190,28 @@ def process_image_with_openai(image_path, analysis_type, subject):
             }
         
         # Prepare the image for API request
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+        snap_request = prepare_snap_request(image_bytes, analysis_type, subject)
+        cache_key = snap_request["cache_key"]
+        
+        cached_content = explanation_cache.get(cache_key)
+        if cached_content:
+            logger.info(f"Serving snap analysis from explanation cache: {cache_key[:12]}")
+            return format_snap_result(cached_content)
         
-        # Set system prompt based on subject and analysis type
+        # A photo of a question already in the bank gets that question's explanation
         if analysis_type == "question_only":
-            system_prompt = f"""You are an expert A-Level {subject} tutor.
-            Analyze the uploaded image which contains an A-Level {subject} question.
-            Clearly identify what the question is asking, explain key concepts involved,
-            and provide a detailed step-by-step solution.
-            
-            If the image contains handwritten work alongside the question,
-            focus on explaining the question itself rather than evaluating the work.
-            
-            Format your response with clear section headings and use mathematical notation
-            where appropriate, using LaTeX format with $ delimiters for inline math 
-            and $$ delimiters for display math.
-            """
-        else:  # answer_feedback
-            system_prompt = f"""You are an expert A-Level {subject} tutor.
-            Analyze the uploaded image which contains both an A-Level {subject} question 
-            and a student's handwritten solution attempt.
-            
-            1. Identify the question being asked
-            2. Evaluate the student's work, noting what they did correctly and where they made mistakes
-            3. Provide the correct solution with clear explanations
-            4. Offer specific advice to help the student improve
-            
-            Format your response with clear section headings and use mathematical notation
-            where appropriate, using LaTeX format with $ delimiters for inline math 
-            and $$ delimiters for display math.
-            """
-        
-        # Build the API request
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": [
-                {"type": "text", "text": f"Please analyze this A-Level {subject} question and provide detailed help."},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-            ]}
-        ]
+            matched_content = find_question_explanation(snap_request["image_bytes"], subject)
+            if matched_content:
+                return format_snap_result(matched_content)
         
         # Make the API call with retry logic
         response = call_openai_with_retry(
-            model="gpt-4o",  # Use GPT-4o for vision capabilities
-            messages=messages,
+            model=SNAP_MODEL,  # Use GPT-4o for vision capabilities
+            messages=build_snap_messages(snap_request["image_bytes"], analysis_type, subject),
             max_tokens=1500,  # Adjust token limit as needed
             temperature=0.0,  # Lower temperature for more factual responses
-            detailed_error=True
+            detailed_error=True,
+            prompt_version=snap_request["prompt_version"]
         )
         
         if not response or "error" in response:
@@ -192,49 +221,70 @@ def process_image_with_openai(image_path, analysis_type, subject):
             }
         
         # Extract and format content from response
-        if response is None:
-            content = "No response received from AI service."
-        elif isinstance(response, dict):
-            # Handle dictionary response
-            choices = response.get("choices", [])
-            if choices and len(choices) > 0:
-                if isinstance(choices[0], dict):
-                    message = choices[0].get("message", {})
-                    if isinstance(message, dict):
-                        content = message.get("content", "")
-                    else:
-                        content = str(message)
-                else:
-                    content = str(choices[0])
-            else:
-                content = "No content in AI response."
-        else:
-            # Handle if response is not a dictionary (OpenAI response object)
-            try:
-                content = response.choices[0].message.content
-            except (AttributeError, IndexError) as e:
-                logger.error(f"Error extracting content: {str(e)}")
-                content = "Unable to extract content from response"
-        
-        # Parse content to identify sections
-        # This is a simple implementation; enhance as needed
-        title = "Analysis Results"
-        analysis = content
-        steps = []
-        
-        # Look for section headings and split content
-        section_pattern = r'#{1,3}\s+([^\n]+)'
-        sections = re.findall(section_pattern, content)
-        if sections:
-            title = sections[0]
-        
-        # Format result
+        content, cacheable = extract_snap_content(response)
+        if cacheable:
+            # Only genuine model output is worth caching
+            explanation_cache.put(cache_key, snap_request["image_sha256"], subject, SNAP_MODEL,
+                                  snap_request["prompt_version"], content)
+        return format_snap_result(content)
+        
+    except Exception as e:
+        logger.error(f"Error processing image with OpenAI: {str(e)}")
         return {
-            "success": True,
-            "title": title,
-            "analysis": analysis,
-            "steps": steps
+            "success": False,
+            "error": "Failed to process image. Please try again."
         }
+
+async def process_image_with_openai_async(image_bytes, analysis_type, subject):
+    """Async variant of process_image_with_openai used by the background AI job workers"""
+    try:
+        api_key = check_openai_key()
+        if not api_key:
+            return {
+                "success": False,
+                "error": "OpenAI API key is not configured. Please contact support."
+            }
+        
+        snap_request = await asyncio.to_thread(prepare_snap_request, image_bytes, analysis_type, subject)
+        cache_key = snap_request["cache_key"]
+        
+        cached_content = await asyncio.to_thread(explanation_cache.get, cache_key)
+        if cached_content:
+            logger.info(f"Serving snap analysis from explanation cache: {cache_key[:12]}")
+            return format_snap_result(cached_content)
+        
+        if analysis_type == "question_only":
+            matched_content = await asyncio.to_thread(
+                find_question_explanation, snap_request["image_bytes"], subject
+            )
+            if matched_content:
+                return format_snap_result(matched_content)
+        
+        messages = await asyncio.to_thread(
+            build_snap_messages, snap_request["image_bytes"], analysis_type, subject
+        )
+        response = await call_openai_async(
+            model=SNAP_MODEL,
+            messages=messages,
+            max_tokens=1500,
+            temperature=0.0,
+            detailed_error=True,
+            prompt_version=snap_request["prompt_version"]
+        )
+        
+        if not response or "error" in response:
+            return {
+                "success": False,
+                "error": response.get("error", "Failed to analyze image with AI service.")
+            }
+        
+        content, cacheable = extract_snap_content(response)
+        if cacheable:
+            await asyncio.to_thread(
+                explanation_cache.put, cache_key, snap_request["image_sha256"], subject, SNAP_MODEL,
+                snap_request["prompt_version"], content
+            )
+        return format_snap_result(content)
         
     except Exception as e:
         logger.error(f"Error processing image with OpenAI: {str(e)}")
@@ -294,6 +344,52 @@ def log_user_query(user_id, query_type, subject, image_path=None):
         db.session.rollback()
         return None
 
+def complete_snap_analysis(user_id, analysis_type, subject, result):
+    """
+    Charge the user for a successful analysis and log the query
+    
+    Returns:
+        tuple: (response dict, HTTP status)
+    """
+    if not result["success"]:
+        return result, 400
+    
+    # Deduct credits and log query
+    if not deduct_credits(user_id, REQUIRED_CREDITS):
+        return {
+            "success": False,
+            "error": "Failed to deduct credits. Please try again."
+        }, 400
+    
+    # Log the query
+    log_user_query(user_id, analysis_type, subject)
+    
+    # Add credits to response
+    result["credits"] = User.query.get(user_id).credits
+    return result, 200
+
+async def run_snap_job(payload):
+    image_bytes = await asyncio.to_thread(read_stored_image, payload['image_path'])
+    return await process_image_with_openai_async(
+        image_bytes, payload['analysis_type'], payload['subject']
+    )
+
+def finalize_snap_job(job, result):
+    payload = job.get_payload()
+    if not is_blob_path(payload['image_path']):
+        # Jobs queued before snaps were kept in the blob store used a temp file
+        cleanup_temp_file(payload['image_path'])
+    return complete_snap_analysis(job.user_id, payload['analysis_type'], payload['subject'], result)
+
+def _snap_job_error(exception):
+    return {
+        "success": False,
+        "error": "An unexpected error occurred. Please try again."
+    }, 500
+
+finalize_snap_job.format_error = _snap_job_error
+register_job_type('analyze_any_paper', run_snap_job, finalize_snap_job)
+
 @snap_paper_bp.route('/snap-any-paper')
 @login_required
 def snap_any_paper():
@@ -407,10 +503,10 @@ def analyze_any_paper():
                 "error": f"You don't have enough credits. {REQUIRED_CREDITS} credits required."
             }), 400
         
-        # Get request data
-        data = request.json
+        # Get request data (a binary multipart upload, or JSON with a data URI)
+        data = request_fields()
         logger.info(f"Request data received: {bool(data)}")
-        if not data:
+        if not data and not is_multipart_upload():
             logger.error("No JSON data provided in request")
             return jsonify({
                 "success": False,
@@ -420,7 +516,29 @@ def analyze_any_paper():
         # Log the keys in the request data for debugging
         logger.info(f"Request data keys: {list(data.keys()) if isinstance(data, dict) else 'Not a dictionary'}")
         
-        image_data = data.get('image')
+        # A file part (or finished chunked upload) is streamed into the blob store and only
+        # read once its size is known to be acceptable; older clients send a data URI
+        try:
+            image_path, _ = uploaded_image(data, 'image')
+        except ValueError as upload_error:
+            return jsonify({
+                "success": False,
+                "error": str(upload_error)
+            }), 400
+        image_data = None if image_path else data.get('image')
+        if image_path:
+            image_size = os.path.getsize(image_path)
+        else:
+            image_size = len(image_data) * 3 // 4 if isinstance(image_data, str) else 0
+        too_large = oversized_image_message(image_size)
+        if too_large:
+            logger.warning(f"Rejected oversized snap of {image_size} bytes")
+            return jsonify({
+                "success": False,
+                "error": too_large
+            }), 413
+        if image_path:
+            image_data = read_stored_image(image_path)
         analysis_type = data.get('analysis_type', 'question_only')
         subject = data.get('subject', 'mathematics')
         
@@ -437,37 +555,41 @@ def analyze_any_paper():
                 "error": "No image provided."
             }), 400
         
-        # Save temporary image
-        temp_file_path = save_temp_image(image_data)
-        if not temp_file_path:
+        # Decode the image once, in memory
+        image_bytes = decode_snap_image(image_data)
+        if not image_bytes:
             return jsonify({
                 "success": False,
                 "error": "Failed to process the image. Please try again."
             }), 400
         
-        # Process image with OpenAI
-        result = process_image_with_openai(temp_file_path, analysis_type, subject)
-        
-        # Cleanup temp file
-        cleanup_temp_file(temp_file_path)
-        
-        if not result["success"]:
-            return jsonify(result), 400
-        
-        # Deduct credits and log query
-        if not deduct_credits(current_user.id, REQUIRED_CREDITS):
+        # Turn away blurry, dark or unreadable photos before spending credits and model time
+        rejection = quality_rejection(image_bytes)
+        if rejection:
             return jsonify({
                 "success": False,
-                "error": "Failed to deduct credits. Please try again."
-            }), 400
+                "error": rejection['message'],
+                "quality": rejection
+            }), 422
+        
+        # Crop the photo to the page and straighten it; the result is what is stored and sent
+        image_bytes, _ = rectify_page(image_bytes)
+        
+        # Hand the request to the background job workers if the client asked for a job id;
+        # only then is the image persisted (unreferenced, so the blob store collects it later)
+        if async_requested(request):
+            job = enqueue_job('analyze_any_paper', {
+                'image_path': store_bytes(image_bytes, referenced=False),
+                'analysis_type': analysis_type,
+                'subject': subject
+            }, user_id=current_user.id)
+            return job_accepted_response(job)
         
-        # Log the query
-        log_user_query(current_user.id, analysis_type, subject)
-        
-        # Add credits to response
-        result["credits"] = current_user.credits
+        # Process image with OpenAI
+        result = process_image_with_openai(image_bytes, analysis_type, subject)
         
-        return jsonify(result), 200
+        response_data, status = complete_snap_analysis(current_user.id, analysis_type, subject, result)
+        return jsonify(response_data), status
         
     except Exception as e:
         logger.error(f"Error in analyze_any_paper: {str(e)}")
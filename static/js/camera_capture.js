@@ -9,6 +9,8 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Global variable to store captured image
     let capturedImageData;
+    // The same photo compressed for upload at the size the AI uses (a Promise of a Blob)
+    let capturedImageUpload = null;
 
     // Get all DOM elements
     const elements = {
@@ -219,12 +221,15 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
-        // Validate file size (10MB max)
-        if (file.size > 10 * 1024 * 1024) {
-            alert('File size exceeds 10MB limit. Please select a smaller file.');
+        // Validate file size (25MB max; the photo is compressed before it is uploaded)
+        if (file.size > 25 * 1024 * 1024) {
+            alert('File size exceeds 25MB limit. Please select a smaller file.');
             return;
         }
         
+        // Compress the full-resolution photo for upload in the background
+        capturedImageUpload = compressImage(file);
+        
         // Create a FileReader to read the image
         const reader = new FileReader();
         
@@ -499,6 +504,17 @@ document.addEventListener('DOMContentLoaded', function() {
         elements.analyzeBtn.disabled = true;
     }
     
+    // The photo to upload: the compressed version, or the preview if compression failed
+    function capturedImageBlob() {
+        if (!capturedImageUpload) {
+            return Promise.resolve(dataURLToBlob(capturedImageData));
+        }
+        return capturedImageUpload.catch(error => {
+            console.warn('Image compression failed, uploading the preview instead:', error);
+            return dataURLToBlob(capturedImageData);
+        });
+    }
+    
     // Proceed with analysis after consent - make it available globally
     window.proceedWithAnalysis = function() {
         console.log("proceedWithAnalysis called");
@@ -562,32 +578,28 @@ document.addEventListener('DOMContentLoaded', function() {
             
             console.log('Preparing to send image analysis request...');
             
-            // Create the request payload with exact size logging
-            const payload = {
-                image_data: capturedImageData,
-                subject: subject,
-                exam_board: examBoard,
-                mode: 'question-only'
-            };
-            
-            // Log payload size for debugging
-            const payloadSize = JSON.stringify(payload).length;
-            console.log('Request payload size: ' + Math.round(payloadSize / 1024) + ' KB');
-            
-            // Check if payload is extremely large
-            if (payloadSize > 5 * 1024 * 1024) { // 5MB
-                console.error('Payload too large:', Math.round(payloadSize / 1024 / 1024), 'MB');
-                handleAnalysisError(new Error('The image is too large to process. Please try with a smaller image or lower resolution.'));
-                return;
-            }
-            
-            console.log('Sending analysis request to server...');
-            const fetchPromise = fetch('/api/analyze-captured-image', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify(payload)
+            // Send the compressed image as a binary file part rather than a base64 string in JSON
+            const fetchPromise = capturedImageBlob().then(imageBlob => {
+                console.log('Image upload size: ' + Math.round(imageBlob.size / 1024) + ' KB');
+                
+                // Check if the image is extremely large
+                if (imageBlob.size > 5 * 1024 * 1024) { // 5MB
+                    console.error('Image too large:', Math.round(imageBlob.size / 1024 / 1024), 'MB');
+                    throw new Error('The image is too large to process. Please try with a smaller image or lower resolution.');
+                }
+                
+                // Upload the photo in resumable chunks, then refer to it by its upload id
+                return buildImageFormData({ image: imageBlob }, {
+                    subject: subject,
+                    exam_board: examBoard,
+                    mode: 'question-only'
+                });
+            }).then(formData => {
+                console.log('Sending analysis request to server...');
+                return fetchAIJob('/api/analyze-captured-image', {
+                    method: 'POST',
+                    body: formData
+                });
             });
             
             // Use Promise.race to implement timeout
@@ -596,6 +608,12 @@ document.addEventListener('DOMContentLoaded', function() {
                     const processingTime = (new Date() - startTime) / 1000;
                     console.log('Received server response after ' + processingTime + ' seconds');
                     
+                    if (response && (response.status === 413 || response.status === 422)) {
+                        // The photo is over the upload limit or failed the quality check; show the server's explanation
+                        return response.json().then(data => {
+                            throw new Error(data.message || 'The image is too large to process.');
+                        });
+                    }
                     if (!response || !response.ok) {
                         // Check if it's an authentication error
                         if (response && (response.status === 401 || response.url.includes('login'))) {
@@ -630,19 +648,25 @@ document.addEventListener('DOMContentLoaded', function() {
                 setTimeout(() => reject(new Error('Request timed out after 90 seconds')), 90000);
             });
             
-            const fetchPromise = fetch('/api/analyze-answer', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    question_image: capturedImageData,
-                    answer_image: capturedImageData, // Using same image, but the AI will analyze both parts
+            // Stream the feedback so the first paragraphs render while the rest is generated
+            elements.feedbackContent.innerHTML = '';
+            // One photo holds both the question and the answer, so it is uploaded once
+            const fetchPromise = capturedImageBlob().then(imageBlob => {
+                return buildImageFormData({ question_image: imageBlob }, {
                     subject: subject,
                     exam_board: examBoard,
                     mode: 'answer-feedback',
-                    combined_image: true
-                })
+                    combined_image: 'true'
+                });
+            }).then(formData => {
+                return fetchAIStream('/api/analyze-answer/stream', {
+                    method: 'POST',
+                    body: formData
+                }, html => {
+                    elements.feedbackLoading.style.display = 'none';
+                    elements.feedbackResult.style.display = 'block';
+                    elements.feedbackContent.insertAdjacentHTML('beforeend', html);
+                });
             });
             
             // Use Promise.race to implement timeout
@@ -651,6 +675,12 @@ document.addEventListener('DOMContentLoaded', function() {
                     const processingTime = (new Date() - startTime) / 1000;
                     console.log('Received server response after ' + processingTime + ' seconds');
                     
+                    if (response && (response.status === 413 || response.status === 422)) {
+                        // The photo is over the upload limit or failed the quality check; show the server's explanation
+                        return response.json().then(data => {
+                            throw new Error(data.message || 'The image is too large to process.');
+                        });
+                    }
                     if (!response || !response.ok) {
                         // Check if it's an authentication error
                         if (response && (response.status === 401 || response.url.includes('login'))) {
@@ -1224,6 +1254,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // Capture button
     if (elements.captureBtn) {
         elements.captureBtn.addEventListener('click', function() {
+            // Compress the full-resolution frame for upload in the background
+            capturedImageUpload = compressImage(elements.video);
+            
             // Get canvas context
             const context = elements.canvas.getContext('2d');
             
@@ -1420,6 +1453,7 @@ document.addEventListener('DOMContentLoaded', function() {
         elements.startOverBtn.addEventListener('click', function() {
             // Clear previous capture
             capturedImageData = null;
+            capturedImageUpload = null;
             
             // Reset UI
             elements.feedbackResult.style.display = 'none';
@@ -1454,6 +1488,7 @@ document.addEventListener('DOMContentLoaded', function() {
         elements.newUploadBtn.addEventListener('click', function() {
             // Clear previous capture
             capturedImageData = null;
+            capturedImageUpload = null;
             
             // Reset UI while keeping feedback hidden
             elements.feedbackResult.style.display = 'none';
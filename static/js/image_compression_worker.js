@@ -0,0 +1,46 @@
+/**
+ * Web Worker that resizes and re-encodes photos before they are uploaded.
+ *
+ * Phone cameras produce 3-12 MB frames, but the server only ever shows the
+ * vision model an image fitted within 2048x2048 with its short side at most
+ * 768px (see utils/image_preparation.py). Decoding, scaling and encoding run
+ * here on an OffscreenCanvas so the capture page stays responsive.
+ *
+ * Message in:  { id, source: Blob | ImageBitmap, target: { maxLongSide, maxShortSide, type, quality } }
+ * Message out: { id, blob, width, height } or { id, error }
+ */
+
+/**
+ * Size the vision model works at, never larger than the original
+ * (mirrors vision_target_size in utils/image_preparation.py)
+ */
+function targetSize(width, height, target) {
+    let scale = Math.min(1, target.maxLongSide / Math.max(width, height));
+    scale *= Math.min(1, target.maxShortSide / (Math.min(width, height) * scale));
+    return {
+        width: Math.max(1, Math.round(width * scale)),
+        height: Math.max(1, Math.round(height * scale))
+    };
+}
+
+self.onmessage = async function(event) {
+    const { id, source, target } = event.data;
+    try {
+        // Files are decoded here, upright from their EXIF orientation
+        const bitmap = source instanceof Blob
+            ? await createImageBitmap(source, { imageOrientation: 'from-image' })
+            : source;
+        const size = targetSize(bitmap.width, bitmap.height, target);
+
+        const canvas = new OffscreenCanvas(size.width, size.height);
+        const context = canvas.getContext('2d');
+        context.imageSmoothingQuality = 'high';
+        context.drawImage(bitmap, 0, 0, size.width, size.height);
+        bitmap.close();
+
+        const blob = await canvas.convertToBlob({ type: target.type, quality: target.quality });
+        self.postMessage({ id: id, blob: blob, width: size.width, height: size.height });
+    } catch (error) {
+        self.postMessage({ id: id, error: error.message || String(error) });
+    }
+};
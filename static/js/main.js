@@ -88,3 +88,343 @@ function formatExplanation(text) {
     
     return text;
 }
+
+/**
+ * Convert a base64 data URI (e.g. from canvas.toDataURL) to a Blob,
+ * so it can be uploaded as a binary file part of a FormData body.
+ * @param {string} dataUrl - The data URI
+ * @returns {Blob} The decoded image
+ */
+function dataURLToBlob(dataUrl) {
+    const [header, base64] = dataUrl.split(',', 2);
+    const mimeMatch = header.match(/^data:([^;]+)/);
+    const binary = atob(base64);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return new Blob([bytes], { type: mimeMatch ? mimeMatch[1] : 'image/jpeg' });
+}
+
+/**
+ * Size and encoding photos are compressed to before upload. The vision model
+ * never sees more than 2048px on the long side or 768px on the short side
+ * (see utils/image_preparation.py), so larger uploads are only wasted bandwidth.
+ */
+const IMAGE_UPLOAD_TARGET = {
+    maxLongSide: 2048,
+    maxShortSide: 768,
+    type: 'image/jpeg',
+    quality: 0.85
+};
+
+let imageCompressionWorker = null;
+let imageCompressionRequests = 0;
+
+/**
+ * Size an image is compressed to, never larger than the original
+ * @param {number} width - Original width
+ * @param {number} height - Original height
+ * @returns {{width: number, height: number}} Target size
+ */
+function imageUploadSize(width, height) {
+    let scale = Math.min(1, IMAGE_UPLOAD_TARGET.maxLongSide / Math.max(width, height));
+    scale *= Math.min(1, IMAGE_UPLOAD_TARGET.maxShortSide / (Math.min(width, height) * scale));
+    return {
+        width: Math.max(1, Math.round(width * scale)),
+        height: Math.max(1, Math.round(height * scale))
+    };
+}
+
+/**
+ * Resize and re-encode a photo for upload, in a Web Worker where the browser
+ * supports OffscreenCanvas and on the main thread otherwise.
+ * @param {Blob|HTMLVideoElement|HTMLCanvasElement|HTMLImageElement} source - A picked file or a camera frame
+ * @returns {Promise<Blob>} The compressed JPEG
+ */
+async function compressImage(source) {
+    if (window.Worker && typeof OffscreenCanvas !== 'undefined' && typeof createImageBitmap !== 'undefined') {
+        if (!(source instanceof Blob)) {
+            // Grab the camera frame now, before the stream is stopped
+            source = await createImageBitmap(source);
+        }
+        try {
+            return await compressImageInWorker(source);
+        } catch (error) {
+            console.warn('Image compression worker failed, compressing on the main thread:', error);
+        }
+    }
+    return compressImageOnMainThread(source);
+}
+
+async function compressImageInWorker(source) {
+    if (!imageCompressionWorker) {
+        imageCompressionWorker = new Worker('/static/js/image_compression_worker.js');
+    }
+    const id = ++imageCompressionRequests;
+
+    return new Promise((resolve, reject) => {
+        const worker = imageCompressionWorker;
+        function onError(event) {
+            // The worker script failed to load or crashed; don't reuse it
+            worker.removeEventListener('message', onMessage);
+            imageCompressionWorker = null;
+            reject(new Error(event.message || 'Image compression worker error'));
+        }
+        function onMessage(event) {
+            if (event.data.id !== id) {
+                return;
+            }
+            worker.removeEventListener('message', onMessage);
+            worker.removeEventListener('error', onError);
+            if (event.data.error) {
+                reject(new Error(event.data.error));
+            } else {
+                console.log('Compressed image to', event.data.width, 'x', event.data.height, '-', Math.round(event.data.blob.size / 1024), 'KB');
+                resolve(event.data.blob);
+            }
+        }
+        worker.addEventListener('message', onMessage);
+        worker.addEventListener('error', onError, { once: true });
+        worker.postMessage({ id: id, source: source, target: IMAGE_UPLOAD_TARGET });
+    });
+}
+
+async function compressImageOnMainThread(source) {
+    let image = source;
+    let objectUrl = null;
+    try {
+        if (source instanceof Blob) {
+            objectUrl = URL.createObjectURL(source);
+            image = await new Promise((resolve, reject) => {
+                const img = new Image();
+                img.onload = () => resolve(img);
+                img.onerror = () => reject(new Error('The selected file could not be read as an image.'));
+                img.src = objectUrl;
+            });
+        }
+        const size = imageUploadSize(
+            image.videoWidth || image.naturalWidth || image.width,
+            image.videoHeight || image.naturalHeight || image.height
+        );
+        const canvas = document.createElement('canvas');
+        canvas.width = size.width;
+        canvas.height = size.height;
+        canvas.getContext('2d').drawImage(image, 0, 0, size.width, size.height);
+        return await new Promise(resolve => canvas.toBlob(resolve, IMAGE_UPLOAD_TARGET.type, IMAGE_UPLOAD_TARGET.quality));
+    } finally {
+        if (objectUrl) {
+            URL.revokeObjectURL(objectUrl);
+        }
+    }
+}
+
+// Upload ids by file checksum, so retrying an analysis resumes the earlier upload
+const resumableUploads = new Map();
+
+async function sha256Hex(data) {
+    const hash = await crypto.subtle.digest('SHA-256', data);
+    return Array.from(new Uint8Array(hash), byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
+/**
+ * Upload a photo in fixed-size chunks that survive a flaky connection.
+ * A failed chunk is retried with backoff from the position the server
+ * reports, so an interruption costs one chunk rather than the whole photo.
+ * @param {Blob} blob - The image to upload
+ * @param {number} maxRetries - Consecutive failures allowed before giving up
+ * @returns {Promise<string>} The upload id, for the `<field>_upload_id` request field
+ */
+async function uploadImageResumable(blob, maxRetries = 5) {
+    const buffer = await blob.arrayBuffer();
+    const sha256 = await sha256Hex(buffer);
+    let upload = null;
+    
+    const knownId = resumableUploads.get(sha256);
+    if (knownId) {
+        const response = await fetch(`/api/uploads/${knownId}`, { cache: 'no-store' });
+        if (response.ok) {
+            upload = await response.json();
+        }
+    }
+    if (!upload) {
+        const response = await fetch('/api/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ size: blob.size, sha256: sha256 })
+        });
+        upload = await response.json();
+        if (!response.ok) {
+            throw new Error(upload.message || `Could not start the upload (status ${response.status})`);
+        }
+        resumableUploads.set(sha256, upload.upload_id);
+    }
+    
+    let failures = 0;
+    while (upload.status !== 'complete') {
+        const index = upload.received_chunks;
+        const chunk = buffer.slice(index * upload.chunk_size, Math.min(blob.size, (index + 1) * upload.chunk_size));
+        try {
+            const response = await fetch(`/api/uploads/${upload.upload_id}/chunks/${index}`, {
+                method: 'PUT',
+                headers: {
+                    'Content-Type': 'application/octet-stream',
+                    'X-Chunk-SHA256': await sha256Hex(chunk)
+                },
+                body: chunk
+            });
+            const result = await response.json();
+            if (response.ok) {
+                upload = result;
+                failures = 0;
+                continue;
+            }
+            if ([404, 413, 415].includes(response.status)) {
+                resumableUploads.delete(sha256);
+                throw Object.assign(new Error(result.message), { permanent: true });
+            }
+            // Out of order, corrupted or failed verification: carry on from the server's position
+            upload = Object.assign({}, upload, result);
+        } catch (error) {
+            if (error.permanent) {
+                throw error;
+            }
+            console.warn(`Chunk ${index} of upload ${upload.upload_id} failed:`, error);
+        }
+        
+        if (++failures > maxRetries) {
+            throw new Error('The upload kept failing. Please check your connection and try again.');
+        }
+        await new Promise(resolve => setTimeout(resolve, Math.min(1000 * 2 ** failures, 15000)));
+        try {
+            const response = await fetch(upload.upload_url || `/api/uploads/${upload.upload_id}`, { cache: 'no-store' });
+            if (response.ok) {
+                upload = Object.assign({}, upload, await response.json());
+            }
+        } catch (error) {
+            // Still offline; the next attempt will tell
+        }
+    }
+    return upload.upload_id;
+}
+
+/**
+ * Build the FormData for an analysis request, uploading each image in
+ * resumable chunks first. Images that cannot be uploaded that way (an older
+ * browser without crypto.subtle, or repeated failures) are sent inline.
+ * @param {Object<string, Blob>} images - Image field name -> image
+ * @param {Object<string, string>} fields - Other form fields
+ * @returns {Promise<FormData>} The request body
+ */
+async function buildImageFormData(images, fields = {}) {
+    const formData = new FormData();
+    for (const [name, blob] of Object.entries(images)) {
+        try {
+            formData.append(`${name}_upload_id`, await uploadImageResumable(blob));
+        } catch (error) {
+            console.warn(`Resumable upload of ${name} failed, sending it with the request:`, error);
+            formData.append(name, blob, `${name}.jpg`);
+        }
+    }
+    Object.entries(fields).forEach(([name, value]) => formData.append(name, value));
+    return formData;
+}
+
+/**
+ * Call a slow AI endpoint as a background job and wait for its result.
+ * The server answers 202 with a status URL, which is polled until the job
+ * finishes. The promise resolves with a Response holding the job's result
+ * and HTTP status, so callers can handle it exactly like a normal fetch.
+ * Servers that answer synchronously are handled transparently.
+ * @param {string} url - The AI endpoint URL
+ * @param {Object} options - fetch() options
+ * @param {number} pollInterval - Milliseconds between status checks
+ * @returns {Promise<Response>} The final response
+ */
+async function fetchAIJob(url, options = {}, pollInterval = 1000) {
+    const headers = Object.assign({}, options.headers || {}, { 'Prefer': 'respond-async' });
+    const response = await fetch(url, Object.assign({}, options, { headers: headers }));
+    
+    if (response.status !== 202) {
+        return response;
+    }
+    
+    const job = await response.json();
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, pollInterval));
+        
+        const statusResponse = await fetch(job.status_url, { cache: 'no-store' });
+        if (!statusResponse.ok) {
+            return statusResponse;
+        }
+        
+        const status = await statusResponse.json();
+        if (status.status === 'succeeded' || status.status === 'failed') {
+            return new Response(JSON.stringify(status.result), {
+                status: status.http_status || (status.status === 'succeeded' ? 200 : 500),
+                headers: { 'Content-Type': 'application/json' }
+            });
+        }
+    }
+}
+
+/**
+ * Call a streaming AI endpoint (server-sent events) and render blocks as they arrive.
+ * The promise resolves with a Response holding the final result and HTTP status,
+ * so callers can handle it exactly like a normal fetch once the stream ends.
+ * @param {string} url - The streaming endpoint URL
+ * @param {Object} options - fetch() options
+ * @param {function(string)} onBlock - Called with the HTML of each completed block
+ * @returns {Promise<Response>} The final response
+ */
+async function fetchAIStream(url, options = {}, onBlock = null) {
+    const response = await fetch(url, options);
+    const contentType = response.headers.get('Content-Type') || '';
+    if (!response.ok || !contentType.includes('text/event-stream')) {
+        return response;
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let final = null;
+    
+    while (final === null) {
+        const { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        
+        // Events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            
+            let eventName = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) {
+                    eventName = line.slice(7);
+                } else if (line.startsWith('data: ')) {
+                    data += line.slice(6);
+                }
+            });
+            
+            if (eventName === 'block' && onBlock) {
+                onBlock(JSON.parse(data).html);
+            } else if (eventName === 'done' || eventName === 'error') {
+                final = JSON.parse(data);
+            }
+        }
+    }
+    
+    if (final === null) {
+        final = { http_status: 502, result: { success: false, message: 'The response stream ended unexpectedly. Please try again.' } };
+    }
+    return new Response(JSON.stringify(final.result), {
+        status: final.http_status,
+        headers: { 'Content-Type': 'application/json' }
+    });
+}
@@ -0,0 +1,90 @@
+import sys
+import time
+import asyncio
+import logging
+
+from app import app  # noqa: F401 (imported first, as the gateway's telemetry needs it)
+from utils import openai_gateway
+from utils.openai_gateway import circuit_breaker
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MESSAGES = [{"role": "user", "content": "Say hello"}]
+
+
+class FakeChunk:
+    """Stand-in for a streamed chat completion chunk"""
+
+    def __init__(self, content):
+        delta = type('Delta', (), {'content': content})()
+        self.choices = [type('Choice', (), {'delta': delta, 'finish_reason': None})()]
+        self.usage = None
+
+
+def half_open():
+    """Put the circuit breaker in the state where the next call is the probe"""
+    circuit_breaker._consecutive_failures = 10 ** 6
+    circuit_breaker._opened_at = time.monotonic() - 10 ** 6
+    circuit_breaker._probe_in_flight = False
+
+
+def test_stream_closed_early():
+    """A client that disconnects mid-stream must not keep the probe forever"""
+    half_open()
+    openai_gateway.openai_client.chat.completions.create = \
+        lambda **kwargs: iter([FakeChunk("a"), FakeChunk("b"), FakeChunk("c")])
+    stream = openai_gateway.stream_chat_completion(MESSAGES, model="gpt-4o", max_tokens=5)
+    next(stream)
+    if not circuit_breaker._probe_in_flight:
+        return False, "the stream was not sent as the probe"
+    stream.close()
+    if circuit_breaker._probe_in_flight:
+        return False, "the probe was still in flight after the stream was closed"
+    if circuit_breaker.before_call() is not True:
+        return False, "the next call was not allowed to probe"
+    return True, "the probe was released"
+
+
+def test_async_call_cancelled():
+    """A job cancelled during its call must release the probe"""
+    half_open()
+
+    async def never_answers(**kwargs):
+        await asyncio.sleep(3600)
+
+    openai_gateway.async_openai_client.chat.completions.create = never_answers
+
+    async def cancel_call():
+        task = asyncio.create_task(
+            openai_gateway.chat_completion_async(MESSAGES, model="gpt-4o", max_tokens=5)
+        )
+        await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(cancel_call())
+    if circuit_breaker._probe_in_flight:
+        return False, "the probe was still in flight after the call was cancelled"
+    return True, "the probe was released"
+
+
+def main():
+    """Check that abandoned half-open calls release the circuit breaker probe (no API key needed)"""
+    success = True
+    for test in (test_stream_closed_early, test_async_call_cancelled):
+        passed, message = test()
+        if passed:
+            logger.info(f"{test.__name__}: {message}")
+        else:
+            logger.error(f"{test.__name__} failed: {message}")
+            success = False
+    return success
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
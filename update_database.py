@@ -4,13 +4,16 @@ from models import (
     QuestionPaper, Question, Explanation, UserProfile, Topic, 
     QuestionTopic, UserQuery, StudentAnswer
 )
+from utils.migrations import apply_migrations
 
 def update_database():
     print("Starting database update...")
     with app.app_context():
         # Create all tables
         db.create_all()
-        print("Database schema updated successfully")
+        # Columns and indexes added to existing tables
+        migrated = apply_migrations()
+        print(f"Database schema updated successfully ({len(migrated)} migrations applied)")
         
         # Get current tables
         tables = db.metadata.tables.keys()
@@ -1,16 +1,41 @@
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, current_app, send_file, flash, make_response
+from flask import Blueprint, render_template, request, jsonify, redirect, url_for, current_app, send_file, flash, make_response, Response, stream_with_context
 import os
+import io
 import base64
 import re
-import uuid
 import json
+import asyncio
 from datetime import datetime
 from flask_login import login_required, current_user
 from models import (
     db, Subject, ExamBoard, PaperCategory, QuestionPaper, 
-    Question, Explanation, User, UserQuery, StudentAnswer, QuestionTopic, UserProfile, UserFeedback
+    Question, Explanation, User, UserQuery, StudentAnswer, QuestionTopic, UserProfile, UserFeedback,
+    QuestionImageHash, MissingAsset
 )
-from utils.openai_helper import generate_explanation, generate_answer_feedback, test_openai_connection
+from utils.openai_helper import (
+    generate_explanation, generate_answer_feedback, generate_answer_feedback_async, test_openai_connection,
+    stream_explanation, stream_answer_feedback, parse_answer_feedback, check_explanation_text
+)
+from utils.explanation_cache import (
+    get_or_generate_explanation, get_or_generate_explanation_async, store_explanation,
+    explanation_cache, explanation_cache_key, explanation_flights, save_question_explanation
+)
+from utils.perceptual_hash import find_question_explanation
+from utils.question_images import question_images, IMAGE_VERSION_LENGTH
+from utils.image_derivatives import select_derivative
+from utils.missing_assets import missing_assets, render_placeholder, find_sample_image, PLACEHOLDER_MAX_AGE
+from utils.file_offload import send_asset
+from utils.blob_store import store_bytes, discard
+from utils.vision_payloads import load_vision_image
+from utils.uploads import (
+    is_multipart_upload, request_fields, field_flag, uploaded_image, read_stored_image, oversized_image_message
+)
+from utils.chunked_uploads import UploadError, create_upload, get_upload, write_chunk
+from utils.image_quality import quality_rejection
+from utils.page_rectification import rectify_page
+from utils.answer_composite import answer_image_layout, compose_answer_image, LAYOUT_COMPOSITE, LAYOUT_SEPARATE
+from utils.streaming import sse_event, BlockBuffer, STREAM_HEADERS
+from utils.ai_jobs import register_job_type, enqueue_job, get_job, async_requested, job_accepted_response, get_worker
 
 # Create user blueprint
 user_bp = Blueprint('user', __name__, template_folder='templates/user')
@@ -19,6 +44,14 @@ user_bp = Blueprint('user', __name__, template_folder='templates/user')
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Browser cache lifetime for versioned (content-addressed) question image URLs
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600
+
+# Make versioned question image URLs available to every template
+@user_bp.app_context_processor
+def inject_question_image_url():
+    return {'question_image_url': question_images.url_for}
+
 @user_bp.route('/')
 def index():
     """User dashboard showing available papers through hierarchical navigation"""
@@ -435,129 +468,50 @@ def get_question_image(question_id):
         paper_id = question.paper_id
         question_num = question.question_number
         
-        # Get the image path from the database record - First priority
-        image_path = question.image_path
-        
-        # Priority order for images:
-        # 1. First, try with the image_path from the database (authentic exam content)
-        # 2. Only if that fails, fall back to sample images
-        
         # Always allow fallback samples as a last resort, but prioritize real images
         use_fallback_samples = True
-        current_app.logger.info(f"Attempting to serve image at path: {image_path}")
-        
-        # Extract folder name and filename for path construction
-        folder_name = os.path.basename(os.path.dirname(image_path))
-        file_name = os.path.basename(image_path)
-        current_app.logger.info(f"Image folder: {folder_name}, filename: {file_name}")
-        
-        # Create a list of possible paths to try, without hardcoding paper or question IDs
-        paths_to_try = [
-            image_path,  # Original path from database
-            image_path.replace('/home/runner/workspace/', './'),  # Relative path
-            f"./data/{folder_name}/{file_name}",  # Local data folder
-            f"./{folder_name}/{file_name}",  # Direct folder access
-            os.path.join(os.getcwd(), 'data', folder_name, file_name),
-            os.path.join(os.getcwd(), folder_name, file_name)
-        ]
-        
-        # Try each path
-        for path in paths_to_try:
-            current_app.logger.info(f"Trying path: {path}")
-            if os.path.isfile(path):
-                current_app.logger.info(f"Found image at: {path}")
-                # Add a timestamp to prevent browser caching
-                response = make_response(send_file(path, mimetype='image/png'))
-                response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-                response.headers['Pragma'] = 'no-cache'
-                response.headers['Expires'] = '0'
-                response.headers['X-Timestamp'] = str(datetime.now().timestamp())
-                return response
-        
-        # If we get here, check for the debug image
-        debug_path = os.path.join(
-            os.getcwd(), 'data', f'paper_{paper_id}', 
-            f"{question_num}_debug.png"
-        )
-        if os.path.isfile(debug_path):
-            current_app.logger.info(f"Using debug image at: {debug_path}")
-            response = make_response(send_file(debug_path, mimetype='image/png'))
-            response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+        
+        # The question's own image (authentic exam content), resolved once per process
+        image_version = question_images.version(question)
+        if image_version:
+            image_path, digest = image_version
+            # Serve a WebP/AVIF derivative at the requested width when the browser accepts one
+            derivative = select_derivative(digest, request.headers.get('Accept'), request.args.get('w', type=int))
+            if derivative:
+                derivative_path, mimetype, width = derivative
+                # Answers If-None-Match / If-Modified-Since with 304 Not Modified; the proxy sends the bytes
+                # when file offload is enabled
+                response = send_asset(derivative_path, mimetype=mimetype, etag=f"{digest[:32]}-{width}-{mimetype[6:]}",
+                                      conditional=True)
+            else:
+                response = send_asset(image_path, mimetype='image/png', etag=digest[:32], conditional=True)
+            response.vary.add('Accept')
+            response.cache_control.public = True
+            if request.args.get('v') == digest[:IMAGE_VERSION_LENGTH]:
+                # Versioned URLs change whenever the image does, so they never need revalidating
+                response.cache_control.no_cache = None
+                response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+                response.cache_control.immutable = True
+            else:
+                response.cache_control.no_cache = True
             return response
-            
-        # If we still don't have an image, use sample images as fallback
-        if use_fallback_samples and question_num and question_num.startswith('q'):
-            try:
-                # Extract question number (q1, q2, etc) and try to find a sample image
-                question_number = question_num.replace('q', '')
-                q_num = int(question_number)
-                
-                # Allow sample fallback for any paper ID when actual images don't exist
-                if q_num > 0 and q_num <= 12:
-                    sample_file = f"703866-q{q_num}.png"
-                    sample_path = os.path.join('./attached_assets', sample_file)
-                    
-                    if os.path.isfile(sample_path):
-                        current_app.logger.info(f"Using sample image as fallback: {sample_path}")
-                        response = make_response(send_file(sample_path, mimetype='image/png'))
-                        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-                        response.headers['Pragma'] = 'no-cache'
-                        response.headers['Expires'] = '0'
-                        response.headers['X-Timestamp'] = str(datetime.now().timestamp())
-                        response.headers['Access-Control-Allow-Origin'] = '*'
-                        return response
-                        
-                    # Try additional fallback locations for sample images
-                    alt_sample_paths = [
-                        f"./attached_assets/q{q_num}.png",
-                        f"./attached_assets/question{q_num}.png",
-                        f"./static/images/sample_q{q_num}.png"
-                    ]
-                    
-                    for alt_path in alt_sample_paths:
-                        if os.path.isfile(alt_path):
-                            current_app.logger.info(f"Using alternative sample image: {alt_path}")
-                            response = make_response(send_file(alt_path, mimetype='image/png'))
-                            response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-                            response.headers['Pragma'] = 'no-cache'
-                            response.headers['Expires'] = '0'
-                            response.headers['X-Timestamp'] = str(datetime.now().timestamp())
-                            response.headers['Access-Control-Allow-Origin'] = '*'
-                            return response
-            except Exception as sample_error:
-                current_app.logger.warning(f"Error using sample image: {str(sample_error)}")
-        
-        # Create a text-based image with question information
-        # This is a last resort when no image is found
-        current_app.logger.warning(f"No image file found for question {question_id}, creating placeholder")
-        from PIL import Image, ImageDraw, ImageFont
-        import io
-        
-        # Create a new image
-        img = Image.new('RGB', (800, 600), color=(40, 40, 45))
-        d = ImageDraw.Draw(img)
-        
-        # Try to get a font, fall back to default if not available
-        try:
-            font = ImageFont.truetype("arial.ttf", 24)
-            small_font = ImageFont.truetype("arial.ttf", 18)
-        except IOError:
-            font = ImageFont.load_default()
-            small_font = ImageFont.load_default()
-        
-        # Add text
-        d.text((50, 50), f"Question {question_num}", fill=(255, 255, 255), font=font)
-        d.text((50, 100), f"Paper ID: {paper_id}", fill=(255, 255, 255), font=small_font)
-        d.text((50, 150), "The original image file could not be found.", fill=(255, 170, 50), font=small_font)
-        
-        # Save to a buffer
-        buf = io.BytesIO()
-        img.save(buf, format='PNG')
-        buf.seek(0)
-        
-        # Return the image
-        response = make_response(send_file(buf, mimetype='image/png'))
-        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+        
+        # The image is missing: count the miss for the admins (in memory, never blocking the request)
+        missing_assets.record(question)
+        
+        # Use a sample image as fallback if there is one for this question number
+        sample_path = find_sample_image(question_num) if use_fallback_samples else None
+        if sample_path:
+            response = send_asset(sample_path, mimetype='image/png', conditional=True, max_age=PLACEHOLDER_MAX_AGE)
+            response.cache_control.public = True
+            response.headers['Access-Control-Allow-Origin'] = '*'
+            return response
+        
+        # Otherwise a text placeholder with the question information, rendered once and memoized
+        png, etag = render_placeholder(paper_id, question_num, "The original image file could not be found.")
+        response = send_file(io.BytesIO(png), mimetype='image/png', etag=etag, conditional=True,
+                             max_age=PLACEHOLDER_MAX_AGE)
+        response.cache_control.public = True
         return response
             
     except Exception as e:
@@ -636,6 +590,469 @@ def process_math_notation(text):
     
     return text
 
+def find_question_image_path(question, allow_samples=True):
+    """
+    Locate the image file for a question, falling back to the bundled sample images
+    
+    Args:
+        question: The Question to find an image for
+        allow_samples: Fall back to sample images when the question's own image is missing
+    
+    Returns:
+        str: Path of the image to use, or None if nothing usable exists
+    """
+    # The question's own image, resolved once per process
+    image_path = question_images.resolve(question)
+    if image_path is None and allow_samples:
+        image_path = find_sample_image(question.question_number, use_default=True)
+        if image_path:
+            current_app.logger.warning(f"Image not found for question {question.id}, using sample image {image_path}")
+    return image_path
+
+def record_implicit_ai_consent(user):
+    """Make sure the user has a profile with AI usage consent recorded (never blocks access)"""
+    # Get user profile for logging but don't block based on consent
+    user_profile = UserProfile.query.filter_by(user_id=user.id).first()
+    
+    # Log status for debugging
+    if user_profile:
+        current_app.logger.info(f"User {user.id} consent status: ai_usage_consent_required={user_profile.ai_usage_consent_required}, last_ai_consent_date={user_profile.last_ai_consent_date}")
+        # Update consent date if needed but don't block access
+        if user_profile.ai_usage_consent_required:
+            user_profile.ai_usage_consent_required = False
+            user_profile.last_ai_consent_date = datetime.utcnow()
+            db.session.commit()
+            current_app.logger.info(f"Updated consent for user {user.id}")
+    else:
+        current_app.logger.warning(f"User {user.id} does not have a UserProfile record")
+        # Create a profile with consent if missing
+        new_profile = UserProfile(
+            user_id=user.id,
+            ai_usage_consent_required=False,
+            last_ai_consent_date=datetime.utcnow()
+        )
+        db.session.add(new_profile)
+        db.session.commit()
+        current_app.logger.info(f"Created profile with consent for user {user.id}")
+
+def friendly_ai_error_message(error_message, multiple_images=False):
+    """Map an OpenAI failure to a user-friendly message"""
+    error_message = error_message.lower()
+    
+    # Provide more robust and user-friendly error messages
+    if "pattern" in error_message:
+        if multiple_images:
+            return "Image format error: There was an issue with the captured images. Please try again with clearer pictures."
+        return "Image format error: There was an issue with the captured image. Please try again with a clearer picture."
+    elif "api key" in error_message or "authentication" in error_message:
+        return "API configuration error. Please contact support."
+    elif "circuit breaker" in error_message:
+        return "The AI service is currently experiencing problems. Please try again in a minute."
+    elif "timeout" in error_message:
+        return "The AI service is taking longer than expected to respond. Please try again in a moment."
+    elif "rate limit" in error_message or "ratelimit" in error_message:
+        return "The AI service is experiencing high demand. Please try again in a few moments."
+    elif "quota" in error_message or "capacity" in error_message or "maximum" in error_message:
+        return "The AI service is temporarily unavailable. Our team has been notified and is working to restore service. Please try again later."
+    elif "model" in error_message and "overloaded" in error_message:
+        return "The AI service is currently at capacity. Please try again in a few minutes."
+    elif "invalid" in error_message and "format" in error_message:
+        return "There was an issue processing the image format. Please try a different image or capture method."
+    
+    # Log the full error for diagnostic purposes but show a simplified message to the user
+    current_app.logger.error(f"Unhandled OpenAI error: {error_message}")
+    return "The AI service is temporarily unavailable. Our team has been notified and is working to restore service. Please try again later."
+
+def save_data_uri_image(image_data):
+    """
+    Decode a data URI (or plain base64 string) and keep it in the blob store until
+    a background job has read it (no row refers to it, so it is garbage collected later);
+    bytes are rectified photos, which are always JPEG
+    
+    Returns:
+        tuple: (blob path, MIME type of the image)
+    """
+    if isinstance(image_data, bytes):
+        return store_bytes(image_data, referenced=False), 'image/jpeg'
+    mime_type = 'image/png'
+    if image_data.startswith('data:') and ';base64,' in image_data:
+        header, image_data = image_data.split(';base64,', 1)
+        mime_type = header[len('data:'):] or mime_type
+    return store_bytes(base64.b64decode(image_data), referenced=False), mime_type
+
+def read_image_as_data_uri(image_path, mime_type='image/png'):
+    """Read an image file from disk and return it as a data URI"""
+    with open(image_path, 'rb') as image_file:
+        image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
+    return f"data:{mime_type};base64,{image_base64}"
+
+
+def quality_rejection_response(report):
+    """422 response telling the student why their photo was not sent for analysis"""
+    return jsonify({
+        'success': False,
+        'message': report['message'],
+        'quality': report
+    }), 422
+
+
+def rectify_answer_images(question_image, answer_image, uploaded):
+    """
+    Crop the photos of an analyze-answer request to the page and straighten them
+    (a combined photo only once)
+    
+    A rectified photo replaces the original as JPEG bytes and, for uploads, as the
+    stored file.
+    
+    Returns:
+        tuple: (question image, answer image, uploaded files), as from answer_request_images
+    """
+    rectified = {}
+    results = []
+    for image, image_file in zip((question_image, answer_image), uploaded or (None, None)):
+        if image not in rectified:
+            image_bytes, corrections = rectify_page(image)
+            if corrections:
+                stored = (store_bytes(image_bytes, referenced=False), 'image/jpeg') if image_file else None
+                rectified[image] = (image_bytes, stored)
+            else:
+                rectified[image] = (image, image_file)
+        results.append(rectified[image])
+    (question_image, question_file), (answer_image, answer_file) = results
+    return question_image, answer_image, (question_file, answer_file) if uploaded else None
+
+def arrange_answer_images(question_image, answer_image, requested_layout=None):
+    """
+    Apply the image layout chosen for a request with separate question and answer photos
+    (see utils/answer_composite.py)
+    
+    Returns:
+        tuple: (question image, answer image, layout) - for the composite layout both
+            images are the same composite JPEG bytes
+    """
+    layout = answer_image_layout(requested_layout, current_user.id)
+    if layout == LAYOUT_COMPOSITE:
+        try:
+            composite = compose_answer_image(question_image, answer_image)
+            return composite, composite, layout
+        except ValueError as compose_error:
+            current_app.logger.warning(f"Sending separate images instead of a composite: {str(compose_error)}")
+            layout = LAYOUT_SEPARATE
+    return question_image, answer_image, layout
+
+def answer_request_images(fields):
+    """
+    The question and answer images of an analyze-answer request
+    
+    A multipart upload has the files 'question_image' and 'answer_image' (which may be
+    left out when combined_image is set), or the ids of finished chunked uploads in
+    'question_image_upload_id'/'answer_image_upload_id'; older JSON requests carry
+    both as data URIs.
+    
+    Returns:
+        tuple: (question image, answer image, uploaded files) - for uploads the images are bytes
+            and the files are ((path, mime), (path, mime)) in the blob store; for JSON the
+            images are data URIs and the files None
+    
+    Raises:
+        ValueError: If an uploaded file is not an image, or an upload id is unknown or unfinished
+    """
+    question_file = uploaded_image(fields, 'question_image')
+    answer_file = uploaded_image(fields, 'answer_image')
+    if question_file[0] is None and answer_file[0] is None and not is_multipart_upload():
+        return fields.get('question_image', ''), fields.get('answer_image', ''), None
+    if answer_file[0] is None and field_flag(fields, 'combined_image'):
+        # One photo holding both the question and the handwritten answer
+        answer_file = question_file
+    question_image = read_stored_image(question_file[0]) if question_file[0] else b''
+    if answer_file == question_file:
+        answer_image = question_image
+    else:
+        answer_image = read_stored_image(answer_file[0]) if answer_file[0] else b''
+    return question_image, answer_image, (question_file, answer_file)
+
+def complete_captured_image_analysis(user, subject, explanation_text):
+    """
+    Format an explanation for a captured image and charge the user for it
+    
+    Returns:
+        tuple: (response dict, HTTP status)
+    """
+    # Process the mathematical notation for display
+    processed_text = process_math_notation(explanation_text)
+    current_app.logger.info("Math notation processed")
+    
+    # Deduct 10 credits for successful AI explanation
+    if not user.use_credits(10):
+        # This should never happen as we checked credits earlier, but just in case
+        current_app.logger.error(f"Failed to deduct credits from user {user.id} - insufficient balance")
+        return {
+            'success': False,
+            'message': 'You need at least 10 credits to use this feature. Please purchase more credits.',
+            'credits_required': True
+        }, 403
+        
+    db.session.commit()
+    current_app.logger.info(f"Deducted 10 credits from user {user.id}, new balance: {user.credits}")
+    
+    return {
+        'success': True,
+        'explanation': processed_text,
+        'subject': subject,
+        'credits_remaining': user.credits,
+        'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    }, 200
+
+def complete_answer_analysis(user, subject, response):
+    """
+    Format answer feedback sections and charge the user for them
+    
+    Returns:
+        tuple: (response dict, HTTP status)
+    """
+    # Extract the different components from the response
+    feedback = process_math_notation(response.get('feedback', 'No feedback available'))
+    explanation = process_math_notation(response.get('explanation', 'No explanation available'))
+    tips = process_math_notation(response.get('tips', 'No tips available'))
+    score = response.get('score', '3/5 Marks')  # Default to 3/5 marks if not provided
+    
+    # Deduct 10 credits for successful AI answer analysis
+    if not user.use_credits(10):
+        # This should never happen as we checked credits earlier, but just in case
+        current_app.logger.error(f"Failed to deduct credits from user {user.id} - insufficient balance")
+        return {
+            'success': False,
+            'message': 'You need at least 10 credits to use this feature. Please purchase more credits.',
+            'credits_required': True
+        }, 403
+        
+    db.session.commit()
+    current_app.logger.info(f"Deducted 10 credits from user {user.id}, new balance: {user.credits}")
+    
+    return {
+        'success': True,
+        'feedback': feedback,
+        'explanation': explanation,
+        'tips': tips,
+        'score': score,
+        'subject': subject,
+        'credits_remaining': user.credits,
+        'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    }, 200
+
+def complete_question_explanation(user, question_id, subject, explanation_text):
+    """
+    Save a newly generated explanation for a stored question and charge the user for it
+    
+    Returns:
+        tuple: (response dict, HTTP status)
+    """
+    # Process the mathematical notation
+    processed_text = process_math_notation(explanation_text)
+    
+    # Create a user query record for tracking
+    user_query = UserQuery(
+        user_id=user.id,
+        query_type='explanation',
+        question_id=question_id,
+        response_text=explanation_text,
+        credits_used=10,
+        subject=subject
+    )
+    
+    # Deduct 10 credits for successful AI explanation
+    if not user.use_credits(10):
+        # This should never happen as we checked credits earlier, but just in case
+        current_app.logger.error(f"Failed to deduct credits from user {user.id} - insufficient balance")
+        return {
+            'success': False,
+            'message': 'You need at least 10 credits to use this feature. Please purchase more credits.',
+            'credits_required': True
+        }, 403
+    
+    # Save the explanation (unless a concurrent request already has) with the credit transaction
+    save_question_explanation(db.session, question_id, explanation_text)
+    db.session.add(user_query)
+    db.session.commit()
+    current_app.logger.info(f"Deducted 10 credits from user {user.id}, new balance: {user.credits}")
+    
+    return {
+        'success': True,
+        'question_id': question_id,
+        'explanation': processed_text,
+        'credits_remaining': user.credits,
+        'is_new': True
+    }, 200
+
+def stream_ai_response(deltas, complete, multiple_images=False):
+    """
+    Stream an AI response to the client as server-sent events
+    
+    Args:
+        deltas: Iterator of text deltas from the model
+        complete: function(full text) -> (response dict, status); persists and charges once the stream has finished
+        multiple_images: Passed to friendly_ai_error_message
+    
+    Returns:
+        Response: A text/event-stream response
+    """
+    def generate():
+        blocks = BlockBuffer()
+        parts = []
+        try:
+            for delta in deltas:
+                parts.append(delta)
+                yield sse_event('token', {'text': delta})
+                # Format each completed paragraph/equation as soon as it is available
+                for block in blocks.feed(delta):
+                    yield sse_event('block', {'html': process_math_notation(block)})
+            for block in blocks.flush():
+                yield sse_event('block', {'html': process_math_notation(block)})
+            
+            response_data, status = complete(''.join(parts))
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error streaming AI response: {str(e)}")
+            response_data = {
+                'success': False,
+                'message': friendly_ai_error_message(str(e), multiple_images=multiple_images)
+            }
+            status = 500
+        
+        yield sse_event('done' if status < 400 else 'error', {'http_status': status, 'result': response_data})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=STREAM_HEADERS)
+
+# ---------------------------------------------------------------------------
+# Background AI jobs (see utils/ai_jobs.py)
+# Runners perform the OpenAI call; finalizers charge the user and build the
+# same response body the synchronous endpoint would have returned.
+# ---------------------------------------------------------------------------
+
+def _job_user(job):
+    return User.query.get(job.user_id)
+
+def _job_error(exception):
+    return {'success': False, 'message': friendly_ai_error_message(str(exception))}, 500
+
+async def run_captured_image_job(payload):
+    image_data = await asyncio.to_thread(read_image_as_data_uri, payload['image_path'])
+    explanation_text = await asyncio.to_thread(find_question_explanation, image_data, payload['subject'])
+    if explanation_text is None:
+        explanation_text, _ = await get_or_generate_explanation_async(image_data, payload['subject'])
+    return explanation_text
+
+def finalize_captured_image_job(job, explanation_text):
+    return complete_captured_image_analysis(_job_user(job), job.get_payload()['subject'], explanation_text)
+
+async def run_answer_job(payload):
+    question_image = await asyncio.to_thread(
+        read_image_as_data_uri, payload['question_image_path'], payload['question_mime']
+    )
+    if payload['combined_image']:
+        answer_image = question_image
+    else:
+        answer_image = await asyncio.to_thread(
+            read_image_as_data_uri, payload['answer_image_path'], payload['answer_mime']
+        )
+    return await generate_answer_feedback_async(
+        question_image, answer_image, payload['subject'], combined_image=payload['combined_image'],
+        layout=payload.get('layout')
+    )
+
+def finalize_answer_job(job, response):
+    return complete_answer_analysis(_job_user(job), job.get_payload()['subject'], response)
+
+async def run_explanation_job(payload):
+    image_data = await asyncio.to_thread(load_vision_image, payload['image_path'])
+    explanation_text, _ = await get_or_generate_explanation_async(
+        image_data, payload['subject'], force_refresh=payload.get('force_refresh', False)
+    )
+    return explanation_text
+
+def finalize_explanation_job(job, explanation_text):
+    payload = job.get_payload()
+    return complete_question_explanation(_job_user(job), payload['question_id'], payload['subject'], explanation_text)
+
+for _finalizer in (finalize_captured_image_job, finalize_answer_job, finalize_explanation_job):
+    _finalizer.format_error = _job_error
+
+register_job_type('analyze_captured_image', run_captured_image_job, finalize_captured_image_job)
+register_job_type('analyze_answer', run_answer_job, finalize_answer_job)
+register_job_type('explain_question', run_explanation_job, finalize_explanation_job)
+
+@user_bp.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def api_job_status(job_id):
+    """Poll the status of a background AI job; the result is included once it has finished"""
+    job = get_job(job_id)
+    if not job or (job.user_id != current_user.id and not current_user.is_admin):
+        return jsonify({
+            'success': False,
+            'message': 'Job not found'
+        }), 404
+
+    response = jsonify(job.to_dict())
+    response.headers['Cache-Control'] = 'no-store'
+    if not job.is_finished:
+        # Hint to the client how long to wait before polling again
+        response.headers['Retry-After'] = '1'
+        # Make sure this process has a worker, so a job abandoned by a dead one is recovered
+        get_worker(current_app._get_current_object())
+    return response
+
+@user_bp.route('/api/uploads', methods=['POST'])
+@login_required
+def api_create_upload():
+    """Open a resumable chunked upload of a photo; the body gives its size and SHA-256"""
+    data = request.get_json(silent=True) or {}
+    try:
+        upload = create_upload(current_user.id, data.get('size'), data.get('sha256'))
+    except UploadError as upload_error:
+        return jsonify({
+            'success': False,
+            'message': str(upload_error)
+        }), upload_error.http_status
+
+    response = upload.to_dict()
+    response['success'] = True
+    response['upload_url'] = url_for('user.api_upload_status', upload_id=upload.id)
+    return jsonify(response), 201
+
+@user_bp.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def api_upload_status(upload_id):
+    """How much of a chunked upload has arrived, so an interrupted client can resume"""
+    upload = get_upload(upload_id, current_user.id)
+    if upload is None:
+        return jsonify({
+            'success': False,
+            'message': 'Upload not found'
+        }), 404
+
+    response = jsonify(dict(upload.to_dict(), success=True))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@user_bp.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def api_upload_chunk(upload_id, index):
+    """Receive one chunk of a chunked upload (the raw bytes are the request body)"""
+    upload = get_upload(upload_id, current_user.id)
+    if upload is None:
+        return jsonify({
+            'success': False,
+            'message': 'Upload not found'
+        }), 404
+
+    try:
+        upload = write_chunk(upload, index, request.get_data(cache=False), request.headers.get('X-Chunk-SHA256'))
+    except UploadError as upload_error:
+        current_app.logger.warning(f"Rejected chunk {index} of upload {upload_id}: {str(upload_error)}")
+        return jsonify(dict(upload.to_dict(), success=False, message=str(upload_error))), upload_error.http_status
+
+    return jsonify(dict(upload.to_dict(), success=True))
+
 @user_bp.route('/api/analyze-captured-image', methods=['POST'])
 @login_required
 def analyze_captured_image():
@@ -677,106 +1094,133 @@ def analyze_captured_image():
                 'credits_required': True
             }), 403
         
-        # Validate request format
-        if not request.json:
-            current_app.logger.error("Invalid request format: No JSON data")
-            return jsonify({
-                'success': False,
-                'message': 'Invalid request format: No JSON data'
-            }), 400
+        fields = request_fields()
+        if is_multipart_upload() or fields.get('image_upload_id'):
+            # Binary or chunked upload: the photo is already in the blob store, never base64-decoded
+            subject = fields.get('subject', 'Mathematics')
+            mode = fields.get('mode', 'question-only')
+            try:
+                image_path, _ = uploaded_image(fields, 'image')
+            except ValueError as upload_error:
+                return jsonify({
+                    'success': False,
+                    'message': str(upload_error)
+                }), 400
+            if not image_path:
+                current_app.logger.error("No image file provided")
+                return jsonify({
+                    'success': False,
+                    'message': 'No image data provided'
+                }), 400
+            too_large = oversized_image_message(os.path.getsize(image_path))
+            if too_large:
+                current_app.logger.warning(f"Rejected oversized upload of {os.path.getsize(image_path)} bytes")
+                return jsonify({
+                    'success': False,
+                    'message': too_large
+                }), 413
+            image_data = read_stored_image(image_path)
+            current_app.logger.info(f"Received uploaded image of {len(image_data)} bytes for subject: {subject}, mode: {mode}")
+        else:
+            # Validate request format
+            if not request.json:
+                current_app.logger.error("Invalid request format: No JSON data")
+                return jsonify({
+                    'success': False,
+                    'message': 'Invalid request format: No JSON data'
+                }), 400
             
-        # Get the image data and subject from the request and log the payload size
-        request_size = len(str(request.json))
-        current_app.logger.info(f"Received analysis request: JSON payload size: {request_size / 1024:.2f} KB")
-        
-        image_data = request.json.get('image_data', '')
-        subject = request.json.get('subject', 'Mathematics')
-        mode = request.json.get('mode', 'question-only')  # Default to question-only
-        
-        current_app.logger.info(f"Processing image for subject: {subject}, mode: {mode}, image data length: {len(image_data) if image_data else 'EMPTY'}")
-        
-        if not image_data:
-            current_app.logger.error("No image data provided")
-            return jsonify({
-                'success': False,
-                'message': 'No image data provided'
-            }), 400
-        
-        # Check image data format
-        if isinstance(image_data, str):
-            current_app.logger.info(f"Received image data of length: {len(image_data)}")
+            # Get the image data and subject from the request and log the payload size
+            request_size = len(str(request.json))
+            current_app.logger.info(f"Received analysis request: JSON payload size: {request_size / 1024:.2f} KB")
             
-            # Handle data URI format (e.g., data:image/jpeg;base64,...)
-            if image_data.startswith('data:'):
-                current_app.logger.info("Received image in data URI format")
-                try:
-                    # Extract the base64 part from the data URI
-                    if ';base64,' in image_data:
-                        base64_part = image_data.split(';base64,')[1]
-                        current_app.logger.info(f"Extracted base64 data of length: {len(base64_part)}")
-                        
-                        # This variable will be used for saving the image
-                        clean_base64 = base64_part
-                    else:
-                        current_app.logger.error("Invalid data URI format (missing base64 marker)")
+            image_data = request.json.get('image_data', '')
+            subject = request.json.get('subject', 'Mathematics')
+            mode = request.json.get('mode', 'question-only')  # Default to question-only
+            
+            current_app.logger.info(f"Processing image for subject: {subject}, mode: {mode}, image data length: {len(image_data) if image_data else 'EMPTY'}")
+            
+            if not image_data:
+                current_app.logger.error("No image data provided")
+                return jsonify({
+                    'success': False,
+                    'message': 'No image data provided'
+                }), 400
+            
+            # Check image data format
+            if isinstance(image_data, str):
+                current_app.logger.info(f"Received image data of length: {len(image_data)}")
+            
+                # Handle data URI format (e.g., data:image/jpeg;base64,...)
+                if image_data.startswith('data:'):
+                    current_app.logger.info("Received image in data URI format")
+                    try:
+                        # Extract the base64 part from the data URI
+                        if ';base64,' in image_data:
+                            base64_part = image_data.split(';base64,')[1]
+                            current_app.logger.info(f"Extracted base64 data of length: {len(base64_part)}")
+            
+                            # This variable will be used for saving the image
+                            clean_base64 = base64_part
+                        else:
+                            current_app.logger.error("Invalid data URI format (missing base64 marker)")
+                            return jsonify({
+                                'success': False,
+                                'message': 'Invalid image format (missing base64 marker)'
+                            }), 400
+                    except Exception as uri_error:
+                        current_app.logger.error(f"Error parsing data URI: {str(uri_error)}")
                         return jsonify({
                             'success': False,
-                            'message': 'Invalid image format (missing base64 marker)'
+                            'message': f'Error parsing image data: {str(uri_error)}'
                         }), 400
-                except Exception as uri_error:
-                    current_app.logger.error(f"Error parsing data URI: {str(uri_error)}")
+                else:
+                    # Assume it's already a clean base64 string
+                    current_app.logger.info("Received image data as plain base64")
+                    clean_base64 = image_data
+            
+                # Validate the base64 data
+                try:
+                    if not clean_base64.strip():
+                        raise ValueError("Empty base64 string")
+                    # Test decode a small sample
+                    padding = "=" * ((4 - len(clean_base64[:20]) % 4) % 4)
+                    base64.b64decode(clean_base64[:20] + padding)
+                    current_app.logger.info("Image data appears to be valid")
+                except Exception as e:
+                    current_app.logger.error(f"Invalid base64 data: {str(e)}")
                     return jsonify({
                         'success': False,
-                        'message': f'Error parsing image data: {str(uri_error)}'
+                        'message': f'Invalid image data format: {str(e)}'
                     }), 400
             else:
-                # Assume it's already a clean base64 string
-                current_app.logger.info("Received image data as plain base64")
-                clean_base64 = image_data
-                
-            # Validate the base64 data
+                current_app.logger.error(f"Received non-string image data: {type(image_data)}")
+                return jsonify({
+                    'success': False,
+                    'message': 'Image data must be a string'
+                }), 400
+            
+            # Reject oversized photos before decoding them (base64 is 4 characters per 3 bytes)
+            too_large = oversized_image_message(len(clean_base64) * 3 // 4)
+            if too_large:
+                current_app.logger.warning(f"Rejected oversized image of {len(clean_base64)} base64 characters")
+                return jsonify({
+                    'success': False,
+                    'message': too_large
+                }), 413
+            
             try:
-                if not clean_base64.strip():
-                    raise ValueError("Empty base64 string")
-                # Test decode a small sample
-                padding = "=" * ((4 - len(clean_base64[:20]) % 4) % 4)
-                base64.b64decode(clean_base64[:20] + padding)
-                current_app.logger.info("Image data appears to be valid")
-            except Exception as e:
-                current_app.logger.error(f"Invalid base64 data: {str(e)}")
+                # Decode and store the base64 image using our cleaned base64 data; identical
+                # photos share one file, which is garbage collected as no row refers to it
+                image_bytes = base64.b64decode(clean_base64)
+                image_path = store_bytes(image_bytes, referenced=False)
+                current_app.logger.info(f"Image saved to {image_path}")
+            except Exception as image_error:
+                current_app.logger.error(f"Error saving image: {str(image_error)}")
                 return jsonify({
                     'success': False,
-                    'message': f'Invalid image data format: {str(e)}'
+                    'message': f'Error processing image data: {str(image_error)}'
                 }), 400
-        else:
-            current_app.logger.error(f"Received non-string image data: {type(image_data)}")
-            return jsonify({
-                'success': False,
-                'message': 'Image data must be a string'
-            }), 400
-        
-        # Create data directory if it doesn't exist
-        data_dir = os.path.join(os.getcwd(), 'data', 'captured_images')
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-            current_app.logger.info(f"Created directory: {data_dir}")
-        
-        # Generate a unique filename and save the image
-        filename = f"captured_{uuid.uuid4().hex}.png"
-        image_path = os.path.join(data_dir, filename)
-        
-        try:
-            # Decode and save the base64 image using our cleaned base64 data
-            image_bytes = base64.b64decode(clean_base64)
-            with open(image_path, 'wb') as f:
-                f.write(image_bytes)
-            current_app.logger.info(f"Image saved to {image_path}")
-        except Exception as image_error:
-            current_app.logger.error(f"Error saving image: {str(image_error)}")
-            return jsonify({
-                'success': False,
-                'message': f'Error processing image data: {str(image_error)}'
-            }), 400
         
         try:
             # Generate explanation using OpenAI
@@ -794,8 +1238,19 @@ def analyze_captured_image():
                     'message': 'The captured image data is invalid or too small. Please try again with a clearer picture.'
                 }), 400
             
+            # Turn away blurry, dark or unreadable photos before spending credits and model time
+            rejection = quality_rejection(image_data)
+            if rejection:
+                return quality_rejection_response(rejection)
+            
+            # Crop the photo to the page and straighten it; the result is what is stored and sent
+            rectified_image, corrections = rectify_page(image_data)
+            if corrections:
+                image_data = rectified_image
+                image_path = store_bytes(rectified_image, referenced=False)
+            
             # Import here to refresh the module and ensure environment variables are loaded
-            from utils.openai_helper import generate_explanation, OPENAI_API_KEY
+            from utils.openai_helper import OPENAI_API_KEY
             
             # Check API key availability
             if not OPENAI_API_KEY:
@@ -807,12 +1262,26 @@ def analyze_captured_image():
                 
             current_app.logger.info(f"OpenAI API key is available (length: {len(OPENAI_API_KEY)})")
             
-            # Call OpenAI with the validated image data (using the full data URI format)
-            explanation_text = generate_explanation(
-                image_data,  # Send the complete data URI
-                subject
-            )
-            current_app.logger.info("Received explanation from OpenAI")
+            # Hand the request to the background job workers if the client asked for a job id
+            if async_requested(request):
+                job = enqueue_job('analyze_captured_image', {
+                    'image_path': image_path,
+                    'subject': subject
+                }, user_id=current_user.id)
+                return job_accepted_response(job)
+            
+            # A photo of a question already in the bank gets that question's explanation
+            explanation_text = find_question_explanation(image_data, subject)
+            if explanation_text is not None:
+                current_app.logger.info("Photo matched an existing question; reusing its explanation")
+            else:
+                # Call OpenAI with the validated image data (using the full data URI format).
+                # Identical photos already explained for this subject are served from the shared cache.
+                explanation_text, from_cache = get_or_generate_explanation(
+                    image_data,  # Send the complete data URI
+                    subject
+                )
+                current_app.logger.info(f"Received explanation ({'cache hit' if from_cache else 'from OpenAI'})")
             
             # Log the length of the explanation received
             current_app.logger.info(f"Received explanation of length: {len(explanation_text)}")
@@ -820,60 +1289,18 @@ def analyze_captured_image():
         except Exception as ai_error:
             error_message = str(ai_error)
             current_app.logger.error(f"OpenAI API error: {error_message}")
-            
-            # Provide more robust and user-friendly error messages
-            if "pattern" in error_message.lower():
-                message = "Image format error: There was an issue with the captured image. Please try again with a clearer picture."
-            elif "api key" in error_message.lower() or "authentication" in error_message.lower():
-                message = "API configuration error. Please contact support."
-            elif "timeout" in error_message.lower():
-                message = "The AI service is taking longer than expected to respond. Please try again in a moment."
-            elif "rate limit" in error_message.lower() or "ratelimit" in error_message.lower():
-                message = "The AI service is experiencing high demand. Please try again in a few moments."
-            elif "quota" in error_message.lower() or "capacity" in error_message.lower() or "maximum" in error_message.lower():
-                message = "The AI service is temporarily unavailable. Our team has been notified and is working to restore service. Please try again later."
-            elif "model" in error_message.lower() and "overloaded" in error_message.lower():
-                message = "The AI service is currently at capacity. Please try again in a few minutes."
-            elif "invalid" in error_message.lower() and "format" in error_message.lower():
-                message = "There was an issue processing the image format. Please try a different image or capture method."
-            else:
-                # Log the full error for diagnostic purposes but show a simplified message to the user
-                current_app.logger.error(f"Unhandled OpenAI error: {error_message}")
-                message = "The AI service is temporarily unavailable. Our team has been notified and is working to restore service. Please try again later."
-                
             return jsonify({
                 'success': False,
-                'message': message
+                'message': friendly_ai_error_message(error_message)
             }), 500
         
         # The explanation is already in text format from OpenAI - no JSON parsing needed
         current_app.logger.info("Using explanation text directly without JSON parsing")
         
-        # Process the mathematical notation for display
-        processed_text = process_math_notation(explanation_text)
-        current_app.logger.info("Math notation processed")
-        
-        # Deduct 10 credits for successful AI explanation
-        if not current_user.use_credits(10):
-            # This should never happen as we checked credits earlier, but just in case
-            current_app.logger.error(f"Failed to deduct credits from user {current_user.id} - insufficient balance")
-            return jsonify({
-                'success': False,
-                'message': 'You need at least 10 credits to use this feature. Please purchase more credits.',
-                'credits_required': True
-            }), 403
-            
-        db.session.commit()
-        current_app.logger.info(f"Deducted 10 credits from user {current_user.id}, new balance: {current_user.credits}")
-        
-        # Build response data
-        response_data = {
-            'success': True,
-            'explanation': processed_text,
-            'subject': subject,
-            'credits_remaining': current_user.credits,
-            'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        }
+        # Format the explanation, deduct credits and build response data
+        response_data, status = complete_captured_image_analysis(current_user, subject, explanation_text)
+        if status != 200:
+            return jsonify(response_data), status
         
         # Ensure the response is properly formatted before returning
         try:
@@ -944,8 +1371,9 @@ def analyze_answer():
                 'credits_required': True
             }), 403
         
-        # Validate request format
-        if not request.json:
+        # Validate request format (a binary multipart upload, or JSON with data URIs)
+        fields = request_fields()
+        if not fields and not is_multipart_upload():
             current_app.logger.error("Invalid request format: No JSON data")
             return jsonify({
                 'success': False,
@@ -953,9 +1381,14 @@ def analyze_answer():
             }), 400
             
         # Get the image data and subject from the request
-        question_image = request.json.get('question_image', '')
-        answer_image = request.json.get('answer_image', '')
-        subject = request.json.get('subject', 'Mathematics')
+        try:
+            question_image, answer_image, uploaded = answer_request_images(fields)
+        except ValueError as upload_error:
+            return jsonify({
+                'success': False,
+                'message': str(upload_error)
+            }), 400
+        subject = fields.get('subject', 'Mathematics')
         
         current_app.logger.info(f"Processing answer for subject: {subject}")
         
@@ -967,22 +1400,21 @@ def analyze_answer():
                 'message': 'Both question and answer images are required'
             }), 400
             
-        # Validate image formats (both should be data URIs)
-        if not isinstance(question_image, str) or not isinstance(answer_image, str):
+        # Validate image formats (data URIs, or bytes for uploads)
+        if not isinstance(question_image, (str, bytes)) or not isinstance(answer_image, (str, bytes)):
             current_app.logger.error("Invalid image data types")
             return jsonify({
                 'success': False,
                 'message': 'Image data must be strings'
             }), 400
         
-        # Create data directory if it doesn't exist
-        data_dir = os.path.join(os.getcwd(), 'data', 'student_answers')
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-            current_app.logger.info(f"Created directory: {data_dir}")
+        # Turn away blurry, dark or unreadable photos before spending credits and model time
+        rejection = quality_rejection(question_image, answer_image)
+        if rejection:
+            return quality_rejection_response(rejection)
         
-        # Generate unique IDs for this analysis
-        analysis_id = uuid.uuid4().hex
+        # Crop the photos to the page and straighten them; the results are what is stored and sent
+        question_image, answer_image, uploaded = rectify_answer_images(question_image, answer_image, uploaded)
         
         try:
             # Call OpenAI to analyze the student's answer
@@ -1002,22 +1434,56 @@ def analyze_answer():
             current_app.logger.info(f"OpenAI API key is available (length: {len(OPENAI_API_KEY)})")
             
             # Log the mode we're using
-            analysis_mode = request.json.get('mode', 'answer-feedback')
+            analysis_mode = fields.get('mode', 'answer-feedback')
             current_app.logger.info(f"Answer analysis mode: {analysis_mode}")
             
             # Check if this is a combined image (explicitly specified or identical images)
-            is_combined_image = request.json.get('combined_image', False)
+            is_combined_image = field_flag(fields, 'combined_image')
             same_image = question_image == answer_image
             
-            if is_combined_image or same_image:
-                current_app.logger.info(f"Using combined image mode: explicitly set={is_combined_image}, identical images={same_image}")
+            # Separate photos are sent as two images or stitched into one, per the layout comparison
+            layout = None
+            if not (is_combined_image or same_image):
+                question_image, answer_image, layout = arrange_answer_images(
+                    question_image, answer_image, fields.get('image_layout')
+                )
+                if layout == LAYOUT_COMPOSITE:
+                    # The composite is a new image, stored below if needed
+                    uploaded = None
+            combined = bool(is_combined_image or same_image or layout == LAYOUT_COMPOSITE)
+            
+            # Hand the request to the background job workers if the client asked for a job id
+            if async_requested(request):
+                if uploaded:
+                    # Already streamed into the blob store
+                    (question_image_path, question_mime), (answer_image_path, answer_mime) = uploaded
+                else:
+                    question_image_path, question_mime = save_data_uri_image(question_image)
+                    answer_image_path, answer_mime = (None, None) if combined else save_data_uri_image(answer_image)
+                if combined:
+                    answer_image_path = answer_mime = None
+                
+                job = enqueue_job('analyze_answer', {
+                    'question_image_path': question_image_path,
+                    'question_mime': question_mime,
+                    'answer_image_path': answer_image_path,
+                    'answer_mime': answer_mime,
+                    'combined_image': combined,
+                    'layout': layout,
+                    'subject': subject
+                }, user_id=current_user.id)
+                return job_accepted_response(job)
+            
+            if combined:
+                current_app.logger.info(f"Using combined image mode: explicitly set={is_combined_image}, identical images={same_image}, layout={layout}")
                 
                 # Update the prompt to inform OpenAI that this is a combined image containing both question and answer
                 response = generate_answer_feedback(
                     question_image,  # Combined image with both question and answer (data URI)
                     answer_image,    # Pass the answer image for backwards compatibility
                     subject,
-                    combined_image=True
+                    combined_image=True,
+                    layout=layout
                 )
             else:
                 # Use regular two-image processing if they're different
@@ -1025,69 +1491,22 @@ def analyze_answer():
                 response = generate_answer_feedback(
                     question_image,  # Question image (data URI)
                     answer_image,    # Answer image (data URI)
-                    subject
+                    subject,
+                    layout=layout
                 )
             
             current_app.logger.info("Received answer analysis from OpenAI")
             
-            # Extract the different components from the response
-            feedback = process_math_notation(response.get('feedback', 'No feedback available'))
-            explanation = process_math_notation(response.get('explanation', 'No explanation available'))
-            tips = process_math_notation(response.get('tips', 'No tips available'))
-            score = response.get('score', '3/5 Marks')  # Default to 3/5 marks if not provided
-            
-            # Deduct 10 credits for successful AI answer analysis
-            if not current_user.use_credits(10):
-                # This should never happen as we checked credits earlier, but just in case
-                current_app.logger.error(f"Failed to deduct credits from user {current_user.id} - insufficient balance")
-                return jsonify({
-                    'success': False,
-                    'message': 'You need at least 10 credits to use this feature. Please purchase more credits.',
-                    'credits_required': True
-                }), 403
-                
-            db.session.commit()
-            current_app.logger.info(f"Deducted 10 credits from user {current_user.id}, new balance: {current_user.credits}")
-            
-            # Create the response
-            return jsonify({
-                'success': True,
-                'feedback': feedback,
-                'explanation': explanation,
-                'tips': tips,
-                'score': score,
-                'subject': subject,
-                'credits_remaining': current_user.credits,
-                'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-            })
+            # Format the feedback, deduct credits and create the response
+            response_data, status = complete_answer_analysis(current_user, subject, response)
+            return jsonify(response_data), status
             
         except Exception as ai_error:
             error_message = str(ai_error)
             current_app.logger.error(f"OpenAI API error: {error_message}")
-            
-            # Provide more robust and user-friendly error messages
-            if "pattern" in error_message.lower():
-                message = "Image format error: There was an issue with the captured images. Please try again with clearer pictures."
-            elif "api key" in error_message.lower() or "authentication" in error_message.lower():
-                message = "API configuration error. Please contact support."
-            elif "timeout" in error_message.lower():
-                message = "The AI service is taking longer than expected to respond. Please try again in a moment."
-            elif "rate limit" in error_message.lower() or "ratelimit" in error_message.lower():
-                message = "The AI service is experiencing high demand. Please try again in a few moments."
-            elif "quota" in error_message.lower() or "capacity" in error_message.lower() or "maximum" in error_message.lower():
-                message = "The AI service is temporarily unavailable. Our team has been notified and is working to restore service. Please try again later."
-            elif "model" in error_message.lower() and "overloaded" in error_message.lower():
-                message = "The AI service is currently at capacity. Please try again in a few minutes."
-            elif "invalid" in error_message.lower() and "format" in error_message.lower():
-                message = "There was an issue processing the image format. Please try a different image or capture method."
-            else:
-                # Log the full error for diagnostic purposes but show a simplified message to the user
-                current_app.logger.error(f"Unhandled OpenAI error: {error_message}")
-                message = "The AI service is temporarily unavailable. Our team has been notified and is working to restore service. Please try again later."
-                
             return jsonify({
                 'success': False,
-                'message': message
+                'message': friendly_ai_error_message(error_message, multiple_images=True)
             }), 500
             
     except Exception as e:
@@ -1097,6 +1516,70 @@ def analyze_answer():
             'message': f'Error analyzing answer: {str(e)}'
         }), 500
 
+@user_bp.route('/api/analyze-answer/stream', methods=['POST'])
+@login_required
+def api_stream_answer_analysis():
+    """Streaming variant of /api/analyze-answer; sends the feedback as server-sent events"""
+    record_implicit_ai_consent(current_user)
+    
+    # Credit verification - require 10 credits per analysis
+    if not current_user.has_sufficient_credits(10):
+        return jsonify({
+            'success': False,
+            'message': 'You need at least 10 credits to use this feature. Please purchase more credits.',
+            'credits_required': True
+        }), 403
+    
+    data = request_fields()
+    if not data and not is_multipart_upload():
+        return jsonify({
+            'success': False,
+            'message': 'Invalid request format: No JSON data'
+        }), 400
+    
+    try:
+        question_image, answer_image, _ = answer_request_images(data)
+    except ValueError as upload_error:
+        return jsonify({
+            'success': False,
+            'message': str(upload_error)
+        }), 400
+    subject = data.get('subject', 'Mathematics')
+    
+    if not question_image or not answer_image:
+        return jsonify({
+            'success': False,
+            'message': 'Both question and answer images are required'
+        }), 400
+    if not isinstance(question_image, (str, bytes)) or not isinstance(answer_image, (str, bytes)):
+        return jsonify({
+            'success': False,
+            'message': 'Image data must be strings'
+        }), 400
+    
+    rejection = quality_rejection(question_image, answer_image)
+    if rejection:
+        return quality_rejection_response(rejection)
+    question_image, answer_image, _ = rectify_answer_images(question_image, answer_image, None)
+    
+    combined_image = bool(field_flag(data, 'combined_image') or question_image == answer_image)
+    layout = None
+    if not combined_image:
+        question_image, answer_image, layout = arrange_answer_images(
+            question_image, answer_image, data.get('image_layout')
+        )
+        combined_image = layout == LAYOUT_COMPOSITE
+    current_app.logger.info(f"Streaming answer analysis for user {current_user.id}, subject: {subject}, combined: {combined_image}")
+    
+    user_id = current_user.id
+    
+    def complete(response_text):
+        # Runs after the view has returned, so load the user into the current session
+        return complete_answer_analysis(User.query.get(user_id), subject, parse_answer_feedback(response_text))
+    
+    deltas = stream_answer_feedback(question_image, answer_image, subject, combined_image=combined_image, layout=layout)
+    return stream_ai_response(deltas, complete, multiple_images=True)
+
 @user_bp.route('/api/explain/<int:question_id>', methods=['GET', 'POST'])
 @login_required
 def api_get_explanation(question_id):
@@ -1154,29 +1637,8 @@ def api_get_explanation(question_id):
         
         # If requesting a new explanation via POST, always generate new one regardless of cache
         if request.method == 'POST':
-            # Get user profile for logging but don't block based on consent
-            user_profile = UserProfile.query.filter_by(user_id=current_user.id).first()
-            
-            # Log status for debugging
-            if user_profile:
-                current_app.logger.info(f"User {current_user.id} consent status: ai_usage_consent_required={user_profile.ai_usage_consent_required}, last_ai_consent_date={user_profile.last_ai_consent_date}")
-                # Update consent date if needed but don't block access
-                if user_profile.ai_usage_consent_required:
-                    user_profile.ai_usage_consent_required = False
-                    user_profile.last_ai_consent_date = datetime.utcnow()
-                    db.session.commit()
-                    current_app.logger.info(f"Updated consent for user {current_user.id}")
-            else:
-                current_app.logger.warning(f"User {current_user.id} does not have a UserProfile record")
-                # Create a profile with consent if missing
-                new_profile = UserProfile(
-                    user_id=current_user.id,
-                    ai_usage_consent_required=False,
-                    last_ai_consent_date=datetime.utcnow()
-                )
-                db.session.add(new_profile)
-                db.session.commit()
-                current_app.logger.info(f"Created profile with consent for user {current_user.id}")
+            # Record consent for AI usage but don't block access
+            record_implicit_ai_consent(current_user)
             
             # Credit verification - require 10 credits for new explanations
             if not current_user.has_sufficient_credits(10):
@@ -1187,78 +1649,27 @@ def api_get_explanation(question_id):
                     'credits_required': True
                 }), 403
             try:
-                # Get paths to try
-                image_path = question.image_path
-                current_app.logger.info(f"Looking for image at path: {image_path}")
-                
-                # Create a list of possible paths to try
-                paths_to_try = [
-                    image_path,  # Original path from database
-                    image_path.replace('/home/runner/workspace/', './'),  # Relative path
-                    f"./data/{os.path.basename(os.path.dirname(image_path))}/{os.path.basename(image_path)}",  # Local data folder
-                ]
-                
-                # Add fallback to default images when image is missing
-                question_number = question.question_number.replace('q', '')
-                try:
-                    q_num = int(question_number)
-                    if 1 <= q_num <= 4:  # Only use sample images for questions 1-4
-                        paths_to_try.append(f"./data/questions/paper_1/question_q{q_num}_703866-q{q_num}.png")
-                except:
-                    pass  # Skip if question number isn't numeric
-                
-                # Try each path
-                image_found = False
-                for path in paths_to_try:
-                    current_app.logger.info(f"Trying path: {path}")
-                    if os.path.isfile(path):
-                        current_app.logger.info(f"Found image at: {path}")
-                        image_path = path
-                        image_found = True
-                        break
-                
-                # Check for sample images if no image was found
-                if not image_found:
-                    current_app.logger.warning(f"Image not found in any expected location. Looking for sample images.")
-                    
-                    # Determine which sample question file to use based on the question number
-                    question_sample = "./data/questions/paper_1/question_q1_703866-q1.png"  # Default fallback
-                    
-                    # Try to use a sample image that matches the current question number
-                    try:
-                        q_num = int(question_number)
-                        if 1 <= q_num <= 4:
-                            question_sample = f"./data/questions/paper_1/question_q{q_num}_703866-q{q_num}.png"
-                            current_app.logger.info(f"Using numbered sample image for q{q_num}")
-                    except:
-                        current_app.logger.warning(f"Could not determine question number, using default sample")
-                    
-                    sample_paths = [
-                        question_sample,
-                        "./data/papers/sample_math_paper.png"
-                    ]
-                    
-                    for path in sample_paths:
-                        if os.path.isfile(path):
-                            current_app.logger.warning(f"Using sample image instead: {path}")
-                            image_path = path
-                            image_found = True
-                            break
-                
-                if not image_found:
+                image_path = find_question_image_path(question)
+                if not image_path:
                     current_app.logger.error(f"No usable image found for question {question_id}")
                     return jsonify({
                         'success': False,
                         'message': 'Question image not found. Please contact support.'
                     }), 404
                 
-                # Read the image and encode it to base64 with data URI format
+                # Hand the request to the background job workers if the client asked for a job id
+                if async_requested(request):
+                    job = enqueue_job('explain_question', {
+                        'question_id': question_id,
+                        'image_path': image_path,
+                        'subject': paper.subject,
+                        'force_refresh': True
+                    }, user_id=current_user.id)
+                    return job_accepted_response(job)
+                
+                # Load the image's cached model-ready payload
                 try:
-                    with open(image_path, "rb") as image_file:
-                        image_bytes = image_file.read()
-                        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                        # Create a data URI with proper mime type
-                        data_uri = f"data:image/png;base64,{image_base64}"
+                    data_uri = load_vision_image(image_path)
                 except Exception as e:
                     current_app.logger.error(f"Error reading image file {image_path}: {str(e)}")
                     return jsonify({
@@ -1266,58 +1677,22 @@ def api_get_explanation(question_id):
                         'message': 'Error reading question image. Please try again or contact support.'
                     }), 500
                 
-                # Generate explanation using OpenAI with data URI format
+                # Generate explanation using OpenAI with data URI format (POST always regenerates)
                 current_app.logger.info(f"Generating explanation for question {question_id}, subject: {paper.subject}")
-                explanation_text = generate_explanation(
+                explanation_text, _ = get_or_generate_explanation(
                     data_uri,
-                    paper.subject
+                    paper.subject,
+                    force_refresh=True
                 )
                 
                 # The explanation from OpenAI is already in text format, no JSON parsing needed
                 current_app.logger.info("Using explanation text directly without JSON parsing")
                 
-                # Process the mathematical notation
-                processed_text = process_math_notation(explanation_text)
-                
-                # Save the original explanation
-                explanation = Explanation(
-                    question_id=question_id,
-                    explanation_text=explanation_text
-                )
-                
-                # Create a user query record for tracking
-                user_query = UserQuery(
-                    user_id=current_user.id,
-                    query_type='explanation',
-                    question_id=question_id,
-                    response_text=explanation_text,
-                    credits_used=10,
-                    subject=paper.subject
+                # Save the explanation and user query, and deduct credits
+                response_data, status = complete_question_explanation(
+                    current_user, question_id, paper.subject, explanation_text
                 )
-                
-                # Deduct 10 credits for successful AI explanation
-                if not current_user.use_credits(10):
-                    # This should never happen as we checked credits earlier, but just in case
-                    current_app.logger.error(f"Failed to deduct credits from user {current_user.id} - insufficient balance")
-                    return jsonify({
-                        'success': False,
-                        'message': 'You need at least 10 credits to use this feature. Please purchase more credits.',
-                        'credits_required': True
-                    }), 403
-                
-                # Add explanation and save both explanation and credit transaction
-                db.session.add(explanation)
-                db.session.add(user_query)
-                db.session.commit()
-                current_app.logger.info(f"Deducted 10 credits from user {current_user.id}, new balance: {current_user.credits}")
-                
-                return jsonify({
-                    'success': True,
-                    'question_id': question_id,
-                    'explanation': processed_text,
-                    'credits_remaining': current_user.credits,
-                    'is_new': True
-                })
+                return jsonify(response_data), status
                 
             except Exception as e:
                 current_app.logger.error(f"Error generating explanation: {str(e)}")
@@ -1441,56 +1816,30 @@ def api_get_explanation(question_id):
                 current_app.logger.info(f"Auto-generating explanation for question {question_id}")
                 
                 # Get the image file for the explanation
-                image_path = question.image_path
-                current_app.logger.info(f"Looking for image at path: {image_path}")
-                
-                # Create a list of possible paths to try
-                paths_to_try = [
-                    image_path,  # Original path from database
-                    image_path.replace('/home/runner/workspace/', './'),  # Relative path
-                    f"./data/{os.path.basename(os.path.dirname(image_path))}/{os.path.basename(image_path)}",  # Local data folder
-                ]
-                
-                # Try each path
-                image_found = False
-                for path in paths_to_try:
-                    current_app.logger.info(f"Trying path: {path}")
-                    if os.path.isfile(path):
-                        current_app.logger.info(f"Found image at: {path}")
-                        image_path = path
-                        image_found = True
-                        break
-                
-                if not image_found:
+                image_path = question_images.resolve(question)
+                if not image_path:
                     raise FileNotFoundError(f"Could not find image file for question {question_id}")
                 
-                # Read the image and encode it to base64 with data URI format
+                # Load the image's cached model-ready payload
                 try:
-                    with open(image_path, "rb") as image_file:
-                        image_bytes = image_file.read()
-                        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                        data_uri = f"data:image/png;base64,{image_base64}"
-                        current_app.logger.info(f"Image encoded successfully, size: {len(image_bytes)} bytes, base64 length: {len(image_base64)}")
+                    data_uri = load_vision_image(image_path)
                 except Exception as img_error:
                     current_app.logger.error(f"Error encoding image: {str(img_error)}")
                     raise img_error
                 
-                # Generate explanation using OpenAI with data URI format
+                # Generate explanation using OpenAI with data URI format, reusing any cached
+                # explanation for an identical image (e.g. the same page in another paper)
                 current_app.logger.info(f"Generating explanation for question {question_id}, subject: {paper.subject}")
-                explanation_text = generate_explanation(
+                explanation_text, from_cache = get_or_generate_explanation(
                     data_uri,
                     paper.subject
                 )
+                if from_cache:
+                    current_app.logger.info(f"Served explanation for question {question_id} from the explanation cache")
                 
                 # Process the mathematical notation
                 processed_text = process_math_notation(explanation_text)
                 
-                # Save the explanation in the database
-                explanation = Explanation(
-                    question_id=question_id,
-                    explanation_text=explanation_text
-                )
-                
                 # Create a user query record
                 user_query = UserQuery(
                     user_id=current_user.id,
@@ -1505,8 +1854,9 @@ def api_get_explanation(question_id):
                 if not current_user.use_credits(10):
                     raise ValueError("Insufficient credits")
                 
-                # Save the records
-                db.session.add(explanation)
+                # Save the records; the explanation only unless a concurrent request
+                # sharing the same generation has already stored it
+                save_question_explanation(db.session, question_id, explanation_text)
                 db.session.add(user_query)
                 db.session.commit()
                 
@@ -1644,6 +1994,77 @@ def api_get_explanation(question_id):
         'generated_at': existing_explanation.generated_at.strftime('%Y-%m-%d %H:%M:%S')
     })
 
+@user_bp.route('/api/explain/<int:question_id>/stream', methods=['GET', 'POST'])
+@login_required
+def api_stream_explanation(question_id):
+    """Streaming variant of POST /api/explain/<question_id>; generates a new explanation as server-sent events"""
+    question = Question.query.get(question_id)
+    if not question:
+        return jsonify({
+            'success': False,
+            'message': f'Question with ID {question_id} not found'
+        }), 404
+    
+    paper = QuestionPaper.query.get(question.paper_id)
+    if not paper:
+        return jsonify({
+            'success': False,
+            'message': 'The paper associated with this question could not be found'
+        }), 404
+    
+    record_implicit_ai_consent(current_user)
+    
+    # Credit verification - require 10 credits for new explanations
+    if not current_user.has_sufficient_credits(10):
+        return jsonify({
+            'success': False,
+            'message': 'You need at least 10 credits to generate a new explanation. Please purchase more credits.',
+            'credits_required': True
+        }), 403
+    
+    image_path = find_question_image_path(question)
+    if not image_path:
+        current_app.logger.error(f"No usable image found for question {question_id}")
+        return jsonify({
+            'success': False,
+            'message': 'Question image not found. Please contact support.'
+        }), 404
+    
+    try:
+        data_uri = load_vision_image(image_path)
+    except Exception as e:
+        current_app.logger.error(f"Error reading image file {image_path}: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Error reading question image. Please try again or contact support.'
+        }), 500
+    
+    subject = paper.subject
+    current_app.logger.info(f"Streaming explanation for question {question_id}, subject: {subject}")
+    
+    user_id = current_user.id
+    requested_at = datetime.utcnow()
+    _, cache_key = explanation_cache_key(data_uri, subject)
+    
+    def store(explanation_text):
+        check_explanation_text(explanation_text)
+        store_explanation(data_uri, subject, explanation_text)
+    
+    def complete(explanation_text):
+        check_explanation_text(explanation_text)
+        # Runs after the view has returned, so load the user into the current session
+        return complete_question_explanation(User.query.get(user_id), question_id, subject, explanation_text)
+    
+    # Students opening the same question at once share a single generation:
+    # the first request streams from OpenAI, the others receive its finished text
+    deltas = explanation_flights.stream(
+        cache_key,
+        lambda: stream_explanation(data_uri, subject),
+        check=lambda: explanation_cache.get(cache_key, newer_than=requested_at),
+        store=store
+    )
+    return stream_ai_response(deltas, complete)
+
 @user_bp.route('/favorite-query/<int:query_id>')
 @login_required
 def favorite_query(query_id):
@@ -1715,6 +2136,10 @@ def api_get_question_data(question_id):
             'success': True
         }
         
+        # URL that can be cached indefinitely; it changes when the image is replaced
+        question_data['cacheable_image_url'] = question_images.url_for(question)
+        question_data['image_srcset'] = question_images.srcset(question)
+        
         # Always include an image_url - either from database or direct access endpoint
         if question.image_url:
             question_data['image_url'] = question.image_url
@@ -1724,13 +2149,12 @@ def api_get_question_data(question_id):
             question_data['image_url'] = url_for('user.get_question_image', question_id=question.id, _external=True)
             current_app.logger.info(f"Generated image URL: {question_data['image_url']}")
         
-        # Create the response with appropriate headers to avoid caching issues
+        # Revalidate on every use, but let unchanged data come back as 304 Not Modified
         response = jsonify(question_data)
         response.headers.add('Access-Control-Allow-Origin', '*')  # Allow cross-origin requests
-        response.headers.add('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
-        response.headers.add('Pragma', 'no-cache')
-        response.headers.add('Expires', '0')
-        return response
+        response.cache_control.no_cache = True
+        response.add_etag()
+        return response.make_conditional(request)
         
     except Exception as e:
         current_app.logger.error(f"Error getting question data: {str(e)}")
@@ -1773,32 +2197,20 @@ def api_delete_question(question_id):
             # Delete all question topics associations
             QuestionTopic.query.filter_by(question_id=question_id).delete()
             
-            # Delete the image file if it exists
-            if question.image_path:
-                # Try different path formats
-                paths_to_try = [
-                    question.image_path,
-                    question.image_path.replace('/home/runner/workspace/', './'),
-                    f"./data/{os.path.basename(os.path.dirname(question.image_path))}/{os.path.basename(question.image_path)}"
-                ]
-                
-                deletion_success = False
-                for path in paths_to_try:
-                    if os.path.exists(path):
-                        try:
-                            os.remove(path)
-                            current_app.logger.info(f"Deleted question image: {path}")
-                            deletion_success = True
-                            break
-                        except Exception as file_error:
-                            current_app.logger.warning(f"Error deleting file at {path}: {str(file_error)}")
-                
-                if not deletion_success:
-                    current_app.logger.warning(f"Could not delete image file for question {question_id} - file not found in any expected location")
+            # Delete the perceptual hashes used to match photos to this question
+            QuestionImageHash.query.filter_by(question_id=question_id).delete()
+            
+            # Delete any missing-image record
+            MissingAsset.query.filter_by(question_id=question_id).delete()
+            
+            # Release the image (a shared blob is kept while other rows use it)
+            image_path = question_images.resolve(question) or question.image_path
             
             # Finally, delete the question
             db.session.delete(question)
             db.session.commit()
+            discard(image_path)
+            question_images.forget(question_id)
             
             current_app.logger.info(f"Question {question_id} successfully deleted by admin {current_user.id}")
             
@@ -1846,13 +2258,8 @@ def feedback():
             
             # Handle screenshot upload if provided
             if form.screenshot.data:
-                # Generate a unique filename
-                filename = f"feedback_{uuid.uuid4()}.png"
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                
-                # Save the file
-                form.screenshot.data.save(filepath)
-                new_feedback.screenshot_path = filepath
+                # Store the file in the blob store, referenced by this feedback entry
+                new_feedback.screenshot_path = store_bytes(form.screenshot.data.read())
             
             # Save to database
             db.session.add(new_feedback)
@@ -1982,7 +2389,7 @@ def feedback_screenshot(feedback_id):
         if not feedback.screenshot_path or not os.path.exists(feedback.screenshot_path):
             return "Screenshot not found", 404
             
-        return send_file(feedback.screenshot_path, mimetype='image/png')
+        return send_asset(feedback.screenshot_path, mimetype='image/png', conditional=True)
     except Exception as e:
         current_app.logger.error(f"Error serving feedback screenshot: {str(e)}")
         return "Error loading screenshot", 500
@@ -0,0 +1,313 @@
+"""
+Background job engine for slow AI requests.
+
+Request handlers validate input, store any images on disk and call enqueue_job()
+instead of calling OpenAI inline. Jobs are persisted in the AIJob table, so any
+gunicorn worker can report their status and any worker's job pool can pick them
+up. Each process runs one background thread with an asyncio event loop; jobs are
+executed as tasks using the AsyncOpenAI client, bounded by AI_JOB_CONCURRENCY,
+so throughput is limited by OpenAI concurrency rather than by the number of
+request workers.
+
+A job type is registered with two functions:
+- an async runner that takes the payload and performs the AI call, and
+- a synchronous finalizer that runs inside an app context with the runner's
+  output, persists records, deducts credits and returns (response dict, status).
+"""
+import os
+import json
+import uuid
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app import db
+from models import AIJob
+from utils.openai_telemetry import telemetry_endpoint
+
+logger = logging.getLogger(__name__)
+
+# Number of AI jobs a single process runs at the same time
+AI_JOB_CONCURRENCY = int(os.environ.get('AI_JOB_CONCURRENCY', 8))
+# Fallback polling interval for jobs enqueued by other processes
+AI_JOB_POLL_INTERVAL = float(os.environ.get('AI_JOB_POLL_INTERVAL', 1.0))
+# Jobs stuck in 'running' longer than this are assumed lost (e.g. worker restart)
+AI_JOB_STALE_AFTER = timedelta(seconds=int(os.environ.get('AI_JOB_STALE_AFTER', 600)))
+AI_JOB_MAX_ATTEMPTS = int(os.environ.get('AI_JOB_MAX_ATTEMPTS', 2))
+# How often each worker looks for stale jobs, so a dead worker's jobs are picked up by the live ones
+AI_JOB_RECOVERY_INTERVAL = AI_JOB_STALE_AFTER.total_seconds() / 2
+
+# Registered job types: job_type -> (async runner, finalizer)
+_job_types = {}
+
+
+def register_job_type(job_type, runner, finalizer):
+    """
+    Register the functions used to execute a job type
+
+    Args:
+        job_type: Name stored in AIJob.job_type
+        runner: async function(payload) -> output, performs the AI call
+        finalizer: function(job, output) -> (response dict, http status), runs in an app context
+    """
+    _job_types[job_type] = (runner, finalizer)
+
+
+def enqueue_job(job_type, payload, user_id=None):
+    """
+    Persist a new job and wake this process's worker pool
+
+    Args:
+        job_type: A registered job type
+        payload: JSON-serializable job arguments (store image paths, not image data)
+        user_id: Owner of the job, used for authorization and billing
+
+    Returns:
+        AIJob: The queued job
+    """
+    from flask import current_app
+
+    if job_type not in _job_types:
+        raise ValueError(f"Unknown AI job type: {job_type}")
+
+    job = AIJob(
+        id=uuid.uuid4().hex,
+        user_id=user_id,
+        job_type=job_type,
+        status='queued',
+        payload=json.dumps(payload)
+    )
+    db.session.add(job)
+    db.session.commit()
+    logger.info(f"Enqueued AI job {job.id} ({job_type}) for user {user_id}")
+
+    worker = get_worker(current_app._get_current_object())
+    worker.notify()
+    return job
+
+
+def get_job(job_id):
+    """Return the AIJob with the given id, or None"""
+    return AIJob.query.get(job_id)
+
+
+def async_requested(request):
+    """
+    Check whether the client asked for a job id instead of a blocking response.
+    Clients opt in with ?async=1, "async": true in the JSON body, or a
+    "Prefer: respond-async" header.
+    """
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    if 'respond-async' in request.headers.get('Prefer', ''):
+        return True
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and data.get('async') is True:
+            return True
+    return False
+
+
+def job_accepted_response(job):
+    """Build the 202 response returned when a job has been enqueued"""
+    from flask import jsonify, url_for
+
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('user.api_job_status', job_id=job.id)
+    }), 202
+
+
+class AIJobWorker:
+    """Background asyncio worker pool that claims and runs queued AI jobs"""
+
+    def __init__(self, app, concurrency=AI_JOB_CONCURRENCY):
+        self.app = app
+        self.concurrency = concurrency
+        self._loop = None
+        self._wakeup = None
+        self._thread = None
+        self._started = threading.Event()
+        self._running_jobs = set()
+
+    def start(self):
+        """Start the worker thread if it is not already running"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run_loop, name='ai-job-worker', daemon=True)
+        self._thread.start()
+        self._started.wait(timeout=5)
+        logger.info(f"AI job worker started with concurrency {self.concurrency}")
+
+    def notify(self):
+        """Wake the worker so a newly enqueued job starts without waiting for the next poll"""
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    @property
+    def active_jobs(self):
+        return len(self._running_jobs)
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._wakeup = asyncio.Event()
+        self._started.set()
+        self._loop.run_until_complete(self._dispatch_forever())
+
+    async def _dispatch_forever(self):
+        next_recovery = 0
+        while True:
+            try:
+                if self._loop.time() >= next_recovery:
+                    next_recovery = self._loop.time() + AI_JOB_RECOVERY_INTERVAL
+                    await asyncio.to_thread(self._recover_stale_jobs)
+                free_slots = self.concurrency - len(self._running_jobs)
+                if free_slots > 0:
+                    job_ids = await asyncio.to_thread(self._claim_jobs, free_slots)
+                    for job_id in job_ids:
+                        task = asyncio.create_task(self._execute(job_id))
+                        self._running_jobs.add(task)
+                        task.add_done_callback(self._job_done)
+            except Exception as e:
+                logger.error(f"AI job dispatcher error: {str(e)}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=AI_JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _job_done(self, task):
+        self._running_jobs.discard(task)
+        # A slot has been freed - look for more work straight away
+        self._wakeup.set()
+
+    def _claim_jobs(self, limit):
+        """Atomically move up to `limit` queued jobs to 'running' and return their ids"""
+        with self.app.app_context():
+            candidates = [
+                job_id for (job_id,) in db.session.query(AIJob.id)
+                .filter(AIJob.status == 'queued')
+                .order_by(AIJob.created_at)
+                .limit(limit)
+                .all()
+            ]
+            claimed = []
+            for job_id in candidates:
+                # Conditional update so two processes never run the same job
+                result = db.session.execute(
+                    update(AIJob)
+                    .where(AIJob.id == job_id, AIJob.status == 'queued')
+                    .values(status='running', started_at=datetime.utcnow(), attempts=AIJob.attempts + 1)
+                )
+                if result.rowcount:
+                    claimed.append(job_id)
+            db.session.commit()
+            db.session.remove()
+            return claimed
+
+    def _recover_stale_jobs(self):
+        """Requeue (or fail) jobs left 'running' by a worker that died"""
+        with self.app.app_context():
+            cutoff = datetime.utcnow() - AI_JOB_STALE_AFTER
+            stale_jobs = AIJob.query.filter(AIJob.status == 'running', AIJob.started_at < cutoff).all()
+            for job in stale_jobs:
+                if job.attempts < AI_JOB_MAX_ATTEMPTS:
+                    logger.warning(f"Requeueing stale AI job {job.id}")
+                    job.status = 'queued'
+                else:
+                    logger.error(f"Giving up on stale AI job {job.id} after {job.attempts} attempts")
+                    job.status = 'failed'
+                    job.http_status = 500
+                    job.error = 'Job did not complete'
+                    job.result = json.dumps({
+                        'success': False,
+                        'message': 'The AI request could not be completed. Please try again.'
+                    })
+                    job.finished_at = datetime.utcnow()
+            db.session.commit()
+            db.session.remove()
+
+    async def _execute(self, job_id):
+        job_type, payload = await asyncio.to_thread(self._load_job, job_id)
+        if job_type not in _job_types:
+            await asyncio.to_thread(self._fail, job_id, f"Unknown AI job type: {job_type}", 500, None)
+            return
+
+        runner, finalizer = _job_types[job_type]
+        started = datetime.utcnow()
+        try:
+            # The app context is task-local and is inherited by asyncio.to_thread calls in the runner
+            with self.app.app_context(), telemetry_endpoint(f"job:{job_type}"):
+                output = await runner(payload)
+        except Exception as e:
+            logger.error(f"AI job {job_id} ({job_type}) failed: {str(e)}")
+            await asyncio.to_thread(self._fail, job_id, str(e), 500, e)
+            return
+
+        await asyncio.to_thread(self._finalize, job_id, finalizer, output)
+        logger.info(f"AI job {job_id} ({job_type}) finished in {(datetime.utcnow() - started).total_seconds():.1f}s")
+
+    def _load_job(self, job_id):
+        with self.app.app_context():
+            job = AIJob.query.get(job_id)
+            job_type, payload = job.job_type, job.get_payload()
+            db.session.remove()
+            return job_type, payload
+
+    def _finalize(self, job_id, finalizer, output):
+        with self.app.app_context():
+            job = AIJob.query.get(job_id)
+            try:
+                response_data, http_status = finalizer(job, output)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error finalizing AI job {job_id}: {str(e)}")
+                self._fail(job_id, str(e), 500, e)
+                return
+
+            job = AIJob.query.get(job_id)
+            job.status = 'succeeded' if http_status < 400 else 'failed'
+            job.http_status = http_status
+            job.result = json.dumps(response_data)
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            db.session.remove()
+
+    def _fail(self, job_id, error_message, http_status, exception):
+        with self.app.app_context():
+            job = AIJob.query.get(job_id)
+            finalizer = _job_types.get(job.job_type, (None, None))[1]
+            response_data = {'success': False, 'message': error_message}
+            # Finalizers may expose a friendlier error formatter for their endpoint
+            error_formatter = getattr(finalizer, 'format_error', None)
+            if error_formatter and exception is not None:
+                response_data, http_status = error_formatter(exception)
+
+            job.status = 'failed'
+            job.error = error_message
+            job.http_status = http_status
+            job.result = json.dumps(response_data)
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            db.session.remove()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker(app):
+    """Return this process's worker pool, starting it on first use (after gunicorn has forked)"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = AIJobWorker(app)
+        _worker.start()
+        return _worker
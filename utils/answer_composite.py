@@ -0,0 +1,135 @@
+"""
+Composite single-image layout for answer feedback.
+
+Answer feedback normally sends the question and the student's answer as two
+images. The vision model fits and tiles each one separately, so the request
+pays for two sets of 512px tiles and two base image costs. It is the most
+expensive call the app makes. compose_answer_image stitches both into one
+image instead:
+
+- each part is trimmed to its writing,
+- both are brought to a common width, so printed and handwritten text end up
+  at a similar scale (only a part narrower than the model's 768px short side
+  is enlarged),
+- they are stacked question above answer, as the combined-image prompt
+  expects, with a divider line between them,
+- the result is sized to what the model will use and snapped to the tile
+  grid.
+
+answer_image_layout decides which layout a request uses. Its inputs are the
+request's 'image_layout' field, and otherwise ANSWER_COMPOSITE_MODE:
+'separate' or 'composite' for everyone, or 'ab' to split users by
+ANSWER_COMPOSITE_AB_PERCENT. The layout is recorded in the call's prompt
+version, so the admin usage page can compare the tokens and latency of the
+two arms.
+"""
+import io
+import os
+import hashlib
+import logging
+
+import numpy as np
+from PIL import Image, ImageOps, ImageDraw
+
+from utils.image_preparation import (
+    decode_image_data, flatten_image, vision_target_size, snap_to_tile_grid, tile_count,
+    MAX_SHORT_SIDE, VISION_IMAGE_QUALITY
+)
+from utils.page_rectification import content_box
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_SEPARATE = 'separate'
+LAYOUT_COMPOSITE = 'composite'
+ANSWER_IMAGE_LAYOUTS = (LAYOUT_SEPARATE, LAYOUT_COMPOSITE)
+
+# 'separate', 'composite', or 'ab' to assign users to one of the two
+ANSWER_COMPOSITE_MODE = os.environ.get('ANSWER_COMPOSITE_MODE', 'ab').lower()
+# Share of users given the composite layout in 'ab' mode
+ANSWER_COMPOSITE_AB_PERCENT = int(os.environ.get('ANSWER_COMPOSITE_AB_PERCENT', 50))
+
+# White space between the question and the answer, with a divider line across its middle
+COMPOSITE_GAP = 32
+DIVIDER_COLOR = (128, 128, 128)
+
+
+def answer_image_layout(requested, user_id):
+    """
+    Layout of the question and answer images for one request
+
+    Args:
+        requested: The request's 'image_layout' field, if any
+        user_id: The requesting user; in 'ab' mode a user always gets the same layout
+
+    Returns:
+        str: LAYOUT_SEPARATE or LAYOUT_COMPOSITE
+    """
+    if requested in ANSWER_IMAGE_LAYOUTS:
+        return requested
+    if ANSWER_COMPOSITE_MODE in ANSWER_IMAGE_LAYOUTS:
+        return ANSWER_COMPOSITE_MODE
+    bucket = int(hashlib.sha256(f"answer-layout:{user_id}".encode()).hexdigest(), 16) % 100
+    return LAYOUT_COMPOSITE if bucket < ANSWER_COMPOSITE_AB_PERCENT else LAYOUT_SEPARATE
+
+
+def vision_tiles(width, height):
+    """Tiles the vision model bills for an image of this size, after its own resizing"""
+    return tile_count(*snap_to_tile_grid(*vision_target_size(width, height)))
+
+
+def _load_part(image_data):
+    """Decode one image upright on white and trim it to its writing"""
+    image_bytes, _ = decode_image_data(image_data)
+    with Image.open(io.BytesIO(image_bytes)) as original:
+        img = flatten_image(ImageOps.exif_transpose(original)).convert('RGB')
+    box = content_box(np.asarray(img.convert('L')))
+    if box:
+        img = img.crop(box)
+    return img
+
+
+def compose_answer_image(question_image, answer_image):
+    """
+    Stitch the question and the student's answer into one image
+
+    Args:
+        question_image: Question image as bytes, a data URI or base64
+        answer_image: Answer image in the same forms
+
+    Returns:
+        bytes: JPEG of the question above the answer, sized for the vision model
+
+    Raises:
+        ValueError: If either image cannot be decoded
+    """
+    try:
+        parts = [_load_part(question_image), _load_part(answer_image)]
+    except Exception as e:
+        raise ValueError(f"Could not decode the images to compose: {str(e)}")
+
+    separate_tiles = sum(vision_tiles(*part.size) for part in parts)
+    widths = [part.width for part in parts]
+    width = min(max(widths), max(min(widths), MAX_SHORT_SIDE))
+    parts = [
+        part if part.width == width else
+        part.resize((width, max(1, round(part.height * width / part.width))), Image.LANCZOS)
+        for part in parts
+    ]
+
+    canvas = Image.new('RGB', (width, parts[0].height + COMPOSITE_GAP + parts[1].height), (255, 255, 255))
+    canvas.paste(parts[0], (0, 0))
+    canvas.paste(parts[1], (0, parts[0].height + COMPOSITE_GAP))
+    divider = parts[0].height + COMPOSITE_GAP // 2
+    ImageDraw.Draw(canvas).line([(0, divider), (width, divider)], fill=DIVIDER_COLOR, width=2)
+
+    target = snap_to_tile_grid(*vision_target_size(*canvas.size))
+    if target != canvas.size:
+        canvas = canvas.resize(target, Image.LANCZOS)
+    out = io.BytesIO()
+    canvas.save(out, 'JPEG', quality=VISION_IMAGE_QUALITY, optimize=True)
+
+    logger.info(
+        f"Composed answer image {target[0]}x{target[1]}: {tile_count(*target)} tiles "
+        f"instead of {separate_tiles} for the separate images"
+    )
+    return out.getvalue()
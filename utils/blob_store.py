@@ -0,0 +1,298 @@
+"""
+Content-addressed store for uploaded and generated images.
+
+Images used to be written under ad-hoc names in data/paper_N,
+data/questions/paper_N, data/captured_images, data/student_answers and
+uploads, often several times over (a re-uploaded question, a debug copy, the
+same photo snapped twice). The blob store keeps each distinct file once, named
+by the SHA-256 of its bytes and sharded by the first two bytes of the digest:
+
+    data/blobs/3f/a2/3fa2...e9.png
+
+so no directory holds more than a few hundred files. The digest in the name
+also serves as the image's cache key (ETags, derivatives) without re-hashing.
+
+A Blob row per file counts the database rows that point at it. The columns
+that may hold blob paths are listed in BLOB_REFERENCES. Code that sets one of
+them calls add_reference; code that clears or deletes one calls discard.
+Files nothing refers to (including images only kept for a background job) are
+removed by collect_garbage once they have been unreferenced for a grace
+period. It runs in the background every BLOB_GC_INTERVAL_SECONDS (see
+utils/temp_sweeper.py), and on demand with migrate_to_blob_store.py --gc. Counts are adjusted on their own
+connection, so a rolled-back request can leave one too high; --recount
+rebuilds them from BLOB_REFERENCES.
+"""
+import io
+import os
+import re
+import uuid
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+from PIL import Image
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import Blob, Question, UserQuery, StudentAnswer, UserFeedback
+
+logger = logging.getLogger(__name__)
+
+BLOB_STORE_FOLDER = os.path.abspath(os.environ.get(
+    'BLOB_STORE_FOLDER', os.path.join(os.getcwd(), 'data', 'blobs')
+))
+# Unreferenced blobs younger than this are kept, so a just-stored image survives until its row is committed
+BLOB_GC_GRACE_SECONDS = float(os.environ.get('BLOB_GC_GRACE_SECONDS', 7 * 24 * 3600))
+# How often each process runs collect_garbage in the background; 0 disables it
+BLOB_GC_INTERVAL_SECONDS = float(os.environ.get('BLOB_GC_INTERVAL_SECONDS', 6 * 3600))
+
+# Every column that may hold a blob path
+BLOB_REFERENCES = (
+    (Question, 'image_path'),
+    (UserQuery, 'image_path'),
+    (StudentAnswer, 'answer_image_path'),
+    (UserFeedback, 'screenshot_path'),
+)
+
+# Pillow format -> file extension; anything else is stored as .bin
+IMAGE_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'GIF': 'gif', 'WEBP': 'webp', 'BMP': 'bmp', 'AVIF': 'avif'}
+
+_BLOB_NAME = re.compile(r'^([0-9a-f]{64})\.([a-z0-9]+)$')
+
+
+def blob_path(digest, extension):
+    """Path of the blob with the given SHA-256 hex digest"""
+    return os.path.join(BLOB_STORE_FOLDER, digest[:2], digest[2:4], f"{digest}.{extension}")
+
+
+def blob_digest(path):
+    """
+    SHA-256 of a blob, read from its path
+
+    Returns:
+        str: Hex digest, or None if the path is not in the blob store
+    """
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    if os.path.dirname(os.path.dirname(os.path.dirname(path))) != BLOB_STORE_FOLDER:
+        return None
+    match = _BLOB_NAME.match(os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def is_blob_path(path):
+    return blob_digest(path) is not None
+
+
+def detect_extension(data):
+    """File extension for image bytes, from their content rather than the uploaded name"""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return IMAGE_EXTENSIONS.get(img.format, 'bin')
+    except Exception:
+        return 'bin'
+
+
+def store_bytes(data, referenced=True):
+    """
+    Store bytes in the blob store (a no-op on disk if they are already there)
+
+    Args:
+        data: File contents
+        referenced: Count a reference for the row the caller is about to save;
+            False for files only kept for a while (e.g. background job input)
+
+    Returns:
+        str: Absolute path of the blob
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    extension = detect_extension(data)
+    path = blob_path(digest, extension)
+    # Take the reference before checking the file, so a concurrent collect_garbage
+    # either has already removed both (and the file is written again) or neither
+    _touch(digest, extension, len(data), 1 if referenced else 0)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as blob_file:
+            blob_file.write(data)
+        os.replace(temp_path, path)
+    return path
+
+
+def store_stream(stream, referenced=True, chunk_size=1024 * 1024):
+    """
+    Store a file-like object (e.g. an uploaded file) without reading it all into memory
+
+    The stream is hashed while it is copied to a temporary file in the store, which
+    is then renamed into place, or dropped if the blob already exists.
+
+    Returns:
+        str: Absolute path of the blob
+    """
+    os.makedirs(BLOB_STORE_FOLDER, exist_ok=True)
+    temp_path = os.path.join(BLOB_STORE_FOLDER, f"upload.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                head = head or chunk
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+        digest = digest.hexdigest()
+        # The image header is in the first chunk
+        extension = detect_extension(head)
+        path = blob_path(digest, extension)
+        _touch(digest, extension, size, 1 if referenced else 0)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        return path
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def store_file(source_path, referenced=True):
+    """Store a copy of an existing file; returns the blob path"""
+    with open(source_path, 'rb') as source:
+        return store_stream(source, referenced=referenced)
+
+
+def add_reference(path):
+    """Count a new row pointing at a blob (no-op for files outside the store)"""
+    digest = blob_digest(path)
+    if digest:
+        _adjust(digest, 1)
+
+
+def discard(path):
+    """
+    A row no longer points at this file: release the blob, or delete a file outside the store
+
+    Files outside the store are only ever owned by the row that named them, so they
+    are removed immediately; blobs may be shared and are left to collect_garbage.
+    """
+    if not path:
+        return
+    digest = blob_digest(path)
+    if digest:
+        _adjust(digest, -1)
+    elif os.path.exists(path):
+        try:
+            os.remove(path)
+            logger.info(f"Deleted image file: {path}")
+        except OSError as e:
+            logger.warning(f"Could not delete image file {path}: {str(e)}")
+
+
+def _touch(digest, extension, size, references):
+    table = Blob.__table__
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        updated = conn.execute(
+            update(table).where(table.c.sha256 == digest)
+            .values(ref_count=table.c.ref_count + references, updated_at=now)
+        ).rowcount
+        if updated:
+            return
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(
+                sha256=digest, extension=extension, size=size, ref_count=references,
+                created_at=now, updated_at=now
+            ))
+    except IntegrityError:
+        # Stored concurrently by another request
+        _adjust(digest, references)
+
+
+def _adjust(digest, delta):
+    table = Blob.__table__
+    condition = table.c.sha256 == digest
+    if delta < 0:
+        # Never below zero, even if a count was lost
+        condition &= table.c.ref_count >= -delta
+    with db.engine.begin() as conn:
+        conn.execute(
+            update(table).where(condition)
+            .values(ref_count=table.c.ref_count + delta, updated_at=datetime.utcnow())
+        )
+
+
+def count_references():
+    """
+    Count the rows pointing at each blob, from the columns in BLOB_REFERENCES
+
+    Returns:
+        dict: digest -> number of references
+    """
+    counts = {}
+    with db.engine.connect() as conn:
+        for model, column_name in BLOB_REFERENCES:
+            column = model.__table__.c[column_name]
+            for (path,) in conn.execute(select(column).where(column.isnot(None))):
+                digest = blob_digest(path)
+                if digest:
+                    counts[digest] = counts.get(digest, 0) + 1
+    return counts
+
+
+def recount_references():
+    """
+    Rebuild every Blob.ref_count from the referencing columns
+
+    Returns:
+        int: Number of blobs whose count was wrong
+    """
+    counts = count_references()
+    table = Blob.__table__
+    corrected = 0
+    with db.engine.begin() as conn:
+        for digest, ref_count in conn.execute(select(table.c.sha256, table.c.ref_count)).all():
+            actual = counts.get(digest, 0)
+            if actual != ref_count:
+                conn.execute(update(table).where(table.c.sha256 == digest).values(ref_count=actual))
+                corrected += 1
+    return corrected
+
+
+def collect_garbage(grace_seconds=BLOB_GC_GRACE_SECONDS, dry_run=False):
+    """
+    Delete blobs that nothing has referred to for at least grace_seconds
+
+    Returns:
+        dict: Counts of 'deleted' blobs and 'bytes' freed
+    """
+    table = Blob.__table__
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    counts = {'deleted': 0, 'bytes': 0}
+    with db.engine.connect() as conn:
+        candidates = conn.execute(
+            select(table.c.sha256, table.c.extension, table.c.size)
+            .where(table.c.ref_count <= 0, table.c.updated_at < cutoff)
+        ).all()
+    for digest, extension, size in candidates:
+        if dry_run:
+            counts['deleted'] += 1
+            counts['bytes'] += size or 0
+            continue
+        with db.engine.begin() as conn:
+            # Re-check inside the transaction: the blob may have been stored again meanwhile
+            removed = conn.execute(
+                delete(table).where(table.c.sha256 == digest, table.c.ref_count <= 0, table.c.updated_at < cutoff)
+            ).rowcount
+            if not removed:
+                continue
+            try:
+                os.remove(blob_path(digest, extension))
+            except FileNotFoundError:
+                pass
+        counts['deleted'] += 1
+        counts['bytes'] += size or 0
+    return counts
@@ -0,0 +1,266 @@
+"""
+Resumable chunked uploads of question and answer photos.
+
+On flaky school Wi-Fi a photo sent in one request is lost entirely when the
+connection drops, and a retry sends it again from the start. Instead the
+client can:
+
+1. POST /api/uploads with the file's size and SHA-256; the server opens an
+   UploadSession and answers with its id and the chunk size.
+2. PUT /api/uploads/<id>/chunks/<n> for each fixed-size chunk in order, with
+   an optional X-Chunk-SHA256 header. Each chunk is written at its offset in
+   a part file, so a request only holds a worker for one small chunk.
+3. After a failure, GET /api/uploads/<id> to learn how many chunks arrived
+   and carry on from there. Re-sending a chunk already received is harmless.
+
+When the last chunk arrives the file is checked against the declared SHA-256
+and moved into the blob store (unreferenced, like other analysis inputs). The
+analyze endpoints then take `<field>_upload_id` instead of the image itself.
+Abandoned sessions are removed by expire_upload_sessions, which runs in the
+background every UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS (see
+utils/temp_sweeper.py) and with migrate_to_blob_store.py --gc.
+"""
+import os
+import re
+import uuid
+import hashlib
+import logging
+import time
+import mimetypes
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, select, delete
+
+from app import db
+from models import UploadSession
+from utils.blob_store import store_file
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_BYTES', 256 * 1024))
+UPLOAD_SESSION_FOLDER = os.environ.get(
+    'UPLOAD_SESSION_FOLDER', os.path.join(os.getcwd(), 'data', 'upload_sessions')
+)
+# Sessions not touched for this long are abandoned
+UPLOAD_SESSION_TTL_SECONDS = float(os.environ.get('UPLOAD_SESSION_TTL_SECONDS', 24 * 3600))
+# How often each process removes abandoned sessions in the background; 0 disables it
+UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS = float(os.environ.get('UPLOAD_SESSION_SWEEP_INTERVAL_SECONDS', 3600))
+
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(ValueError):
+    """A rejected upload request, with the HTTP status to answer it with"""
+
+    def __init__(self, message, http_status=400):
+        super().__init__(message)
+        self.http_status = http_status
+
+
+def part_path(upload_id):
+    return os.path.join(UPLOAD_SESSION_FOLDER, f"{upload_id}.part")
+
+
+def create_upload(user_id, size, sha256):
+    """
+    Open an upload session
+
+    Args:
+        user_id: Owner of the upload
+        size: Total size of the file in bytes
+        sha256: Hex SHA-256 of the whole file
+
+    Returns:
+        UploadSession: The new session
+
+    Raises:
+        UploadError: If the size or checksum is invalid or the file is too large
+    """
+    from utils.uploads import oversized_image_message
+
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise UploadError("The upload size must be a positive number of bytes")
+    sha256 = str(sha256 or '').lower()
+    if not _SHA256_RE.match(sha256):
+        raise UploadError("The upload checksum must be a hex SHA-256 digest")
+    too_large = oversized_image_message(size)
+    if too_large:
+        raise UploadError(too_large, 413)
+
+    session = UploadSession(
+        id=uuid.uuid4().hex,
+        user_id=user_id,
+        size=size,
+        sha256=sha256,
+        chunk_size=UPLOAD_CHUNK_BYTES,
+        received_chunks=0,
+        status='open'
+    )
+    db.session.add(session)
+    db.session.commit()
+    logger.info(f"Opened upload {session.id} of {size} bytes ({session.total_chunks} chunks) for user {user_id}")
+    return session
+
+
+def get_upload(upload_id, user_id):
+    """The user's upload session with the given id, or None"""
+    session = UploadSession.query.get(str(upload_id))
+    if session is None or session.user_id != user_id:
+        return None
+    return session
+
+
+def write_chunk(session, index, data, checksum=None):
+    """
+    Store one chunk; the last one completes the upload
+
+    Args:
+        session: The UploadSession
+        index: Zero-based chunk number; must be the next one expected (or one already received)
+        data: Chunk bytes
+        checksum: Optional hex SHA-256 of the chunk
+
+    Returns:
+        UploadSession: The session, refreshed
+
+    Raises:
+        UploadError: If the chunk is out of order, the wrong length, corrupted, or
+            the assembled file does not match the declared checksum
+    """
+    if session.status == 'complete' or index < session.received_chunks:
+        # A retry of a chunk that already arrived
+        return session
+    if index >= session.total_chunks:
+        raise UploadError(f"Chunk {index} is past the end of the upload ({session.total_chunks} chunks)")
+    if index > session.received_chunks:
+        raise UploadError(
+            f"Expected chunk {session.received_chunks}, received chunk {index}; resume from the reported position",
+            409
+        )
+
+    offset = index * session.chunk_size
+    expected_length = min(session.chunk_size, session.size - offset)
+    if len(data) != expected_length:
+        raise UploadError(f"Chunk {index} should be {expected_length} bytes, received {len(data)}")
+    if checksum and hashlib.sha256(data).hexdigest() != checksum.lower():
+        raise UploadError(f"Chunk {index} was corrupted in transit (checksum mismatch); send it again")
+
+    os.makedirs(UPLOAD_SESSION_FOLDER, exist_ok=True)
+    fd = os.open(part_path(session.id), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.pwrite(fd, data, offset)
+    finally:
+        os.close(fd)
+
+    # Advance only from the position this chunk was written at, so a concurrent
+    # retry of the same chunk cannot count it twice
+    advanced = db.session.execute(
+        update(UploadSession)
+        .where(UploadSession.id == session.id, UploadSession.received_chunks == index)
+        .values(received_chunks=index + 1, updated_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    db.session.refresh(session)
+
+    if advanced and index + 1 == session.total_chunks:
+        _complete(session)
+    return session
+
+
+def _complete(session):
+    """Verify the assembled file and move it into the blob store"""
+    path = part_path(session.id)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as part_file:
+        for block in iter(lambda: part_file.read(1024 * 1024), b''):
+            digest.update(block)
+
+    if digest.hexdigest() != session.sha256:
+        # Start over rather than keep a file that cannot be trusted
+        logger.warning(f"Upload {session.id} failed checksum verification; restarting it")
+        os.remove(path)
+        session.received_chunks = 0
+        session.updated_at = datetime.utcnow()
+        db.session.commit()
+        raise UploadError("The uploaded file does not match its checksum; upload it again from the start", 422)
+
+    blob_path = store_file(path, referenced=False)
+    os.remove(path)
+    if blob_path.endswith('.bin'):
+        db.session.delete(session)
+        db.session.commit()
+        raise UploadError("The uploaded file is not a supported image", 415)
+
+    session.status = 'complete'
+    session.blob_path = blob_path
+    session.updated_at = datetime.utcnow()
+    db.session.commit()
+    logger.info(f"Completed upload {session.id} as {blob_path}")
+
+
+def completed_upload_image(upload_id, user_id):
+    """
+    The stored image of a finished upload, for the analyze endpoints
+
+    Returns:
+        tuple: (blob path, MIME type)
+
+    Raises:
+        ValueError: If there is no such upload or it has not finished
+    """
+    session = get_upload(upload_id, user_id)
+    if session is None:
+        raise ValueError("Unknown upload id")
+    if session.status != 'complete' or not session.blob_path or not os.path.exists(session.blob_path):
+        raise ValueError("The upload has not finished; send the remaining chunks first")
+    return session.blob_path, mimetypes.guess_type(session.blob_path)[0] or 'image/jpeg'
+
+
+def expire_upload_sessions(max_age_seconds=UPLOAD_SESSION_TTL_SECONDS):
+    """
+    Delete sessions not touched for max_age_seconds, with their part files, and
+    part files left without a session (assembled blobs are unreferenced and
+    left to the blob garbage collector)
+
+    Returns:
+        int: Number of sessions removed
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age_seconds)
+    table = UploadSession.__table__
+    with db.engine.connect() as conn:
+        expired = [row.id for row in conn.execute(select(table.c.id).where(table.c.updated_at < cutoff))]
+    removed = 0
+    for upload_id in expired:
+        with db.engine.begin() as conn:
+            # Re-check: the session may have been resumed, or removed by another process
+            deleted = conn.execute(
+                delete(table).where(table.c.id == upload_id, table.c.updated_at < cutoff)
+            ).rowcount
+        if not deleted:
+            continue
+        removed += 1
+        try:
+            os.remove(part_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    try:
+        entries = list(os.scandir(UPLOAD_SESSION_FOLDER))
+    except FileNotFoundError:
+        entries = []
+    stale_parts = {
+        entry.name[:-len('.part')]: entry.path for entry in entries
+        if entry.name.endswith('.part') and entry.stat().st_mtime < time.time() - max_age_seconds
+    }
+    if stale_parts:
+        with db.engine.connect() as conn:
+            live = {row.id for row in conn.execute(select(table.c.id).where(table.c.id.in_(list(stale_parts))))}
+        for upload_id, path in stale_parts.items():
+            if upload_id not in live:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+    if removed:
+        logger.info(f"Removed {removed} abandoned upload sessions")
+    return removed
@@ -0,0 +1,444 @@
+"""
+Content-addressed cache for AI explanations.
+
+Explanations are keyed by the SHA-256 of the normalized image bytes plus the
+subject, model and prompt version. Lookups go through a small in-process LRU
+first and fall back to the CachedExplanation table, which is shared by every
+gunicorn worker. Old and excess rows are evicted periodically on write. Hits
+are counted in memory and written by a background thread every
+EXPLANATION_CACHE_HIT_FLUSH_SECONDS (and at exit), so a cache hit never waits
+for a database write.
+
+A question's own explanation (the Explanation table) is stored once, whichever
+path generated it, through save_question_explanation.
+"""
+import os
+import re
+import time
+import atexit
+import base64
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, func, exists, literal, Text, DateTime
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import CachedExplanation, Explanation
+from utils.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Cache limits (overridable through the environment)
+LRU_MAX_ENTRIES = int(os.environ.get('EXPLANATION_CACHE_LRU_SIZE', 256))
+DB_MAX_ENTRIES = int(os.environ.get('EXPLANATION_CACHE_MAX_ENTRIES', 20000))
+DB_MAX_BYTES = int(os.environ.get('EXPLANATION_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+MAX_AGE_DAYS = int(os.environ.get('EXPLANATION_CACHE_MAX_AGE_DAYS', 180))
+EVICT_EVERY_N_WRITES = int(os.environ.get('EXPLANATION_CACHE_EVICT_EVERY', 50))
+HIT_FLUSH_SECONDS = float(os.environ.get('EXPLANATION_CACHE_HIT_FLUSH_SECONDS', 30))
+
+
+def normalize_image_bytes(image_data):
+    """
+    Convert image data in any of the formats accepted by the AI endpoints into raw bytes
+
+    Args:
+        image_data: Data URI, plain base64 string, or raw bytes
+
+    Returns:
+        bytes: The decoded image bytes
+    """
+    if isinstance(image_data, (bytes, bytearray)):
+        return bytes(image_data)
+    if not isinstance(image_data, str):
+        raise ValueError(f"Invalid image data type: {type(image_data)}")
+
+    # Strip any data URI prefix so the same image sent with a different MIME label hashes identically
+    if 'base64,' in image_data:
+        image_data = image_data.split('base64,', 1)[1]
+
+    clean_base64 = re.sub(r'\s+', '', image_data)
+    clean_base64 += "=" * ((4 - len(clean_base64) % 4) % 4)
+    return base64.b64decode(clean_base64)
+
+
+def image_digest(image_data):
+    """SHA-256 of image data; stored images (utils/vision_payloads.py) carry their own"""
+    digest = getattr(image_data, 'sha256', None)
+    return digest or hashlib.sha256(normalize_image_bytes(image_data)).hexdigest()
+
+
+def make_cache_key(image_sha256, subject, model, prompt_version):
+    """Build the cache key for an image hash and generation parameters"""
+    subject = (subject or '').lower().strip()
+    raw_key = f"{image_sha256}:{subject}:{model}:{prompt_version}"
+    return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+
+class ExplanationCache:
+    """Two-level (in-process LRU + database) cache of generated explanations"""
+
+    def __init__(self, lru_size=LRU_MAX_ENTRIES, max_entries=DB_MAX_ENTRIES,
+                 max_bytes=DB_MAX_BYTES, max_age_days=MAX_AGE_DAYS, hit_flush_interval=HIT_FLUSH_SECONDS):
+        self.lru_size = lru_size
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = timedelta(days=max_age_days)
+        self.hit_flush_interval = hit_flush_interval
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_eviction = 0
+        # cache_key -> [hits, last accessed] not yet written to the database
+        self._hits = {}
+        self._hits_lock = threading.Lock()
+        self._engine = None
+        self._flusher = None
+
+    def get(self, cache_key, newer_than=None):
+        """
+        Look up a cached explanation
+
+        Args:
+            cache_key: Key produced by make_cache_key
+            newer_than: Only accept an entry created at or after this time (used for forced refreshes)
+
+        Returns:
+            str: The cached explanation text, or None on a miss
+        """
+        now = datetime.utcnow()
+
+        text = None
+        with self._lock:
+            entry = self._lru.get(cache_key)
+            if entry is not None:
+                cached_text, created_at = entry
+                if newer_than is not None and created_at < newer_than:
+                    return None
+                if now - created_at <= self.max_age:
+                    self._lru.move_to_end(cache_key)
+                    text = cached_text
+                else:
+                    del self._lru[cache_key]
+        if text is not None:
+            logger.info(f"Explanation cache hit (memory): {cache_key[:12]}")
+            self._touch(cache_key, now)
+            return text
+
+        table = CachedExplanation.__table__
+        try:
+            with db.engine.connect() as conn:
+                row = conn.execute(
+                    select(table.c.response_text, table.c.created_at)
+                    .where(table.c.cache_key == cache_key)
+                ).first()
+        except Exception as e:
+            logger.error(f"Explanation cache lookup failed: {str(e)}")
+            return None
+
+        if row is None:
+            logger.info(f"Explanation cache miss: {cache_key[:12]}")
+            return None
+
+        if newer_than is not None and (row.created_at is None or row.created_at < newer_than):
+            return None
+
+        if row.created_at and now - row.created_at > self.max_age:
+            logger.info(f"Explanation cache entry expired: {cache_key[:12]}")
+            return None
+
+        logger.info(f"Explanation cache hit (database): {cache_key[:12]}")
+        self._remember(cache_key, row.response_text, row.created_at or now)
+        self._touch(cache_key, now)
+        return row.response_text
+
+    def put(self, cache_key, image_sha256, subject, model, prompt_version, response_text):
+        """Store a generated explanation, replacing any existing entry for the key"""
+        now = datetime.utcnow()
+        self._remember(cache_key, response_text, now)
+
+        table = CachedExplanation.__table__
+        values = {
+            'image_sha256': image_sha256,
+            'subject': (subject or '').lower().strip(),
+            'model': model,
+            'prompt_version': prompt_version,
+            'response_text': response_text,
+            'size_bytes': len(response_text.encode('utf-8')),
+            'created_at': now,
+            'last_accessed_at': now,
+        }
+
+        # Use a separate connection so the caller's session is never committed as a side effect
+        try:
+            with db.engine.begin() as conn:
+                updated = conn.execute(
+                    update(table).where(table.c.cache_key == cache_key).values(**values)
+                ).rowcount
+                if not updated:
+                    conn.execute(table.insert().values(cache_key=cache_key, hit_count=0, **values))
+        except IntegrityError:
+            # Another worker stored the same key concurrently - its entry is just as good
+            logger.info(f"Explanation cache entry {cache_key[:12]} was stored concurrently")
+        except Exception as e:
+            logger.error(f"Failed to store explanation in cache: {str(e)}")
+            return
+
+        with self._lock:
+            self._writes_since_eviction += 1
+            run_eviction = self._writes_since_eviction >= EVICT_EVERY_N_WRITES
+            if run_eviction:
+                self._writes_since_eviction = 0
+        if run_eviction:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove expired entries and trim the table to its size limits
+
+        Returns:
+            int: Number of rows removed
+        """
+        # Trim by up-to-date access times
+        self.flush_hits()
+        table = CachedExplanation.__table__
+        cutoff = datetime.utcnow() - self.max_age
+        removed = 0
+
+        try:
+            with db.engine.begin() as conn:
+                removed += conn.execute(delete(table).where(table.c.created_at < cutoff)).rowcount
+
+                count, total_bytes = conn.execute(
+                    select(func.count(table.c.id), func.coalesce(func.sum(table.c.size_bytes), 0))
+                ).one()
+
+                if count > self.max_entries or total_bytes > self.max_bytes:
+                    # Walk from most to least recently used and drop everything past the limits
+                    rows = conn.execute(
+                        select(table.c.id, table.c.size_bytes)
+                        .order_by(table.c.last_accessed_at.desc())
+                    ).all()
+                    kept_entries = 0
+                    kept_bytes = 0
+                    stale_ids = []
+                    for row in rows:
+                        kept_entries += 1
+                        kept_bytes += row.size_bytes or 0
+                        if kept_entries > self.max_entries or kept_bytes > self.max_bytes:
+                            stale_ids.append(row.id)
+
+                    for start in range(0, len(stale_ids), 500):
+                        chunk = stale_ids[start:start + 500]
+                        removed += conn.execute(delete(table).where(table.c.id.in_(chunk))).rowcount
+        except Exception as e:
+            logger.error(f"Explanation cache eviction failed: {str(e)}")
+            return removed
+
+        if removed:
+            logger.info(f"Evicted {removed} explanation cache entries")
+            # Entries may have been removed by age; drop the in-memory copies of anything expired
+            with self._lock:
+                now = datetime.utcnow()
+                for key in [k for k, (_, created_at) in self._lru.items() if now - created_at > self.max_age]:
+                    del self._lru[key]
+        return removed
+
+    def clear_memory(self):
+        """Drop the in-process LRU (the database entries are kept)"""
+        with self._lock:
+            self._lru.clear()
+
+    def _remember(self, cache_key, response_text, created_at):
+        with self._lock:
+            self._lru[cache_key] = (response_text, created_at)
+            self._lru.move_to_end(cache_key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def _touch(self, cache_key, now):
+        """Count a hit (written later by flush_hits) so size-based eviction keeps popular entries"""
+        with self._hits_lock:
+            pending = self._hits.get(cache_key)
+            if pending:
+                pending[0] += 1
+                pending[1] = now
+            else:
+                self._hits[cache_key] = [1, now]
+            # Started on first use, so each gunicorn worker gets its own after forking
+            if self._flusher is None or not self._flusher.is_alive():
+                if self._engine is None:
+                    atexit.register(self.flush_hits)
+                self._engine = db.engine
+                self._flusher = threading.Thread(
+                    target=self._flush_hits_periodically, name='explanation-cache-hits', daemon=True
+                )
+                self._flusher.start()
+
+    def _flush_hits_periodically(self):
+        while True:
+            time.sleep(self.hit_flush_interval)
+            self.flush_hits()
+
+    def flush_hits(self):
+        """Write the hits counted since the last flush"""
+        with self._hits_lock:
+            pending, self._hits = self._hits, {}
+        if not pending:
+            return
+        table = CachedExplanation.__table__
+        # May run on the flusher thread, outside any app context
+        engine = self._engine or db.engine
+        try:
+            with engine.begin() as conn:
+                for cache_key, (hits, last_accessed) in pending.items():
+                    conn.execute(
+                        update(table)
+                        .where(table.c.cache_key == cache_key)
+                        .values(hit_count=table.c.hit_count + hits, last_accessed_at=last_accessed)
+                    )
+        except Exception as e:
+            logger.warning(f"Failed to update explanation cache hit counts: {str(e)}")
+
+
+# Shared cache instance for this process
+explanation_cache = ExplanationCache()
+
+# Coalesces concurrent generation of the same explanation (same cache key) across threads and workers
+explanation_flights = SingleFlight('explanation')
+
+
+def explanation_cache_key(image_data, subject):
+    """
+    Compute the cache key for an explanation of an image
+
+    Returns:
+        tuple: (image SHA-256, cache key)
+    """
+    from utils.openai_helper import EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION
+
+    image_sha256 = image_digest(image_data)
+    return image_sha256, make_cache_key(image_sha256, subject, EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION)
+
+
+def store_explanation(image_data, subject, explanation_text):
+    """Cache an explanation generated outside get_or_generate_explanation (e.g. a streamed one)"""
+    from utils.openai_helper import EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION
+
+    image_sha256, cache_key = explanation_cache_key(image_data, subject)
+    explanation_cache.put(
+        cache_key, image_sha256, subject,
+        EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION, explanation_text
+    )
+
+
+def save_question_explanation(connection, question_id, explanation_text):
+    """
+    Store a question's explanation unless it already has one
+
+    Requests for the same question can generate concurrently (in several workers,
+    or a student request racing a pre-generation run). The insert is conditional
+    and, with the unique index on explanation.question_id, a racing insert is
+    skipped instead of adding a second row.
+
+    Args:
+        connection: Session or Connection whose transaction the insert joins
+        question_id: The question
+        explanation_text: The generated explanation
+
+    Returns:
+        bool: True if stored, False if the question already had an explanation
+    """
+    table = Explanation.__table__
+    insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    row = select(
+        literal(question_id), literal(explanation_text, Text), literal(datetime.utcnow(), DateTime)
+    ).where(~exists().where(table.c.question_id == question_id))
+    statement = insert(table).from_select(
+        ['question_id', 'explanation_text', 'generated_at'], row
+    ).on_conflict_do_nothing()
+    return connection.execute(statement).rowcount > 0
+
+
+def get_or_generate_explanation(image_data, subject, force_refresh=False):
+    """
+    Return an explanation for an image, generating it with OpenAI only on a cache miss
+
+    Args:
+        image_data: Data URI, base64 string, raw bytes or StoredVisionImage of the question image
+        subject: Subject of the question (e.g., "Mathematics", "Physics")
+        force_refresh: Skip the lookup and always generate (the new result replaces the cached one)
+
+    Returns:
+        tuple: (explanation text, True if served from the cache)
+    """
+    from utils.openai_helper import generate_explanation, EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION
+
+    image_sha256 = image_digest(image_data)
+    cache_key = make_cache_key(image_sha256, subject, EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION)
+
+    requested_at = datetime.utcnow()
+    if not force_refresh:
+        cached_text = explanation_cache.get(cache_key)
+        if cached_text:
+            return cached_text, True
+
+    if isinstance(image_data, (bytes, bytearray)):
+        image_data = base64.b64encode(image_data).decode('utf-8')
+
+    def generate():
+        explanation_text = generate_explanation(image_data, subject)
+        explanation_cache.put(
+            cache_key, image_sha256, subject,
+            EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION, explanation_text
+        )
+        return explanation_text
+
+    # Identical requests already in flight share one OpenAI call; a forced refresh
+    # only accepts results generated after it was requested
+    explanation_text = explanation_flights.do(
+        cache_key, generate,
+        check=lambda: explanation_cache.get(cache_key, newer_than=requested_at if force_refresh else None)
+    )
+    return explanation_text, False
+
+
+async def get_or_generate_explanation_async(image_data, subject, force_refresh=False):
+    """
+    Async variant of get_or_generate_explanation used by the background AI job workers.
+    Database access runs in a thread so the worker's event loop is never blocked.
+
+    Returns:
+        tuple: (explanation text, True if served from the cache)
+    """
+    from utils.openai_helper import generate_explanation_async, EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION
+
+    image_sha256 = image_digest(image_data)
+    cache_key = make_cache_key(image_sha256, subject, EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION)
+
+    requested_at = datetime.utcnow()
+    if not force_refresh:
+        cached_text = await asyncio.to_thread(explanation_cache.get, cache_key)
+        if cached_text:
+            return cached_text, True
+
+    if isinstance(image_data, (bytes, bytearray)):
+        image_data = base64.b64encode(image_data).decode('utf-8')
+
+    async def generate():
+        explanation_text = await generate_explanation_async(image_data, subject)
+        await asyncio.to_thread(
+            explanation_cache.put, cache_key, image_sha256, subject,
+            EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION, explanation_text
+        )
+        return explanation_text
+
+    explanation_text = await explanation_flights.do_async(
+        cache_key, generate,
+        check=lambda: explanation_cache.get(cache_key, newer_than=requested_at if force_refresh else None)
+    )
+    return explanation_text, False
@@ -0,0 +1,84 @@
+"""
+Hand file transfers to the front proxy instead of streaming them from Python.
+
+With send_file, a gunicorn worker is busy for as long as a phone on a slow
+connection takes to download an image. In offload mode the view still does
+authorization, path resolution and conditional-request handling (ETag, 304),
+but it returns an empty response with a header that makes the proxy send the
+file itself:
+
+- FILE_OFFLOAD_MODE=sendfile: `X-Sendfile: <absolute path>` (Apache
+  mod_xsendfile, lighttpd).
+- FILE_OFFLOAD_MODE=accel: `X-Accel-Redirect: <FILE_OFFLOAD_PREFIX><path
+  relative to FILE_OFFLOAD_ROOT>` (nginx). Configure a matching internal
+  location:
+
+      location /_protected/ {
+          internal;
+          alias /path/to/app/;
+      }
+
+- FILE_OFFLOAD_MODE=off (the default): stream with send_file as before.
+
+Files outside FILE_OFFLOAD_ROOT, in-memory files and range requests are
+always streamed by Flask.
+"""
+import os
+import logging
+
+from flask import current_app, request, send_file
+from werkzeug.utils import send_file as werkzeug_send_file
+
+logger = logging.getLogger(__name__)
+
+FILE_OFFLOAD_MODE = os.environ.get('FILE_OFFLOAD_MODE', 'off').lower()
+FILE_OFFLOAD_ROOT = os.path.abspath(os.environ.get('FILE_OFFLOAD_ROOT', os.getcwd()))
+FILE_OFFLOAD_PREFIX = '/' + os.environ.get('FILE_OFFLOAD_PREFIX', '/_protected/').strip('/') + '/'
+
+if FILE_OFFLOAD_MODE not in ('off', 'sendfile', 'accel'):
+    logger.error(f"Unknown FILE_OFFLOAD_MODE {FILE_OFFLOAD_MODE!r}; serving files from Python")
+    FILE_OFFLOAD_MODE = 'off'
+
+
+def internal_redirect_uri(path):
+    """
+    The proxy-internal URI of a file for X-Accel-Redirect
+
+    Returns:
+        str: URI under FILE_OFFLOAD_PREFIX, or None if the file is outside FILE_OFFLOAD_ROOT
+    """
+    relative = os.path.relpath(os.path.abspath(path), FILE_OFFLOAD_ROOT)
+    if relative.startswith('..') or os.path.isabs(relative):
+        return None
+    return FILE_OFFLOAD_PREFIX + relative.replace(os.sep, '/')
+
+
+def send_asset(path, **kwargs):
+    """
+    Send a file, offloading the transfer to the front proxy when configured
+
+    Args:
+        path: File to send
+        **kwargs: send_file options (mimetype, etag, conditional, max_age, last_modified, ...)
+
+    Returns:
+        Response: The response; empty with an offload header in offload mode
+    """
+    if FILE_OFFLOAD_MODE == 'off' or 'Range' in request.headers:
+        return send_file(path, **kwargs)
+
+    internal_uri = None
+    if FILE_OFFLOAD_MODE == 'accel':
+        internal_uri = internal_redirect_uri(path)
+        if internal_uri is None:
+            return send_file(path, **kwargs)
+
+    # Werkzeug sets X-Sendfile, and removes it again when the answer is a 304
+    response = werkzeug_send_file(
+        os.path.abspath(path), request.environ, use_x_sendfile=True,
+        response_class=current_app.response_class, **kwargs
+    )
+    if internal_uri and 'X-Sendfile' in response.headers:
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = internal_uri
+    return response
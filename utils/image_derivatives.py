@@ -0,0 +1,196 @@
+"""
+Responsive derivatives of question and mark-scheme images.
+
+Question PNGs are scanned at print resolution, but phones display them at
+400-800 CSS pixels. At ingest each image is re-encoded as WebP (and AVIF
+when this Pillow build supports it) at a few widths. get_question_image
+then serves the smallest derivative that covers the width the client asked
+for (`?w=`), in the best format its Accept header allows.
+
+Derivatives are named after the SHA-256 of the source file, so an edited
+image gets new derivatives and identical images share them. If a derivative
+is missing, the original is served, and the folder is only looked at again
+after DERIVATIVE_MISS_TTL seconds (or once this process generates them). This
+module does not touch the database, so it can run in process pools and in
+utilities that run outside the app.
+"""
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+# Under the application folder (QUESTION_IMAGE_ROOT in utils/question_images.py), not the working directory
+DERIVATIVES_FOLDER = os.environ.get(
+    'IMAGE_DERIVATIVES_FOLDER',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'derivatives')
+)
+DERIVATIVE_WIDTHS = tuple(
+    int(width) for width in os.environ.get('IMAGE_DERIVATIVE_WIDTHS', '480,768,1200').split(',')
+)
+WEBP_QUALITY = int(os.environ.get('IMAGE_WEBP_QUALITY', 80))
+AVIF_QUALITY = int(os.environ.get('IMAGE_AVIF_QUALITY', 60))
+# Seconds an image found to have no derivatives is served its original without looking again
+DERIVATIVE_MISS_TTL = float(os.environ.get('IMAGE_DERIVATIVE_MISS_TTL', 300))
+
+# Preferred format first; AVIF only if this Pillow build can encode it
+DERIVATIVE_FORMATS = (('avif', 'image/avif'),) if features.check('avif') else ()
+DERIVATIVE_FORMATS += (('webp', 'image/webp'),)
+
+# digest -> {extension: sorted widths} of images that have derivatives
+_available_widths = {}
+# digest -> time an image was found to have none; forgotten after DERIVATIVE_MISS_TTL,
+# so derivatives generated by another process are picked up
+_missing = {}
+MAX_MISSING_ENTRIES = 4096
+
+
+def file_digest(path):
+    """SHA-256 of a file's contents, as hex"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as image_file:
+        for chunk in iter(lambda: image_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def derivative_path(digest, width, extension):
+    return os.path.join(DERIVATIVES_FOLDER, digest[:2], f"{digest}_{width}.{extension}")
+
+
+def derivative_widths(source_width):
+    """Widths to generate for an image: the configured ones below its own width, plus its own"""
+    return sorted({width for width in DERIVATIVE_WIDTHS if width < source_width} | {source_width})
+
+
+def generate_derivatives(source_path, digest=None):
+    """
+    Write the WebP/AVIF derivatives of an image, skipping those that already exist
+
+    Args:
+        source_path: Original image file
+        digest: SHA-256 of the file, if already known
+
+    Returns:
+        int: Number of derivative files written
+    """
+    digest = digest or file_digest(source_path)
+    written = 0
+    with Image.open(source_path) as original:
+        img = ImageOps.exif_transpose(original)
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+        for width in derivative_widths(img.width):
+            pending = [
+                (extension, path) for extension, path in (
+                    (extension, derivative_path(digest, width, extension))
+                    for extension, _ in DERIVATIVE_FORMATS
+                ) if not os.path.exists(path)
+            ]
+            if not pending:
+                continue
+            height = max(1, round(img.height * width / img.width))
+            resized = img if width == img.width else img.resize((width, height), Image.LANCZOS)
+            for extension, path in pending:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write under a temporary name so readers never see a partial file
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                if extension == 'avif':
+                    resized.save(temp_path, 'AVIF', quality=AVIF_QUALITY)
+                else:
+                    resized.save(temp_path, 'WEBP', quality=WEBP_QUALITY, method=6)
+                os.replace(temp_path, path)
+                written += 1
+    _available_widths.pop(digest, None)
+    _missing.pop(digest, None)
+    return written
+
+
+def generate_derivatives_safely(source_path):
+    """Generate derivatives at ingest time; a failure is logged and the original is served instead"""
+    try:
+        written = generate_derivatives(source_path)
+        logger.info(f"Generated {written} image derivatives for {source_path}")
+        return written
+    except Exception as e:
+        logger.warning(f"Could not generate image derivatives for {source_path}: {str(e)}")
+        return 0
+
+
+def select_derivative(digest, accept_header, width=None):
+    """
+    Choose the derivative to serve for a request
+
+    Args:
+        digest: SHA-256 of the original image
+        accept_header: The request's Accept header
+        width: Width the client asked for, or None for the largest available
+
+    Returns:
+        tuple: (path, mimetype, width), or None to serve the original
+    """
+    accept_header = accept_header or ''
+    available_widths = _available_widths.get(digest)
+    if available_widths is None:
+        missed_at = _missing.get(digest)
+        if missed_at is not None and time.monotonic() - missed_at < DERIVATIVE_MISS_TTL:
+            return None
+        available_widths = _list_derivatives(digest)
+    for extension, mimetype in DERIVATIVE_FORMATS:
+        available = available_widths.get(extension)
+        if not available or mimetype not in accept_header:
+            continue
+        # Smallest derivative at least as wide as requested, else the largest
+        chosen = next((w for w in available if width and w >= width), available[-1])
+        return derivative_path(digest, chosen, extension), mimetype, chosen
+    return None
+
+
+def _list_derivatives(digest):
+    """Find the derivatives on disk for an image"""
+    prefix = f"{digest}_"
+    available = {}
+    try:
+        names = os.listdir(os.path.join(DERIVATIVES_FOLDER, digest[:2]))
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if name.startswith(prefix) and not name.endswith('.tmp'):
+            width, _, extension = name[len(prefix):].partition('.')
+            available.setdefault(extension, []).append(int(width))
+    for widths in available.values():
+        widths.sort()
+    if available:
+        _available_widths[digest] = available
+        _missing.pop(digest, None)
+    else:
+        if len(_missing) >= MAX_MISSING_ENTRIES:
+            _missing.clear()
+        _missing[digest] = time.monotonic()
+    return available
+
+
+def backfill_derivatives(paths, workers=None):
+    """
+    Generate derivatives for many images in a process pool
+
+    Args:
+        paths: Image files to process
+        workers: Number of processes (defaults to the CPU count)
+
+    Returns:
+        dict: Counts of 'written' derivative files and 'failed' images
+    """
+    counts = {'written': 0, 'failed': 0}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(generate_derivatives, path): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                counts['written'] += future.result()
+            except Exception as e:
+                counts['failed'] += 1
+                logger.warning(f"Could not generate derivatives for {futures[future]}: {str(e)}")
+    return counts
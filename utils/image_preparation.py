@@ -0,0 +1,203 @@
+"""
+Pre-flight preparation of images sent to the OpenAI vision models.
+
+Phone cameras produce 4000x3000 JPEGs of several MB, but GPT-4o first fits
+every image within 2048x2048 and then scales its shortest side down to 768px
+before cutting it into 512px tiles. Anything beyond that is uploaded, billed
+by bandwidth and latency, and then thrown away. Each image is therefore:
+
+- decoded once, rotated upright from its EXIF orientation and stripped of
+  EXIF/GPS metadata,
+- downscaled to the size the model would use, nudged onto the 512px tile grid
+  when a small shrink saves a whole row or column of tiles,
+- re-encoded as JPEG (or WebP) at a tuned quality,
+- sent with a `detail` level chosen from its content.
+
+Images that cannot be decoded are passed through unchanged so the model can
+still report on them.
+"""
+import io
+import os
+import re
+import math
+import base64
+import logging
+
+from PIL import Image, ImageOps, ImageStat
+
+logger = logging.getLogger(__name__)
+
+# Output encoding: 'jpeg' or 'webp' (both accepted by the vision models)
+VISION_IMAGE_FORMAT = os.environ.get('VISION_IMAGE_FORMAT', 'jpeg').lower()
+VISION_IMAGE_QUALITY = int(os.environ.get('VISION_IMAGE_QUALITY', 85))
+# 'auto' chooses per image; 'low' or 'high' forces a level
+VISION_IMAGE_DETAIL = os.environ.get('VISION_IMAGE_DETAIL', 'auto').lower()
+# Largest shrink accepted to drop a row/column of tiles (0.12 = up to 12% smaller)
+VISION_TILE_SNAP = float(os.environ.get('VISION_TILE_SNAP', 0.12))
+
+# Vision model resizing rules (https://platform.openai.com/docs/guides/vision)
+MAX_LONG_SIDE = 2048
+MAX_SHORT_SIDE = 768
+TILE_SIZE = 512
+# Below this brightness standard deviation an image is essentially blank
+BLANK_IMAGE_STDDEV = 4.0
+
+_DATA_URI_RE = re.compile(r'^data:(image/[\w.+-]+)?;base64,', re.IGNORECASE)
+
+
+def vision_target_size(width, height):
+    """
+    Size the vision model works at for an image of the given dimensions
+
+    Returns:
+        tuple: (width, height), never larger than the original
+    """
+    scale = min(1.0, MAX_LONG_SIDE / max(width, height))
+    scale *= min(1.0, MAX_SHORT_SIDE / (min(width, height) * scale))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def tile_count(width, height):
+    return math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+
+
+def snap_to_tile_grid(width, height, max_shrink=VISION_TILE_SNAP):
+    """
+    Shrink an image slightly if that saves whole tiles
+
+    A 780x1100 page costs 2x3 = 6 tiles; at 727x1024 it costs 2x2 = 4 with no
+    visible loss of legibility.
+
+    Returns:
+        tuple: (width, height)
+    """
+    best_scale = 1.0
+    best_tiles = tile_count(width, height)
+    for side in (width, height):
+        boundary = (math.ceil(side / TILE_SIZE) - 1) * TILE_SIZE
+        if boundary <= 0:
+            continue
+        scale = boundary / side
+        if scale < 1.0 - max_shrink:
+            continue
+        tiles = tile_count(math.floor(width * scale), math.floor(height * scale))
+        if tiles < best_tiles or (tiles == best_tiles and scale > best_scale):
+            best_scale, best_tiles = scale, tiles
+    if best_scale == 1.0:
+        return width, height
+    return max(1, math.floor(width * best_scale)), max(1, math.floor(height * best_scale))
+
+
+def choose_detail(img):
+    """
+    Pick the vision `detail` level for a prepared image
+
+    'low' costs a flat 85 tokens but shows the model a 512x512 version, so it
+    is only used when nothing would be lost: images that already fit in one
+    tile, and blank or near-uniform frames (a covered lens, an empty page).
+    Exam questions and handwriting otherwise need 'high'.
+    """
+    if VISION_IMAGE_DETAIL in ('low', 'high'):
+        return VISION_IMAGE_DETAIL
+    if max(img.size) <= TILE_SIZE:
+        return 'low'
+    stddev = ImageStat.Stat(img.convert('L')).stddev[0]
+    if stddev < BLANK_IMAGE_STDDEV:
+        return 'low'
+    return 'high'
+
+
+def decode_image_data(image_data):
+    """
+    Decode a data URI, bare base64 string or raw bytes
+
+    Returns:
+        tuple: (image bytes, mime type or None)
+    """
+    if isinstance(image_data, (bytes, bytearray)):
+        return bytes(image_data), None
+    mime = None
+    match = _DATA_URI_RE.match(image_data)
+    if match:
+        mime = match.group(1)
+        image_data = image_data[match.end():]
+    elif 'base64,' in image_data:
+        image_data = image_data.split('base64,', 1)[1]
+    image_data = image_data.strip()
+    return base64.b64decode(image_data + '=' * (-len(image_data) % 4)), mime
+
+
+def prepare_vision_image(image_data):
+    """
+    Prepare an image for a vision chat completion
+
+    Args:
+        image_data: Data URI, bare base64 string, raw bytes, or an upright PIL Image
+            already decoded (bytes carrying one as `image`, like a rectified photo,
+            are not decoded again)
+
+    Returns:
+        dict: The `image_url` part of a chat message ({'url': ..., 'detail': ...})
+    """
+    if isinstance(image_data, Image.Image):
+        decoded, image_bytes, mime = image_data, None, None
+    else:
+        decoded = getattr(image_data, 'image', None)
+        try:
+            image_bytes, mime = decode_image_data(image_data)
+        except Exception as e:
+            raise ValueError(f"Image data is not valid base64: {str(e)}")
+
+    try:
+        if decoded is not None:
+            img = flatten_image(decoded)
+        else:
+            with Image.open(io.BytesIO(image_bytes)) as original:
+                # Apply the camera orientation; re-encoding below drops the EXIF block
+                img = flatten_image(ImageOps.exif_transpose(original))
+        source_size = img.size
+        target = snap_to_tile_grid(*vision_target_size(*img.size))
+        if target != img.size:
+            img = img.resize(target, Image.LANCZOS)
+        detail = choose_detail(img)
+        encoded, out_mime = _encode(img)
+    except Exception as e:
+        if image_bytes is None:
+            raise ValueError(f"Could not prepare image for the vision model: {str(e)}")
+        logger.warning(f"Could not prepare image for the vision model, sending it unchanged: {str(e)}")
+        url = image_data if isinstance(image_data, str) and image_data.startswith('data:') else \
+            f"data:{mime or 'image/jpeg'};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+        return {"url": url, "detail": 'high' if VISION_IMAGE_DETAIL == 'auto' else VISION_IMAGE_DETAIL}
+
+    logger.info(
+        f"Prepared vision image: {source_size[0]}x{source_size[1]} "
+        f"{'decoded' if decoded is not None else f'{len(image_bytes)} bytes'} -> "
+        f"{target[0]}x{target[1]} {len(encoded)} bytes ({tile_count(*target)} tiles, detail={detail})"
+    )
+    return {
+        "url": f"data:{out_mime};base64,{base64.b64encode(encoded).decode('utf-8')}",
+        "detail": detail
+    }
+
+
+def flatten_image(img):
+    """Convert to a mode the encoders accept, putting transparency on white"""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    if img.mode in ('L', 'RGB'):
+        return img
+    if img.mode in ('1', 'I;16', 'I'):
+        return img.convert('L')
+    return img.convert('RGB')
+
+
+def _encode(img):
+    out = io.BytesIO()
+    if VISION_IMAGE_FORMAT == 'webp':
+        img.save(out, 'WEBP', quality=VISION_IMAGE_QUALITY, method=4)
+        return out.getvalue(), 'image/webp'
+    img.save(out, 'JPEG', quality=VISION_IMAGE_QUALITY, optimize=True, progressive=True)
+    return out.getvalue(), 'image/jpeg'
@@ -5,6 +5,7 @@ from PIL import Image
 import logging
 import uuid
 from datetime import datetime
+from utils.image_derivatives import generate_derivatives_safely
 
 def get_data_folder():
     """Get or create the data folder for storing papers and questions"""
@@ -127,6 +128,7 @@ def extract_questions(paper_path, output_folder, paper_id):
         img_path = os.path.join(output_folder, img_filename)
         
         cv2.imwrite(img_path, question_img)
+        generate_derivatives_safely(img_path)
         
         # Add to questions dictionary
         questions[question_number] = img_path
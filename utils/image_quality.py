@@ -0,0 +1,216 @@
+"""
+Fast local quality check of photos before they are sent to the vision model.
+
+A blurry, dark or tiny photo still costs a 20 s GPT-4o call, after which the
+student retakes it anyway. assess_image_quality looks at a grayscale copy of
+at most QUALITY_WORKING_SIDE pixels (tens of milliseconds, against seconds
+for the model call) and measures:
+
+- sharpness: variance of the Laplacian over the area containing writing (a
+  mostly blank page would otherwise look blurry),
+- exposure: median brightness, and the contrast between the paper and the
+  ink marks on it,
+- text size: typical height of character-sized connected components, in
+  pixels of the original photo,
+- page confidence: how well the largest contour fits a quadrilateral sheet
+  of paper (reported only; screenshots and tight crops have no page edge).
+
+Photos that fail are rejected with a message telling the student what to
+change, before any credits or model time are used. The thresholds are
+deliberately lenient: a borderline photo is better sent than refused.
+"""
+import io
+import os
+import time
+import logging
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from utils.image_preparation import decode_image_data
+
+logger = logging.getLogger(__name__)
+
+IMAGE_QUALITY_GATE_ENABLED = os.environ.get('IMAGE_QUALITY_GATE_ENABLED', 'true').lower() == 'true'
+# Shortest side below which nothing is legible, in pixels
+QUALITY_MIN_SIDE = int(os.environ.get('QUALITY_MIN_SIDE', 240))
+# Laplacian variance of the writing below which a photo is too blurry
+QUALITY_MIN_SHARPNESS = float(os.environ.get('QUALITY_MIN_SHARPNESS', 60))
+# Median brightness (0-255) below which a photo is too dark, unless it has strong contrast
+QUALITY_MIN_BRIGHTNESS = int(os.environ.get('QUALITY_MIN_BRIGHTNESS', 50))
+# Brightness difference between paper and ink below which the writing does not stand out
+QUALITY_MIN_CONTRAST = int(os.environ.get('QUALITY_MIN_CONTRAST', 40))
+# Typical character height below which writing is too small to read, in original pixels
+QUALITY_MIN_TEXT_HEIGHT = float(os.environ.get('QUALITY_MIN_TEXT_HEIGHT', 8))
+# Fewer character-sized marks than this means there is no writing in the photo
+QUALITY_MIN_TEXT_COMPONENTS = int(os.environ.get('QUALITY_MIN_TEXT_COMPONENTS', 8))
+
+QUALITY_WORKING_SIDE = 1024
+
+QUALITY_MESSAGES = {
+    'unreadable': "The photo could not be opened. Please take it again.",
+    'too_small': "The photo is too small to read. Please use a higher-resolution picture.",
+    'too_dark': "The photo is too dark. Please turn on a light or move to a brighter spot and retake it.",
+    'low_contrast': "The writing doesn't stand out in the photo (it may be washed out by glare). "
+                    "Please avoid direct light on the page and retake it.",
+    'no_text': "No writing was found in the photo. Please make sure the question is in the frame.",
+    'text_too_small': "The writing is too small to read. Please move closer so the question fills the frame.",
+    'blurry': "The photo is blurry. Please hold the camera steady, tap to focus and retake it.",
+}
+
+
+def _decode_flag(width, height):
+    """imdecode flag that lets the JPEG decoder scale down large photos (1/2, 1/4, 1/8) while decoding"""
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                         (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+        if max(width, height) / factor >= QUALITY_WORKING_SIDE:
+            return flag
+    return cv2.IMREAD_GRAYSCALE
+
+
+def _page_confidence(gray):
+    """How clearly the photo shows a sheet of paper, from 0 (no page edge) to 1 (a clean quadrilateral)"""
+    _, paper = cv2.threshold(cv2.GaussianBlur(gray, (9, 9), 0), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    contours, _ = cv2.findContours(paper, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return 0.0
+    page = max(contours, key=cv2.contourArea)
+    area = cv2.contourArea(page)
+    coverage = area / gray.size
+    if not 0.2 < coverage < 0.98:
+        return 0.0
+    corners = cv2.approxPolyDP(page, 0.02 * cv2.arcLength(page, True), True)
+    if len(corners) != 4:
+        return 0.3
+    # How much of its quadrilateral the contour fills
+    return round(min(1.0, area / max(cv2.contourArea(corners), 1)), 2)
+
+
+def _text_components(gray):
+    """
+    Heights of the character-sized ink marks, the bounding box of all of them, and
+    the contrast between the ink and the paper around it
+
+    Returns:
+        tuple: (array of heights in working pixels, (x0, y0, x1, y1) or None, contrast)
+    """
+    ink = cv2.adaptiveThreshold(
+        cv2.GaussianBlur(gray, (3, 3), 0), 255,
+        cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15
+    )
+    count, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    stats = stats[1:count]
+    widths, heights, areas = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT], stats[:, cv2.CC_STAT_AREA]
+    # Characters: not specks, not page edges or ruled lines
+    glyphs = (heights >= 3) & (areas >= 6) & (heights < gray.shape[0] / 4) & (widths < gray.shape[1] / 4) \
+        & (widths < heights * 8)
+    stats = stats[glyphs]
+    if len(stats) == 0:
+        return np.array([]), None, 0
+    x0 = stats[:, cv2.CC_STAT_LEFT]
+    y0 = stats[:, cv2.CC_STAT_TOP]
+    box = (
+        int(x0.min()), int(y0.min()),
+        int((x0 + stats[:, cv2.CC_STAT_WIDTH]).max()), int((y0 + stats[:, cv2.CC_STAT_HEIGHT]).max())
+    )
+    # Spread of brightness where the writing is, so a wide margin or dark background
+    # does not swamp it; works for light-on-dark screenshots too
+    x0, y0, x1, y1 = box
+    low, high = np.percentile(gray[y0:y1, x0:x1], [1, 99])
+    contrast = float(high - low)
+    return stats[:, cv2.CC_STAT_HEIGHT], box, contrast
+
+
+def assess_image_quality(image_data):
+    """
+    Check whether a photo is worth sending to the vision model
+
+    Args:
+        image_data: Raw bytes, a data URI or a bare base64 string
+
+    Returns:
+        dict: 'ok', 'issue' (the first problem found, or None), 'message' for the
+            student, and the measured 'metrics'
+    """
+    started = time.perf_counter()
+    try:
+        image_bytes, _ = decode_image_data(image_data)
+        # The header gives the size without decoding the pixels
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            width, height = img.size
+        gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), _decode_flag(width, height))
+    except Exception:
+        gray = None
+    if gray is None:
+        return _report('unreadable', {})
+
+    metrics = {'width': width, 'height': height}
+    if min(width, height) < QUALITY_MIN_SIDE:
+        return _report('too_small', metrics)
+
+    if max(gray.shape) > QUALITY_WORKING_SIDE:
+        factor = QUALITY_WORKING_SIDE / max(gray.shape)
+        gray = cv2.resize(gray, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+    scale = gray.shape[1] / width
+
+    metrics['brightness'] = int(np.median(gray))
+    metrics['page_confidence'] = _page_confidence(gray)
+
+    heights, box, contrast = _text_components(gray)
+    metrics['contrast'] = int(contrast)
+    metrics['text_components'] = int(len(heights))
+    # Near the top of the range: punctuation, subscripts and dotted graph paper pull the median down
+    metrics['text_height'] = round(float(np.percentile(heights, 90)) / scale, 1) if len(heights) else 0.0
+    if box:
+        x0, y0, x1, y1 = box
+        metrics['sharpness'] = round(float(cv2.Laplacian(gray[y0:y1, x0:x1], cv2.CV_64F).var()), 1)
+    else:
+        metrics['sharpness'] = 0.0
+    metrics['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    if len(heights) < QUALITY_MIN_TEXT_COMPONENTS:
+        # A dark frame shows no writing either; say why
+        return _report('too_dark' if metrics['brightness'] < QUALITY_MIN_BRIGHTNESS else 'no_text', metrics)
+    # Dark mode screenshots are dark but sharply contrasted; only dim and flat photos fail
+    if metrics['brightness'] < QUALITY_MIN_BRIGHTNESS and contrast < 2 * QUALITY_MIN_CONTRAST:
+        return _report('too_dark', metrics)
+    if contrast < QUALITY_MIN_CONTRAST:
+        return _report('low_contrast', metrics)
+    if metrics['text_height'] < QUALITY_MIN_TEXT_HEIGHT:
+        return _report('text_too_small', metrics)
+    if metrics['sharpness'] < QUALITY_MIN_SHARPNESS:
+        return _report('blurry', metrics)
+    return _report(None, metrics)
+
+
+def _report(issue, metrics):
+    return {
+        'ok': issue is None,
+        'issue': issue,
+        'message': QUALITY_MESSAGES.get(issue),
+        'metrics': metrics
+    }
+
+
+def quality_rejection(*images):
+    """
+    Check every image of a request (an image passed twice, as for a combined
+    question-and-answer photo, is checked once)
+
+    Returns:
+        dict: The report of the first unusable image, or None if all are usable
+            or the gate is disabled
+    """
+    if not IMAGE_QUALITY_GATE_ENABLED:
+        return None
+    checked = []
+    for image in images:
+        if not image or image in checked:
+            continue
+        checked.append(image)
+        report = assess_image_quality(image)
+        if not report['ok']:
+            logger.info(f"Rejected photo before the AI call ({report['issue']}): {report['metrics']}")
+            return report
+    return None
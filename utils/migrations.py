@@ -0,0 +1,261 @@
+"""
+Versioned schema migrations.
+
+db.create_all only creates missing tables: a new column or index on an
+existing table never reaches a deployed database, which is why schema changes
+used to ship as one-off scripts run by hand. Migrations are instead listed
+here in order, each with a fixed id, and the ids applied to a database are
+recorded in its schema_migration table. `python migrate.py` applies the
+pending ones; new databases get the same schema from create_all, and the
+migrations then find nothing to do.
+
+Migrations run against a live, populated database:
+
+- each migration runs in autocommit mode and every step checks first
+  (add_column, create_index), so an interrupted migration is simply run
+  again, rather than wrapped in one long transaction that would hold locks,
+- on PostgreSQL, indexes are built with CREATE INDEX CONCURRENTLY, which
+  does not block writes; an invalid index left behind by a failed build is
+  dropped before each attempt, and a migration is only recorded once its
+  indexes are valid,
+- DDL that needs a table lock waits at most MIGRATION_LOCK_TIMEOUT for it
+  (and is retried) instead of queueing every request behind it,
+- a PostgreSQL advisory lock keeps two deploys from migrating at once.
+
+To change the schema, update models.py and append a migration to the end of
+MIGRATIONS; never edit or reorder one that has shipped.
+"""
+import os
+import time
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+from app import db
+from models import SchemaMigration
+
+logger = logging.getLogger(__name__)
+
+# Longest wait for a table lock before DDL gives up and retries, on PostgreSQL
+MIGRATION_LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '5s')
+MIGRATION_LOCK_RETRIES = int(os.environ.get('MIGRATION_LOCK_RETRIES', 5))
+# Arbitrary key of the advisory lock held while migrating
+MIGRATION_ADVISORY_LOCK = 4_157_020_213
+
+# (id, description, function) in the order they are applied
+MIGRATIONS = []
+
+
+def migration(migration_id, description):
+    """Register a migration function, called with a SchemaEditor"""
+    def register(function):
+        MIGRATIONS.append((migration_id, description, function))
+        return function
+    return register
+
+
+class SchemaEditor:
+    """Idempotent schema changes on an autocommit connection"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.postgres = conn.dialect.name == 'postgresql'
+
+    def _inspector(self):
+        return inspect(self.conn)
+
+    def has_table(self, table):
+        return self._inspector().has_table(table)
+
+    def column_names(self, table):
+        return {column['name'] for column in self._inspector().get_columns(table)}
+
+    def index_names(self, table):
+        return {index['name'] for index in self._inspector().get_indexes(table)}
+
+    def execute(self, sql, before_attempt=None):
+        """
+        Run DDL, waiting at most MIGRATION_LOCK_TIMEOUT for locks and retrying if it times out
+
+        Args:
+            sql: The statement
+            before_attempt: Called before every attempt, to clean up after a failed one
+        """
+        for attempt in range(1, MIGRATION_LOCK_RETRIES + 1):
+            try:
+                if self.postgres:
+                    self.conn.execute(text(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'"))
+                if before_attempt:
+                    before_attempt()
+                self.conn.execute(text(sql))
+                return
+            except OperationalError as e:
+                # lock_timeout, or a deadlock with a concurrent transaction
+                retryable = getattr(e.orig, 'pgcode', None) in ('55P03', '40P01')
+                if not retryable or attempt == MIGRATION_LOCK_RETRIES:
+                    raise
+                logger.warning(f"Lock timeout on attempt {attempt}, retrying: {sql}")
+                time.sleep(2 ** attempt)
+
+    def add_column(self, table, column, definition):
+        """Add a column unless it exists (nullable or with a constant default, so no table rewrite)"""
+        if column in self.column_names(table):
+            return False
+        logger.info(f"Adding column {table}.{column}")
+        self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+
+    def _index_valid(self, name):
+        """
+        Whether a PostgreSQL index is usable
+
+        Returns:
+            bool: True if valid, False if a failed CREATE INDEX CONCURRENTLY left it
+                behind unusable, None if there is no such index
+        """
+        row = self.conn.execute(text(
+            "SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name"
+        ), {'name': name}).first()
+        return None if row is None else bool(row[0])
+
+    def _drop_invalid_index(self, name):
+        if self._index_valid(name) is False:
+            logger.warning(f"Dropping invalid index {name} to build it again")
+            self.conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    def create_index(self, name, table, columns, unique=False):
+        """Create an index unless it exists, without blocking writes on PostgreSQL"""
+        column_list = ', '.join(columns)
+        kind = 'UNIQUE INDEX' if unique else 'INDEX'
+        if not self.postgres:
+            if name in self.index_names(table):
+                return False
+            logger.info(f"Creating index {name} on {table} ({column_list})")
+            self.execute(f"CREATE {kind} IF NOT EXISTS {name} ON {table} ({column_list})")
+            return True
+
+        if self._index_valid(name):
+            return False
+        logger.info(f"Creating index {name} on {table} ({column_list})")
+        # A CREATE INDEX CONCURRENTLY that fails (e.g. on lock_timeout) leaves an invalid index
+        # under the name, which IF NOT EXISTS would accept; drop it before every attempt instead
+        self.execute(
+            f"CREATE {kind} CONCURRENTLY {name} ON {table} ({column_list})",
+            before_attempt=lambda: self._drop_invalid_index(name)
+        )
+        if not self._index_valid(name):
+            raise RuntimeError(f"Index {name} on {table} was left invalid; run the migration again")
+        return True
+
+
+@migration('0001_question_difficulty_and_marks', "Add difficulty_level and marks to question")
+def _question_difficulty_and_marks(schema):
+    # Formerly update_question_schema.py
+    schema.add_column('question', 'difficulty_level', 'INTEGER')
+    schema.add_column('question', 'marks', 'INTEGER')
+
+
+@migration('0002_user_profile_consent', "Add consent columns to user_profile")
+def _user_profile_consent(schema):
+    # Formerly update_user_profile.py
+    for column, definition in (
+        ('terms_accepted', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+        ('privacy_accepted', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+        ('marketing_consent', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+        ('age_confirmed', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+        ('terms_accepted_date', 'TIMESTAMP WITHOUT TIME ZONE'),
+        ('privacy_accepted_date', 'TIMESTAMP WITHOUT TIME ZONE'),
+        ('ai_usage_consent_required', 'BOOLEAN NOT NULL DEFAULT TRUE'),
+        ('last_ai_consent_date', 'TIMESTAMP WITHOUT TIME ZONE'),
+    ):
+        schema.add_column('user_profile', column, definition)
+
+
+@migration('0003_hot_path_indexes', "Index the cached-explanation, history and paper lookups")
+def _hot_path_indexes(schema):
+    schema.create_index('ix_user_query_user_question_type', 'user_query',
+                        ['user_id', 'question_id', 'query_type', 'created_at'])
+    schema.create_index('ix_user_query_user_created', 'user_query', ['user_id', 'created_at'])
+    schema.create_index('ix_explanation_question_generated', 'explanation', ['question_id', 'generated_at'])
+    schema.create_index('ix_student_answer_user_created', 'student_answer', ['user_id', 'created_at'])
+    schema.create_index('ix_question_paper_number', 'question', ['paper_id', 'question_number'])
+    schema.create_index('ix_question_paper_category', 'question_paper', ['category_id'])
+    schema.create_index('ix_credit_transaction_stripe_payment', 'credit_transaction', ['stripe_payment_id'])
+
+
+@migration('0004_unique_question_explanation', "Keep one explanation per question")
+def _unique_question_explanation(schema):
+    # Concurrent requests used to store an explanation each; keep the latest one.
+    # Duplicates inserted while the index builds fail the build, and running the
+    # migration again removes them first.
+    removed = schema.conn.execute(text(
+        "DELETE FROM explanation WHERE id NOT IN "
+        "(SELECT MAX(id) FROM explanation GROUP BY question_id)"
+    )).rowcount
+    if removed:
+        logger.info(f"Removed {removed} duplicate question explanations")
+    schema.create_index('uq_explanation_question', 'explanation', ['question_id'], unique=True)
+
+
+def applied_migrations():
+    """Ids of the migrations recorded as applied to this database"""
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    with db.engine.connect() as conn:
+        return {row.id for row in conn.execute(SchemaMigration.__table__.select())}
+
+
+def pending_migrations():
+    """
+    Migrations not yet applied, in order
+
+    Returns:
+        list: (id, description) pairs
+    """
+    applied = applied_migrations()
+    return [(migration_id, description) for migration_id, description, _ in MIGRATIONS
+            if migration_id not in applied]
+
+
+def apply_migrations(dry_run=False):
+    """
+    Apply the pending migrations in order
+
+    Args:
+        dry_run: Only report which migrations would run
+
+    Returns:
+        list: Ids of the migrations applied (or that would be applied)
+    """
+    applied = []
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        postgres = conn.dialect.name == 'postgresql'
+        if postgres:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': MIGRATION_ADVISORY_LOCK})
+        try:
+            # Read under the lock, so a migration another process just applied is skipped
+            done = applied_migrations()
+            schema = SchemaEditor(conn)
+            for migration_id, description, function in MIGRATIONS:
+                if migration_id in done:
+                    continue
+                if dry_run:
+                    logger.info(f"Would apply {migration_id}: {description}")
+                    applied.append(migration_id)
+                    continue
+                logger.info(f"Applying {migration_id}: {description}")
+                started = time.monotonic()
+                function(schema)
+                conn.execute(SchemaMigration.__table__.insert().values(
+                    id=migration_id,
+                    description=description,
+                    applied_at=datetime.utcnow(),
+                    duration_ms=int((time.monotonic() - started) * 1000)
+                ))
+                applied.append(migration_id)
+        finally:
+            if postgres:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': MIGRATION_ADVISORY_LOCK})
+    return applied
@@ -0,0 +1,210 @@
+"""
+Placeholders for question images that cannot be found, and a record of them.
+
+Rendering a placeholder (a new PIL image, text drawing and PNG encoding) for
+every view of a paper with missing images costs far more CPU than serving a
+real file, and a crawler can trigger it without limit. Rendered placeholders
+are therefore memoized in a bounded LRU cache keyed by (paper, question
+number, message) and served with an ETag and a short max-age.
+
+Every miss is also counted in the MissingAsset table, so admins can see
+which images need to be re-uploaded. Counts are collected in memory and
+written by a background thread every MISSING_ASSET_FLUSH_SECONDS, and once
+more when the process exits. The request that misses never waits for the
+database.
+
+Sample images stand in for missing ones where available. Which sample a
+question number gets is remembered for SAMPLE_IMAGE_TTL seconds, so samples
+added (or removed) while the app runs are noticed.
+"""
+import io
+import os
+import time
+import atexit
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+from sqlalchemy import update, delete
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import MissingAsset
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_CACHE_SIZE = int(os.environ.get('PLACEHOLDER_CACHE_SIZE', 256))
+# Short, so a re-uploaded image shows up soon even on the unversioned URL
+PLACEHOLDER_MAX_AGE = int(os.environ.get('PLACEHOLDER_MAX_AGE', 300))
+MISSING_ASSET_FLUSH_SECONDS = float(os.environ.get('MISSING_ASSET_FLUSH_SECONDS', 30))
+# Seconds a sample image lookup is remembered
+SAMPLE_IMAGE_TTL = float(os.environ.get('SAMPLE_IMAGE_TTL', 300))
+
+# Shown for any question when there is no sample for its number
+DEFAULT_SAMPLE_IMAGES = (
+    "./data/questions/paper_1/question_q1_703866-q1.png",
+    "./data/papers/sample_math_paper.png",
+)
+
+
+@lru_cache(maxsize=PLACEHOLDER_CACHE_SIZE)
+def render_placeholder(paper_id, question_num, message):
+    """
+    Render the text placeholder shown instead of a missing question image
+
+    Returns:
+        tuple: (PNG bytes, ETag)
+    """
+    img = Image.new('RGB', (800, 600), color=(40, 40, 45))
+    d = ImageDraw.Draw(img)
+
+    # Try to get a font, fall back to default if not available
+    try:
+        font = ImageFont.truetype("arial.ttf", 24)
+        small_font = ImageFont.truetype("arial.ttf", 18)
+    except IOError:
+        font = ImageFont.load_default()
+        small_font = ImageFont.load_default()
+
+    d.text((50, 50), f"Question {question_num}", fill=(255, 255, 255), font=font)
+    d.text((50, 100), f"Paper ID: {paper_id}", fill=(255, 255, 255), font=small_font)
+    d.text((50, 150), message, fill=(255, 170, 50), font=small_font)
+
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    png = buf.getvalue()
+    return png, hashlib.sha256(png).hexdigest()[:32]
+
+
+def _sample_paths(question_num):
+    """Sample images for a question number ('q3' or '3'), most specific first"""
+    try:
+        q_num = int(str(question_num or '').replace('q', ''))
+    except ValueError:
+        return []
+    # Allow sample fallback for any paper ID when actual images don't exist
+    if not 0 < q_num <= 12:
+        return []
+    paths = [
+        os.path.join('./attached_assets', f"703866-q{q_num}.png"),
+        f"./attached_assets/q{q_num}.png",
+        f"./attached_assets/question{q_num}.png",
+        f"./static/images/sample_q{q_num}.png"
+    ]
+    if q_num <= 4:
+        paths.append(f"./data/questions/paper_1/question_q{q_num}_703866-q{q_num}.png")
+    return paths
+
+
+# (question_num, use_default) -> (sample path or None, time looked up)
+_sample_images = {}
+
+
+def find_sample_image(question_num, use_default=False):
+    """
+    Sample image shown for a question whose own image is missing
+
+    Args:
+        question_num: The question number, e.g. 'q3'
+        use_default: Fall back to a generic sample when there is none for this number
+
+    Returns:
+        str: Path of the sample, or None
+    """
+    key = (question_num, use_default)
+    cached = _sample_images.get(key)
+    if cached and time.monotonic() - cached[1] < SAMPLE_IMAGE_TTL:
+        return cached[0]
+    candidates = _sample_paths(question_num) + (list(DEFAULT_SAMPLE_IMAGES) if use_default else [])
+    path = next((path for path in candidates if os.path.isfile(path)), None)
+    if len(_sample_images) >= PLACEHOLDER_CACHE_SIZE:
+        _sample_images.clear()
+    _sample_images[key] = (path, time.monotonic())
+    return path
+
+
+class MissingAssetRecorder:
+    """Counts missing-image requests in memory and writes them to MissingAsset in the background"""
+
+    def __init__(self, flush_interval=MISSING_ASSET_FLUSH_SECONDS):
+        self.flush_interval = flush_interval
+        # question_id -> [paper_id, image_path, hits, last_seen]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._engine = None
+        self._thread = None
+
+    def record(self, question):
+        """Count one request for a question whose image is missing"""
+        now = datetime.utcnow()
+        with self._lock:
+            entry = self._pending.get(question.id)
+            if entry:
+                entry[2] += 1
+                entry[3] = now
+            else:
+                self._pending[question.id] = [question.paper_id, question.image_path, 1, now]
+            # Started on first use, so each gunicorn worker gets its own after forking
+            if self._thread is None or not self._thread.is_alive():
+                if self._engine is None:
+                    atexit.register(self._flush_at_exit)
+                self._engine = db.engine
+                self._thread = threading.Thread(
+                    target=self._flush_periodically, name='missing-asset-flusher', daemon=True
+                )
+                self._thread.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._pending:
+                self.flush(self._engine)
+
+    def _flush_at_exit(self):
+        if self._pending:
+            self.flush(self._engine)
+
+    def flush(self, engine):
+        """Write the pending counts (runs on a background thread, so it takes the engine explicitly)"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        table = MissingAsset.__table__
+        try:
+            for question_id, (paper_id, image_path, hits, last_seen) in pending.items():
+                with engine.begin() as conn:
+                    updated = conn.execute(
+                        update(table).where(table.c.question_id == question_id).values(
+                            hit_count=table.c.hit_count + hits, last_seen=last_seen, image_path=image_path
+                        )
+                    ).rowcount
+                    if updated:
+                        continue
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(table.insert().values(
+                            question_id=question_id, paper_id=paper_id, image_path=image_path,
+                            hit_count=hits, first_seen=last_seen, last_seen=last_seen
+                        ))
+                except IntegrityError:
+                    # Another worker inserted it first, or the question was deleted
+                    with engine.begin() as conn:
+                        conn.execute(
+                            update(table).where(table.c.question_id == question_id)
+                            .values(hit_count=table.c.hit_count + hits, last_seen=last_seen)
+                        )
+        except Exception as e:
+            logger.warning(f"Could not record missing question images: {str(e)}")
+
+
+# Shared recorder for this process
+missing_assets = MissingAssetRecorder()
+
+
+def clear_missing_asset(question_id):
+    """Forget a recorded miss once the question has an image again"""
+    table = MissingAsset.__table__
+    with db.engine.begin() as conn:
+        conn.execute(delete(table).where(table.c.question_id == question_id))
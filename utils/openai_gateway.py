@@ -0,0 +1,470 @@
+"""
+Single entry point for OpenAI chat completion calls.
+
+Every call site goes through chat_completion() / chat_completion_async() so
+retry behaviour is consistent across the app:
+- the OpenAI clients are created with max_retries=0 and the gateway owns retries,
+- errors are classified by exception type and HTTP status, not by message text,
+- retries wait with decorrelated jitter, or for the server's Retry-After if given,
+- each request has an overall deadline that bounds attempts and back-off sleeps,
+- a process-wide circuit breaker fails fast while OpenAI is degraded instead of
+  letting every worker block on timeouts and retry in lock-step,
+- a cross-worker rate limiter (utils/rate_limiter.py) queues calls before they
+  would exceed the account's RPM/TPM budget; after a 429 it pauses every worker
+  instead of each one sleeping on its own.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import openai as openai_sdk
+from openai import OpenAI, AsyncOpenAI
+
+from utils.rate_limiter import rate_limiter, estimate_tokens, RateLimitQueueTimeout
+from utils.openai_telemetry import CallTelemetry
+
+logger = logging.getLogger(__name__)
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+
+# Per-attempt HTTP timeout (seconds)
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', 60))
+# Overall budget for one logical request, including retries and back-off
+OPENAI_REQUEST_DEADLINE = float(os.environ.get('OPENAI_REQUEST_DEADLINE', 100))
+OPENAI_MAX_ATTEMPTS = int(os.environ.get('OPENAI_MAX_ATTEMPTS', 4))
+# Decorrelated jitter bounds (seconds)
+OPENAI_BACKOFF_BASE = float(os.environ.get('OPENAI_BACKOFF_BASE', 1.0))
+OPENAI_BACKOFF_CAP = float(os.environ.get('OPENAI_BACKOFF_CAP', 20.0))
+# Circuit breaker: open after this many consecutive upstream failures, probe again after the cooldown
+OPENAI_BREAKER_THRESHOLD = int(os.environ.get('OPENAI_BREAKER_THRESHOLD', 5))
+OPENAI_BREAKER_COOLDOWN = float(os.environ.get('OPENAI_BREAKER_COOLDOWN', 30))
+
+# Retries are handled by the gateway; client-level retries would multiply the attempts
+openai_client = OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=0)
+async_openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=0)
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling OpenAI while the circuit breaker is open"""
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a request's deadline leaves no time for another attempt"""
+
+
+def is_retryable(error):
+    """Check whether an OpenAI error is transient and worth retrying"""
+    if isinstance(error, (openai_sdk.APITimeoutError, openai_sdk.APIConnectionError, RateLimitQueueTimeout)):
+        return True
+    if isinstance(error, openai_sdk.RateLimitError):
+        # An exhausted quota will not recover by retrying
+        return getattr(error, 'code', None) != 'insufficient_quota'
+    if isinstance(error, openai_sdk.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def is_upstream_failure(error):
+    """Check whether an error indicates OpenAI itself is degraded (counted by the circuit breaker)"""
+    if isinstance(error, (openai_sdk.APITimeoutError, openai_sdk.APIConnectionError)):
+        return True
+    if isinstance(error, openai_sdk.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+
+def get_retry_after(error):
+    """
+    Read the server's requested wait from a failed response
+
+    Returns:
+        float: Seconds to wait, or None if the response did not say
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Process-wide circuit breaker shared by every OpenAI call in this process"""
+
+    def __init__(self, failure_threshold=OPENAI_BREAKER_THRESHOLD, cooldown=OPENAI_BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now):
+        if self._opened_at is None:
+            return 'closed'
+        if now - self._opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if calls should currently fail fast
+
+        Returns:
+            bool: True if this call is the half-open probe; it must end in
+                record_success, record_failure or abandon_probe
+        """
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == 'closed':
+                return False
+            if state == 'half_open' and not self._probe_in_flight:
+                # Let a single request through to test whether OpenAI has recovered
+                self._probe_in_flight = True
+                logger.info("OpenAI circuit breaker half-open, sending probe request")
+                return True
+            retry_in = max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError(
+            f"The AI service is temporarily unavailable (circuit breaker open, retry in {retry_in:.0f}s)"
+        )
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("OpenAI circuit breaker closed")
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def abandon_probe(self):
+        """
+        Release the probe of a call that ended without an outcome (cancelled, or
+        the client disconnected), so the next call can probe instead
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self, error):
+        """Count an upstream failure; errors caused by the request itself are ignored"""
+        with self._lock:
+            self._probe_in_flight = False
+            if not is_upstream_failure(error):
+                return
+            self._consecutive_failures += 1
+            if self._opened_at is not None or self._consecutive_failures >= self.failure_threshold:
+                # (Re-)open: either the threshold was reached or the half-open probe failed
+                self._opened_at = time.monotonic()
+                logger.error(
+                    f"OpenAI circuit breaker opened after {self._consecutive_failures} consecutive failures, "
+                    f"failing fast for {self.cooldown:.0f}s"
+                )
+
+
+circuit_breaker = CircuitBreaker()
+
+
+class _RetryPolicy:
+    """Tracks attempts, back-off and the deadline for one logical request"""
+
+    def __init__(self, deadline, max_attempts):
+        self.deadline_at = time.monotonic() + (deadline or OPENAI_REQUEST_DEADLINE)
+        self.max_attempts = max_attempts or OPENAI_MAX_ATTEMPTS
+        self.attempt = 0
+        self._sleep = OPENAI_BACKOFF_BASE
+
+    def remaining(self):
+        return self.deadline_at - time.monotonic()
+
+    def attempt_timeout(self):
+        """HTTP timeout for the next attempt, never past the deadline"""
+        remaining = self.remaining()
+        if remaining <= 1.0:
+            raise DeadlineExceededError("OpenAI request deadline exceeded (timeout)")
+        return min(OPENAI_TIMEOUT, remaining)
+
+    def next_delay(self, error):
+        """
+        Decide whether to retry after an error
+
+        Returns:
+            float: Seconds to wait before the next attempt, or None to give up
+        """
+        if self.attempt >= self.max_attempts or not is_retryable(error):
+            return None
+
+        # Decorrelated jitter: spreads retries out so workers do not retry in lock-step
+        self._sleep = min(OPENAI_BACKOFF_CAP, random.uniform(OPENAI_BACKOFF_BASE, self._sleep * 3))
+        delay = self._sleep
+
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = retry_after
+
+        # Give up now rather than sleep past the deadline
+        if delay >= self.remaining() - 1.0:
+            return None
+        return delay
+
+
+def _log_retry(policy, error, delay):
+    logger.warning(
+        f"OpenAI request failed (attempt {policy.attempt}/{policy.max_attempts}, "
+        f"{type(error).__name__}: {error}); retrying in {delay:.1f}s"
+    )
+
+
+def _log_give_up(policy, error):
+    if is_retryable(error):
+        logger.error(f"OpenAI request failed after {policy.attempt} attempts: {error}")
+    else:
+        logger.error(f"Non-retryable OpenAI error ({type(error).__name__}): {error}")
+
+
+def _handle_failure(policy, model, error):
+    """
+    Record a failed attempt and decide what to do next
+
+    Returns:
+        float: Seconds to wait before retrying, or None to give up
+    """
+    circuit_breaker.record_failure(error)
+    delay = policy.next_delay(error)
+    if delay is None:
+        _log_give_up(policy, error)
+        return None
+    if isinstance(error, openai_sdk.RateLimitError) and rate_limiter.enabled:
+        # Pause every worker through the shared buckets; the next acquire() queues until they refill
+        rate_limiter.drain(model, get_retry_after(error))
+        delay = 0.0
+    _log_retry(policy, error, delay)
+    return delay
+
+
+def _usage_tokens(response):
+    usage = getattr(response, 'usage', None)
+    return usage.total_tokens if usage else None
+
+
+def _estimate_tokens(messages, max_tokens):
+    """Token estimate for the rate limiter; skipped (it reads every image's header) when unused"""
+    return estimate_tokens(messages, max_tokens) if rate_limiter.counts_tokens else 0
+
+
+def chat_completion(messages, model="gpt-4o", max_tokens=1000, temperature=0.7, deadline=None, max_attempts=None,
+                    prompt_version=None):
+    """
+    Create a chat completion with retries, a deadline and the circuit breaker
+
+    Args:
+        messages: Chat messages to send
+        model: Model name
+        max_tokens: Maximum number of tokens to generate
+        temperature: Sampling temperature
+        deadline: Overall time budget in seconds (defaults to OPENAI_REQUEST_DEADLINE)
+        max_attempts: Maximum number of attempts (defaults to OPENAI_MAX_ATTEMPTS)
+        prompt_version: Recorded with the call's telemetry
+
+    Returns:
+        ChatCompletion: The OpenAI response object
+
+    Raises:
+        CircuitOpenError, DeadlineExceededError, or the last OpenAI error
+    """
+    policy = _RetryPolicy(deadline, max_attempts)
+    telemetry = CallTelemetry(model, prompt_version)
+    estimated_tokens = _estimate_tokens(messages, max_tokens)
+    try:
+        while True:
+            telemetry.queue_wait += rate_limiter.acquire(model, estimated_tokens, max_wait=policy.remaining() - 1.0)
+            timeout = policy.attempt_timeout()
+            probe = circuit_breaker.before_call()
+            policy.attempt += 1
+            try:
+                response = openai_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    timeout=timeout
+                )
+            except Exception as e:
+                delay = _handle_failure(policy, model, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                if probe:
+                    circuit_breaker.abandon_probe()
+                raise
+            break
+    except Exception as e:
+        telemetry.record(policy.attempt, error=e)
+        raise
+
+    circuit_breaker.record_success()
+    rate_limiter.record_usage(model, estimated_tokens, _usage_tokens(response))
+    telemetry.record(policy.attempt, usage=response.usage)
+    return response
+
+
+async def chat_completion_async(messages, model="gpt-4o", max_tokens=1000, temperature=0.7, deadline=None,
+                                max_attempts=None, prompt_version=None):
+    """
+    Async variant of chat_completion used by the background AI job workers
+
+    Returns:
+        ChatCompletion: The OpenAI response object
+    """
+    policy = _RetryPolicy(deadline, max_attempts)
+    telemetry = CallTelemetry(model, prompt_version)
+    estimated_tokens = _estimate_tokens(messages, max_tokens)
+    try:
+        while True:
+            telemetry.queue_wait += await rate_limiter.acquire_async(
+                model, estimated_tokens, max_wait=policy.remaining() - 1.0
+            )
+            timeout = policy.attempt_timeout()
+            probe = circuit_breaker.before_call()
+            policy.attempt += 1
+            try:
+                response = await async_openai_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    timeout=timeout
+                )
+            except Exception as e:
+                delay = await asyncio.to_thread(_handle_failure, policy, model, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # The job was cancelled while the call was in flight
+                if probe:
+                    circuit_breaker.abandon_probe()
+                raise
+            break
+    except Exception as e:
+        await asyncio.to_thread(telemetry.record, policy.attempt, error=e)
+        raise
+
+    circuit_breaker.record_success()
+    await asyncio.to_thread(rate_limiter.record_usage, model, estimated_tokens, _usage_tokens(response))
+    await asyncio.to_thread(telemetry.record, policy.attempt, usage=response.usage)
+    return response
+
+
+def stream_chat_completion(messages, model="gpt-4o", max_tokens=1000, temperature=0.7, deadline=None,
+                           max_attempts=None, prompt_version=None):
+    """
+    Stream a chat completion, yielding text as it arrives
+
+    Failures before the first chunk are retried like chat_completion; once text
+    has been yielded a failure is raised to the caller, since retrying would
+    repeat output the client has already seen.
+
+    Yields:
+        str: Text deltas
+    """
+    policy = _RetryPolicy(deadline, max_attempts)
+    telemetry = CallTelemetry(model, prompt_version, streamed=True)
+    estimated_tokens = _estimate_tokens(messages, max_tokens)
+    try:
+        while True:
+            telemetry.queue_wait += rate_limiter.acquire(model, estimated_tokens, max_wait=policy.remaining() - 1.0)
+            timeout = policy.attempt_timeout()
+            probe = circuit_breaker.before_call()
+            policy.attempt += 1
+            try:
+                stream = openai_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    timeout=timeout,
+                    stream=True,
+                    stream_options={"include_usage": True}  # Final chunk reports usage for the limiter and telemetry
+                )
+                chunks = iter(stream)
+                first_chunk = next(chunks, None)
+            except Exception as e:
+                delay = _handle_failure(policy, model, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                if probe:
+                    circuit_breaker.abandon_probe()
+                raise
+            break
+    except Exception as e:
+        telemetry.record(policy.attempt, error=e)
+        raise
+
+    telemetry.mark_first_token()
+    usage = None
+    try:
+        if first_chunk is not None:
+            for chunk in _prepend(first_chunk, chunks):
+                usage = getattr(chunk, 'usage', None) or usage
+                text = _chunk_text(chunk)
+                if text:
+                    yield text
+    except BaseException as e:
+        # Includes GeneratorExit when the client disconnects mid-stream
+        if isinstance(e, Exception):
+            circuit_breaker.record_failure(e)
+            logger.error(f"OpenAI stream failed mid-response ({type(e).__name__}): {e}")
+        elif probe:
+            # A disconnect says nothing about OpenAI's health
+            circuit_breaker.abandon_probe()
+        telemetry.record(policy.attempt, usage=usage, error=e)
+        raise
+    circuit_breaker.record_success()
+    rate_limiter.record_usage(model, estimated_tokens, usage.total_tokens if usage else None)
+    telemetry.record(policy.attempt, usage=usage)
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
+
+
+def _chunk_text(chunk):
+    if not chunk.choices:
+        return ''
+    return chunk.choices[0].delta.content or ''
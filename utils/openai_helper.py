@@ -1,10 +1,14 @@
 import os
 import json
-import time
+import asyncio
 import logging
 import requests  # For HTTP operations
 import re  # For regex pattern matching
-from openai import OpenAI
+from utils.openai_gateway import (
+    openai_client, async_openai_client, chat_completion, chat_completion_async,
+    stream_chat_completion, is_retryable
+)
+from utils.image_preparation import prepare_vision_image, decode_image_data
 import base64
 
 # Get your API key from the environment variable
@@ -18,17 +22,23 @@ else:
     logger = logging.getLogger(__name__)
     logger.error("OpenAI API key is missing or empty!")
 
-# Configure OpenAI client with additional timeout parameters
-openai = OpenAI(
-    api_key=OPENAI_API_KEY,
-    timeout=60.0,  # Longer timeout
-    max_retries=3  # More retries
-)
+# Shared OpenAI clients; all chat completions go through utils/openai_gateway.py,
+# which owns retries, deadlines and the circuit breaker
+openai = openai_client
+async_openai = async_openai_client
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Model and prompt version used for question explanations. Bump the prompt
+# version whenever the explanation prompt changes so cached explanations
+# generated with the old prompt are no longer served.
+EXPLANATION_MODEL = "gpt-4o"
+EXPLANATION_PROMPT_VERSION = "explanation-v1"
+# Recorded with each answer feedback call's telemetry
+ANSWER_FEEDBACK_PROMPT_VERSION = "answer-feedback-v1"
+
 def check_openai_key():
     """
     Check if OpenAI API key is configured
@@ -42,7 +52,8 @@ def check_openai_key():
         return None
     return api_key
 
-def call_openai_with_retry(model="gpt-4o", messages=None, max_tokens=1000, temperature=0.7, detailed_error=False):
+def call_openai_with_retry(model="gpt-4o", messages=None, max_tokens=1000, temperature=0.7, detailed_error=False,
+                           prompt_version=None):
     """
     Call OpenAI API with retry logic for handling rate limits and timeouts
     
@@ -52,6 +63,7 @@ def call_openai_with_retry(model="gpt-4o", messages=None, max_tokens=1000, tempe
         max_tokens (int): Maximum number of tokens to generate
         temperature (float): Temperature for the completion
         detailed_error (bool): Whether to return detailed error messages
+        prompt_version (str): Recorded with the call's telemetry
     
     Returns:
         dict: The API response or error details
@@ -64,67 +76,61 @@ def call_openai_with_retry(model="gpt-4o", messages=None, max_tokens=1000, tempe
     if not api_key:
         return {"error": "OpenAI API key is not configured"}
     
-    # Retry parameters
-    max_retries = 3
-    retry_count = 0
-    backoff_time = 2.0  # Initial backoff time in seconds
+    try:
+        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+        # do not change this unless explicitly requested by the user
+        response = chat_completion(
+            messages,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            prompt_version=prompt_version
+        )
+        # Convert to dict for consistency
+        return response.model_dump()
+        
+    except Exception as e:
+        return _api_error_response(e, detailed_error)
+
+def _api_error_response(e, detailed_error):
+    """Build the error dict returned by call_openai_with_retry / call_openai_async"""
+    error_message = str(e).lower()
+    error_type = type(e).__name__
+    logger.error(f"OpenAI API error ({error_type}): {error_message}")
     
-    while retry_count < max_retries:
-        try:
-            # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-            # do not change this unless explicitly requested by the user
-            response = openai.chat.completions.create(
-                model=model,
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
-            # Convert to dict for consistency
-            return response.model_dump()
-            
-        except Exception as e:
-            retry_count += 1
-            error_message = str(e).lower()
-            error_type = type(e).__name__
-            
-            # Log the error
-            logger.error(f"OpenAI API error ({error_type}): {error_message}")
-            
-            # Check for retryable errors
-            retryable = (
-                "rate limit" in error_message or 
-                "ratelimit" in error_message or
-                "timeout" in error_message or
-                "capacity" in error_message or
-                "overloaded" in error_message or
-                "internal server error" in error_message or
-                "503" in error_message or
-                "502" in error_message
-            )
-            
-            if retry_count < max_retries and retryable:
-                logger.warning(f"Retryable error, attempt {retry_count}/{max_retries}. Retrying in {backoff_time}s...")
-                time.sleep(backoff_time)
-                backoff_time *= 2  # Exponential backoff
-            else:
-                # Either non-retryable or max retries exceeded
-                if retry_count >= max_retries:
-                    logger.error(f"Maximum retries ({max_retries}) exceeded")
-                else:
-                    logger.error(f"Non-retryable error")
-                
-                if detailed_error:
-                    return {
-                        "error": f"OpenAI API error: {error_message}",
-                        "error_type": error_type,
-                        "retryable": retryable,
-                        "attempts": retry_count
-                    }
-                else:
-                    return {"error": "Failed to generate response from OpenAI API"}
-    
-    # Should not reach here, but just in case
-    return {"error": "Unknown error in OpenAI API call"}
+    if detailed_error:
+        return {
+            "error": f"OpenAI API error: {error_message}",
+            "error_type": error_type,
+            "retryable": is_retryable(e)
+        }
+    return {"error": "Failed to generate response from OpenAI API"}
+
+async def call_openai_async(model="gpt-4o", messages=None, max_tokens=1000, temperature=0.7, detailed_error=False,
+                            prompt_version=None):
+    """
+    Async variant of call_openai_with_retry used by the background AI job workers
+    
+    Returns:
+        dict: The API response or error details
+    """
+    if not messages:
+        return {"error": "No messages provided"}
+    
+    if not check_openai_key():
+        return {"error": "OpenAI API key is not configured"}
+    
+    try:
+        response = await chat_completion_async(
+            messages,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            prompt_version=prompt_version
+        )
+        return response.model_dump()
+    except Exception as e:
+        return _api_error_response(e, detailed_error)
 
 def test_openai_connection():
     """
@@ -154,13 +160,14 @@ def test_openai_connection():
             
             try:
                 # Simple text completion with a smaller model for basic testing
-                response = openai.chat.completions.create(
-                    model="gpt-3.5-turbo",  # Use a simpler model for testing
-                    messages=[
+                response = chat_completion(
+                    [
                         {"role": "system", "content": "You are a helpful assistant."},
                         {"role": "user", "content": "Say hello world!"}
                     ],
-                    max_tokens=5
+                    model="gpt-3.5-turbo",  # Use a simpler model for testing
+                    max_tokens=5,
+                    prompt_version="connection-test"
                 )
                 
                 # Extract the response
@@ -178,9 +185,9 @@ def test_openai_connection():
         logger.error(f"OpenAI test failed: {error_message}")
         return False, f"OpenAI connection failed: {error_message}"
 
-def generate_answer_feedback(question_image, answer_image, subject, combined_image=False):
+def build_answer_feedback_messages(question_image, answer_image, subject, combined_image=False):
     """
-    Generate feedback for a student's answer to a question using OpenAI's GPT-4o model
+    Build the chat messages used to evaluate a student's answer
     
     Args:
         question_image: Data URI of the question image (or combined image with both question and answer)
@@ -189,10 +196,9 @@ def generate_answer_feedback(question_image, answer_image, subject, combined_ima
         combined_image: Boolean indicating if question_image contains both question and answer
     
     Returns:
-        Dictionary containing feedback, explanation, tips, and score
+        list: Messages ready to send to the chat completions API
     """
     subject = subject.lower().strip()
-    logger.info(f"Generating answer feedback for {subject} {'from combined image' if combined_image else 'from separate images'}")
     
     # Create a system prompt for analyzing student answers
     base_prompt = f"""
@@ -256,155 +262,201 @@ Always use proper LaTeX notation for mathematical expressions, formulas and equa
 Be encouraging but realistic in your feedback, just like a real teacher would mark an A-Level paper.
 """
 
-    try:
-        logger.info(f"Processing student answer for {subject} feedback")
-        
-        # Prepare content array based on whether we have a combined image or separate images
-        if combined_image:
-            # For combined image mode, we only need to validate question_image
-            if not question_image:
-                raise ValueError("Question image (combined with answer) is required")
-                
-            # Create content array with just the combined image
-            content = [
-                {"type": "text", "text": f"Please analyze this {subject} question and the student's handwritten answer in this single image:"},
-                {"type": "image_url", "image_url": {"url": question_image}}
-            ]
-            
-            logger.info("Calling OpenAI API with combined question and answer image")
-        else:
-            # For separate images mode, validate both images
-            if not question_image or not answer_image:
-                raise ValueError("Both question and answer images are required for separate image mode")
-            
-            # Create content array with both images
-            content = [
-                {"type": "text", "text": f"Please analyze this {subject} question and the student's handwritten answer:"},
-                {"type": "text", "text": "QUESTION IMAGE:"},
-                {"type": "image_url", "image_url": {"url": question_image}},
-                {"type": "text", "text": "STUDENT'S ANSWER:"},
-                {"type": "image_url", "image_url": {"url": answer_image}}
-            ]
+    # Prepare content array based on whether we have a combined image or separate images
+    if combined_image:
+        # For combined image mode, we only need to validate question_image
+        if not question_image:
+            raise ValueError("Question image (combined with answer) is required")
             
-            logger.info("Calling OpenAI API with separate question and answer images")
+        # Create content array with just the combined image
+        content = [
+            {"type": "text", "text": f"Please analyze this {subject} question and the student's handwritten answer in this single image:"},
+            {"type": "image_url", "image_url": prepare_vision_image(question_image)}
+        ]
+    else:
+        # For separate images mode, validate both images
+        if not question_image or not answer_image:
+            raise ValueError("Both question and answer images are required for separate image mode")
         
-        # Make the API call to OpenAI with retry logic for rate limiting and timeouts
-        max_retries = 3
-        retry_count = 0
-        backoff_time = 2.0  # Initial backoff time in seconds
-        response = None
+        # Create content array with both images
+        content = [
+            {"type": "text", "text": f"Please analyze this {subject} question and the student's handwritten answer:"},
+            {"type": "text", "text": "QUESTION IMAGE:"},
+            {"type": "image_url", "image_url": prepare_vision_image(question_image)},
+            {"type": "text", "text": "STUDENT'S ANSWER:"},
+            {"type": "image_url", "image_url": prepare_vision_image(answer_image)}
+        ]
+    
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": content}
+    ]
+
+def parse_answer_feedback(response_text):
+    """
+    Split a markdown-formatted feedback response into its sections
+    
+    Args:
+        response_text: Raw text returned by the model
+    
+    Returns:
+        Dictionary containing feedback, explanation, tips, and score
+    """
+    # Extract the different sections from the markdown-formatted text
+    sections = {
+        'feedback': '',
+        'explanation': '',
+        'tips': '',
+        'score': '3/5 Marks'  # Default score using mark-based grading
+    }
+    
+    # Simple text parsing by section headers
+    current_section = None
+    section_content = []
+    
+    for line in response_text.split('\n'):
+        if line.startswith('## Feedback'):
+            current_section = 'feedback'
+            section_content = []
+        elif line.startswith('## Explanation'):
+            if current_section:
+                sections[current_section] = '\n'.join(section_content).strip()
+            current_section = 'explanation'
+            section_content = []
+        elif line.startswith('## Tips'):
+            if current_section:
+                sections[current_section] = '\n'.join(section_content).strip()
+            current_section = 'tips'
+            section_content = []
+        elif line.startswith('## Score'):
+            if current_section:
+                sections[current_section] = '\n'.join(section_content).strip()
+            current_section = 'score'
+            section_content = []
+        elif current_section:
+            section_content.append(line)
+            
+            # Look for a score pattern in the score section
+            if current_section == 'score' and ('/' in line or 'mark' in line.lower() or 'marks' in line.lower()):
+                # Try to extract X/Y pattern
+                score_match = re.search(r'(\d+)/(\d+)', line)
+                if score_match:
+                    # Display as marks rather than stars to be more like a teacher's marking
+                    sections['score'] = f"{score_match.group(1)}/{score_match.group(2)} Marks"
+    
+    # Add the last section
+    if current_section:
+        sections[current_section] = '\n'.join(section_content).strip()
         
-        while retry_count < max_retries:
-            try:
-                # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-                # do not change this unless explicitly requested by the user
-                response = openai.chat.completions.create(
-                    model="gpt-4o",  # Using the latest GPT-4o model which supports vision
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": content}
-                    ],
-                    max_tokens=1500,
-                    temperature=0.3  # Lower temperature for more consistent responses
-                )
-                # If we reach here, the request was successful
-                break
-                
-            except Exception as retry_error:
-                retry_count += 1
-                error_message = str(retry_error).lower()
-                
-                # Only retry on certain error types
-                if (retry_count < max_retries and 
-                    ("rate limit" in error_message or 
-                     "ratelimit" in error_message or
-                     "timeout" in error_message or
-                     "capacity" in error_message or
-                     "overloaded" in error_message)):
-                    
-                    logger.warning(f"OpenAI API request failed (attempt {retry_count}/{max_retries}): {error_message}")
-                    logger.info(f"Retrying in {backoff_time} seconds...")
-                    time.sleep(backoff_time)
-                    backoff_time *= 2  # Exponential backoff
-                    continue
-                else:
-                    # Either we've reached max retries or this is not a retryable error
-                    if retry_count >= max_retries:
-                        logger.error(f"Maximum retries ({max_retries}) exceeded: {error_message}")
-                    else:
-                        logger.error(f"Non-retryable error: {error_message}")
-                    raise  # Re-raise the last exception
+    return sections
+
+def answer_feedback_prompt_version(layout=None):
+    """Prompt version recorded for an answer feedback call; tags the image layout being compared"""
+    return f"{ANSWER_FEEDBACK_PROMPT_VERSION}-{layout}" if layout else ANSWER_FEEDBACK_PROMPT_VERSION
+
+def generate_answer_feedback(question_image, answer_image, subject, combined_image=False, layout=None):
+    """
+    Generate feedback for a student's answer to a question using OpenAI's GPT-4o model
+    
+    Args:
+        question_image: Data URI of the question image (or combined image with both question and answer)
+        answer_image: Data URI of the student's answer image (None if combined_image=True)
+        subject: Subject of the question (e.g., "Mathematics", "Physics")
+        combined_image: Boolean indicating if question_image contains both question and answer
+        layout: 'separate' or 'composite' when the request is part of the image layout
+            comparison (see utils/answer_composite.py); recorded with the call's telemetry
+    
+    Returns:
+        Dictionary containing feedback, explanation, tips, and score
+    """
+    logger.info(f"Generating answer feedback for {subject} {'from combined image' if combined_image else 'from separate images'}")
+
+    try:
+        logger.info(f"Processing student answer for {subject} feedback")
+        messages = build_answer_feedback_messages(question_image, answer_image, subject, combined_image)
+        logger.info(f"Calling OpenAI API with {'combined question and answer image' if combined_image else 'separate question and answer images'}")
         
-        # Check if we got a response
-        if not response:
-            raise Exception("Failed to get a response from OpenAI after multiple attempts")
+        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+        # do not change this unless explicitly requested by the user
+        response = chat_completion(
+            messages,
+            model="gpt-4o",  # Using the latest GPT-4o model which supports vision
+            max_tokens=1500,
+            temperature=0.3,  # Lower temperature for more consistent responses
+            prompt_version=answer_feedback_prompt_version(layout)
+        )
         
         # Get the text response without JSON parsing
         response_text = response.choices[0].message.content
         logger.info(f"Received feedback response: {response_text[:100]}...")
         
-        # Extract the different sections from the markdown-formatted text
-        sections = {
-            'feedback': '',
-            'explanation': '',
-            'tips': '',
-            'score': '3/5 Marks'  # Default score using mark-based grading
-        }
+        return parse_answer_feedback(response_text)
         
-        # Simple text parsing by section headers
-        current_section = None
-        section_content = []
+    except Exception as e:
+        logger.error(f"Error generating answer feedback: {e}")
+        raise Exception(f"OpenAI API error: {str(e)}")
+
+def stream_answer_feedback(question_image, answer_image, subject, combined_image=False, layout=None):
+    """
+    Streaming variant of generate_answer_feedback
+    
+    Yields:
+        str: Text deltas of the markdown feedback; parse the joined text with parse_answer_feedback
+    """
+    logger.info(f"Streaming answer feedback for {subject} {'from combined image' if combined_image else 'from separate images'}")
+    messages = build_answer_feedback_messages(question_image, answer_image, subject, combined_image)
+    try:
+        yield from stream_chat_completion(
+            messages,
+            model="gpt-4o",
+            max_tokens=1500,
+            temperature=0.3,
+            prompt_version=answer_feedback_prompt_version(layout)
+        )
+    except Exception as e:
+        logger.error(f"Error streaming answer feedback: {e}")
+        raise Exception(f"OpenAI API error: {str(e)}")
+
+async def generate_answer_feedback_async(question_image, answer_image, subject, combined_image=False, layout=None):
+    """
+    Async variant of generate_answer_feedback used by the background AI job workers
+    
+    Returns:
+        Dictionary containing feedback, explanation, tips, and score
+    """
+    logger.info(f"Generating answer feedback (async) for {subject} {'from combined image' if combined_image else 'from separate images'}")
+    try:
+        # Decoding and resizing the images is CPU work; keep it off the event loop
+        messages = await asyncio.to_thread(
+            build_answer_feedback_messages, question_image, answer_image, subject, combined_image
+        )
         
-        for line in response_text.split('\n'):
-            if line.startswith('## Feedback'):
-                current_section = 'feedback'
-                section_content = []
-            elif line.startswith('## Explanation'):
-                if current_section:
-                    sections[current_section] = '\n'.join(section_content).strip()
-                current_section = 'explanation'
-                section_content = []
-            elif line.startswith('## Tips'):
-                if current_section:
-                    sections[current_section] = '\n'.join(section_content).strip()
-                current_section = 'tips'
-                section_content = []
-            elif line.startswith('## Score'):
-                if current_section:
-                    sections[current_section] = '\n'.join(section_content).strip()
-                current_section = 'score'
-                section_content = []
-            elif current_section:
-                section_content.append(line)
-                
-                # Look for a score pattern in the score section
-                if current_section == 'score' and ('/' in line or 'mark' in line.lower() or 'marks' in line.lower()):
-                    # Try to extract X/Y pattern
-                    score_match = re.search(r'(\d+)/(\d+)', line)
-                    if score_match:
-                        # Display as marks rather than stars to be more like a teacher's marking
-                        sections['score'] = f"{score_match.group(1)}/{score_match.group(2)} Marks"
+        response = await chat_completion_async(
+            messages,
+            model="gpt-4o",
+            max_tokens=1500,
+            temperature=0.3,
+            prompt_version=answer_feedback_prompt_version(layout)
+        )
         
-        # Add the last section
-        if current_section:
-            sections[current_section] = '\n'.join(section_content).strip()
-            
-        return sections
+        response_text = response.choices[0].message.content
+        logger.info(f"Received feedback response: {response_text[:100]}...")
+        return parse_answer_feedback(response_text)
         
     except Exception as e:
         logger.error(f"Error generating answer feedback: {e}")
         raise Exception(f"OpenAI API error: {str(e)}")
 
-def generate_explanation(base64_image, subject):
+def build_explanation_messages(base64_image, subject):
     """
-    Generate an explanation for a question using OpenAI's GPT-4o model
+    Validate the question image and build the chat messages used to explain it
     
     Args:
-        base64_image: Base64-encoded image of the question
+        base64_image: Base64-encoded image (or data URI) of the question, or a StoredVisionImage
         subject: Subject of the question (e.g., "Mathematics", "Physics")
     
     Returns:
-        Generated explanation text
+        list: Messages ready to send to the chat completions API
     """
     subject = subject.lower().strip()
     
@@ -423,157 +475,171 @@ Use clear headings (e.g., "## Step 1:") and numbered steps where appropriate.
 Your explanation should be comprehensive, explaining both the mathematical concepts and their application.
 """
 
-    try:
-        logger.info(f"Processing image for {subject} explanation")
-        
-        # Simplified handling of different input formats with better logging
-        if not isinstance(base64_image, str):
-            logger.error(f"Invalid image data type: {type(base64_image)}")
-            raise ValueError(f"Invalid image data type: {type(base64_image)}")
-            
-        logger.info(f"Image data length: {len(base64_image)} characters")
+    logger.info(f"Processing image for {subject} explanation")
+    
+    # Stored question images arrive already prepared (see utils/vision_payloads.py)
+    if hasattr(base64_image, 'vision_payload'):
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": [
+                {"type": "text", "text": f"Please explain this {subject} question in detail:"},
+                {"type": "image_url", "image_url": base64_image.vision_payload()}
+            ]}
+        ]
+    
+    if not isinstance(base64_image, str):
+        logger.error(f"Invalid image data type: {type(base64_image)}")
+        raise ValueError(f"Invalid image data type: {type(base64_image)}")
         
-        # Extract the base64 part from data URI if needed
-        if base64_image.startswith('data:image/'):
-            logger.info("Input has data URI format, extracting base64 portion")
-            try:
-                # Extract base64 part after the "base64," marker
-                image_parts = base64_image.split('base64,')
-                if len(image_parts) < 2:
-                    raise ValueError("Invalid data URI format: missing base64 data")
-                
-                # The second part is the actual base64 data
-                clean_base64 = image_parts[1]
-                logger.info(f"Successfully extracted base64 data: {len(clean_base64)} characters")
-                
-                # Reconstruct the data URI with the extracted part (in case there were format issues)
-                image_url = f"data:image/jpeg;base64,{clean_base64}"
-            except Exception as extract_error:
-                logger.error(f"Failed to extract base64 from data URI: {extract_error}")
-                raise ValueError(f"Invalid data URI format: {extract_error}")
-        else:
-            # Check if it's already a clean base64 string (no data URI prefix)
-            logger.info("Checking if input is a clean base64 string")
-            try:
-                # Validate it's decodable as base64 (just a sample)
-                test_decode = base64.b64decode(base64_image[:100] + "=" * ((4 - len(base64_image[:100]) % 4) % 4))
-                logger.info("Input appears to be clean base64 data")
-                image_url = f"data:image/jpeg;base64,{base64_image}"
-            except Exception as decode_error:
-                logger.error(f"Input is not valid base64 data: {decode_error}")
-                # Last attempt - maybe it has base64, but not at the beginning
-                if 'base64,' in base64_image:
-                    try:
-                        image_parts = base64_image.split('base64,')
-                        clean_base64 = image_parts[1]
-                        image_url = f"data:image/jpeg;base64,{clean_base64}"
-                        logger.info(f"Recovered base64 data from non-standard format: {len(clean_base64)} characters")
-                    except Exception as recovery_error:
-                        logger.error(f"Failed to recover base64 data: {recovery_error}")
-                        raise ValueError("Unable to process the provided image data")
-                else:
-                    raise ValueError("Image data is not in a recognizable format")
+    logger.info(f"Image data length: {len(base64_image)} characters")
+    
+    # Accepts a data URI, bare base64, or base64 after a non-standard prefix
+    try:
+        image_bytes, _ = decode_image_data(base64_image)
+    except Exception as decode_error:
+        logger.error(f"Input is not valid base64 data: {decode_error}")
+        raise ValueError("Image data is not in a recognizable format")
+    if len(image_bytes) < 64:
+        logger.error(f"Image data is too short: {len(image_bytes)} bytes")
+        raise ValueError("Processed image data is too short or empty")
+    
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": [
+            {"type": "text", "text": f"Please explain this {subject} question in detail:"},
+            {"type": "image_url", "image_url": prepare_vision_image(base64_image)}
+        ]}
+    ]
+
+def check_explanation_text(explanation):
+    """Reject empty model output and log a preview of a valid explanation"""
+    if not explanation or len(explanation) < 10:
+        logger.error(f"Received empty or very short explanation from OpenAI: '{explanation}'")
+        raise Exception("The AI returned an empty or insufficient response. Please try again.")
         
-        # Final validation check on the prepared URL
-        if not image_url or len(image_url) < 100:
-            logger.error(f"Final image URL is too short: {len(image_url) if image_url else 0} characters")
-            raise ValueError("Processed image data is too short or empty")
-            
-        logger.info(f"Final image URL prepared, total length: {len(image_url)} characters")
+    logger.info(f"Received explanation of length {len(explanation)} characters")
+    logger.info(f"Explanation preview: {explanation[:100]}...")
+    return explanation
+
+def _explanation_api_error(api_error):
+    """Translate an OpenAI API failure into a user-facing exception"""
+    logger.error(f"OpenAI API call failed: {api_error}")
+    error_str = str(api_error).lower()
+    
+    # Provide specific error messages based on different error patterns
+    if "api key" in error_str:
+        logger.error("API key authentication issue detected")
+        return Exception("OpenAI API key issue. Please check your API key configuration.")
+    elif "timeout" in error_str:
+        logger.error("Request timeout detected")
+        return Exception("The request timed out. The question might be too complex or the server is busy. Please try again.")
+    elif "rate limit" in error_str or "ratelimit" in error_str:
+        logger.error("Rate limit error detected")
+        return Exception("OpenAI rate limit reached. Please try again in a few moments.")
+    elif any(term in error_str for term in ["quota", "exceeded", "insufficient_quota", "429"]):
+        logger.error("Quota exceeded error detected")
+        return Exception("The AI service is temporarily unavailable due to exceeding usage limits. The administrator has been notified. Please try again later.")
+    elif "invalid" in error_str and ("format" in error_str or "image" in error_str):
+        logger.error("Invalid image format error detected")
+        return Exception("The image format is invalid or corrupted. Please try with a different image.")
+    else:
+        logger.error(f"Unspecified OpenAI API error: {api_error}")
+        return Exception(f"OpenAI API error: {str(api_error)}")
+
+def _explanation_error(e):
+    """Wrap a non-API failure unless it is already a formatted OpenAI error"""
+    logger.error(f"Error generating explanation: {e}")
+    if "OpenAI API error" in str(e) or "API key" in str(e) or "timed out" in str(e):
+        # Pass through already formatted OpenAI errors
+        return e
+    # Format other errors
+    return Exception(f"Error processing request: {str(e)}")
+
+def generate_explanation(base64_image, subject):
+    """
+    Generate an explanation for a question using OpenAI's GPT-4o model
+    
+    Args:
+        base64_image: Base64-encoded image of the question
+        subject: Subject of the question (e.g., "Mathematics", "Physics")
+    
+    Returns:
+        Generated explanation text
+    """
+    try:
+        messages = build_explanation_messages(base64_image, subject)
         
         # API call with explicit error handling and logging
         logger.info(f"Calling OpenAI API (GPT-4o) for explanation")
         try:
-            # Implement an exponential backoff retry mechanism for rate limits and timeouts
-            max_retries = 3
-            retry_count = 0
-            backoff_time = 2.0  # Initial backoff time in seconds
-            
-            while retry_count < max_retries:
-                try:
-                    # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-                    # do not change this unless explicitly requested by the user
-                    response = openai.chat.completions.create(
-                        model="gpt-4o",  # Using the latest GPT-4o model which supports vision
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": [
-                                {"type": "text", "text": f"Please explain this {subject} question in detail:"},
-                                {"type": "image_url", "image_url": {"url": image_url}}
-                            ]}
-                        ],
-                        max_tokens=1500,
-                        temperature=0.3,  # Lower temperature for more focused responses
-                        timeout=90.0  # Increase timeout for longer processing
-                    )
-                    # If we get here, the request was successful
-                    break
-                    
-                except Exception as retry_error:
-                    retry_count += 1
-                    error_message = str(retry_error).lower()
-                    
-                    # Only retry on rate limit or timeout errors
-                    if (retry_count < max_retries and 
-                        ("rate limit" in error_message or 
-                         "ratelimit" in error_message or
-                         "timeout" in error_message or
-                         "capacity" in error_message or
-                         "overloaded" in error_message)):
-                        
-                        logger.warning(f"OpenAI API request failed (attempt {retry_count}/{max_retries}): {error_message}")
-                        logger.info(f"Retrying in {backoff_time} seconds...")
-                        time.sleep(backoff_time)
-                        backoff_time *= 2  # Exponential backoff
-                        continue
-                    else:
-                        # Either we've reached max retries or this is not a retryable error
-                        if retry_count >= max_retries:
-                            logger.error(f"Maximum retries ({max_retries}) exceeded: {error_message}")
-                        else:
-                            logger.error(f"Non-retryable error: {error_message}")
-                        raise  # Re-raise the last exception
+            # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+            # do not change this unless explicitly requested by the user
+            response = chat_completion(
+                messages,
+                model=EXPLANATION_MODEL,  # Using the latest GPT-4o model which supports vision
+                max_tokens=1500,
+                temperature=0.3,  # Lower temperature for more focused responses
+                prompt_version=EXPLANATION_PROMPT_VERSION
+            )
             
             # Process the response
-            explanation = response.choices[0].message.content
-            if not explanation or len(explanation) < 10:
-                logger.error(f"Received empty or very short explanation from OpenAI: '{explanation}'")
-                raise Exception("The AI returned an empty or insufficient response. Please try again.")
-                
-            logger.info(f"Received explanation of length {len(explanation)} characters")
-            logger.info(f"Explanation preview: {explanation[:100]}...")
-            
-            return explanation
+            return check_explanation_text(response.choices[0].message.content)
             
         except Exception as api_error:
-            logger.error(f"OpenAI API call failed: {api_error}")
-            error_str = str(api_error).lower()
+            raise _explanation_api_error(api_error)
+        
+    except Exception as e:
+        raise _explanation_error(e)
+
+def stream_explanation(base64_image, subject):
+    """
+    Streaming variant of generate_explanation
+    
+    Yields:
+        str: Text deltas of the explanation
+    """
+    try:
+        messages = build_explanation_messages(base64_image, subject)
+        
+        logger.info(f"Streaming OpenAI API (GPT-4o) explanation")
+        try:
+            yield from stream_chat_completion(
+                messages,
+                model=EXPLANATION_MODEL,
+                max_tokens=1500,
+                temperature=0.3,
+                prompt_version=EXPLANATION_PROMPT_VERSION
+            )
+        except Exception as api_error:
+            raise _explanation_api_error(api_error)
+        
+    except Exception as e:
+        raise _explanation_error(e)
+
+async def generate_explanation_async(base64_image, subject):
+    """
+    Async variant of generate_explanation used by the background AI job workers
+    
+    Returns:
+        Generated explanation text
+    """
+    try:
+        # Decoding and resizing the image is CPU work; keep it off the event loop
+        messages = await asyncio.to_thread(build_explanation_messages, base64_image, subject)
+        
+        logger.info(f"Calling OpenAI API (GPT-4o, async) for explanation")
+        try:
+            response = await chat_completion_async(
+                messages,
+                model=EXPLANATION_MODEL,
+                max_tokens=1500,
+                temperature=0.3,
+                prompt_version=EXPLANATION_PROMPT_VERSION
+            )
+            return check_explanation_text(response.choices[0].message.content)
             
-            # Provide specific error messages based on different error patterns
-            if "api key" in error_str:
-                logger.error("API key authentication issue detected")
-                raise Exception("OpenAI API key issue. Please check your API key configuration.")
-            elif "timeout" in error_str:
-                logger.error("Request timeout detected")
-                raise Exception("The request timed out. The question might be too complex or the server is busy. Please try again.")
-            elif "rate limit" in error_str or "ratelimit" in error_str:
-                logger.error("Rate limit error detected")
-                raise Exception("OpenAI rate limit reached. Please try again in a few moments.")
-            elif any(term in error_str for term in ["quota", "exceeded", "insufficient_quota", "429"]):
-                logger.error("Quota exceeded error detected")
-                raise Exception("The AI service is temporarily unavailable due to exceeding usage limits. The administrator has been notified. Please try again later.")
-            elif "invalid" in error_str and ("format" in error_str or "image" in error_str):
-                logger.error("Invalid image format error detected")
-                raise Exception("The image format is invalid or corrupted. Please try with a different image.")
-            else:
-                logger.error(f"Unspecified OpenAI API error: {api_error}")
-                raise Exception(f"OpenAI API error: {str(api_error)}")
+        except Exception as api_error:
+            raise _explanation_api_error(api_error)
         
     except Exception as e:
-        logger.error(f"Error generating explanation: {e}")
-        if "OpenAI API error" in str(e) or "API key" in str(e) or "timed out" in str(e):
-            # Pass through already formatted OpenAI errors
-            raise e
-        else:
-            # Format other errors
-            raise Exception(f"Error processing request: {str(e)}")
+        raise _explanation_error(e)
@@ -0,0 +1,244 @@
+"""
+Per-call telemetry for OpenAI chat completions.
+
+The gateway records one OpenAICallLog row per logical call (retries included):
+the endpoint that made it, model, prompt version, token usage, attempts, time
+spent queued on the rate limiter and wall time. Rows are written on a separate
+connection so a failed write never affects the request, and the admin usage
+page aggregates them into latency percentiles and cost per endpoint per day.
+"""
+import os
+import json
+import math
+import time
+import logging
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import has_app_context, has_request_context, request
+
+from app import db
+from models import OpenAICallLog
+
+logger = logging.getLogger(__name__)
+
+# USD per million tokens: (input, cached input, output). Override with a JSON
+# object in OPENAI_PRICING, e.g. {"gpt-4o": [2.5, 1.25, 10.0]}
+MODEL_PRICING = {
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4-turbo': (10.00, 10.00, 30.00),
+    'gpt-3.5-turbo': (0.50, 0.50, 1.50),
+}
+MODEL_PRICING.update({
+    model: tuple(prices) for model, prices in json.loads(os.environ.get('OPENAI_PRICING', '{}')).items()
+})
+
+# Endpoint name for calls made outside a request (background jobs, CLI scripts)
+_call_endpoint = contextvars.ContextVar('openai_call_endpoint', default=None)
+
+
+@contextmanager
+def telemetry_endpoint(name):
+    """Attribute OpenAI calls made inside the block to `name` (e.g. 'job:explain_question')"""
+    token = _call_endpoint.set(name)
+    try:
+        yield
+    finally:
+        _call_endpoint.reset(token)
+
+
+def current_endpoint():
+    """Name of the endpoint making the current OpenAI call"""
+    name = _call_endpoint.get()
+    if name:
+        return name
+    if has_request_context() and request.endpoint:
+        return request.endpoint
+    return 'other'
+
+
+def estimate_cost(model, input_tokens, output_tokens, cached_tokens=0):
+    """
+    Cost of a call in USD
+
+    Returns:
+        float: Cost, or None if the model has no known pricing
+    """
+    prices = MODEL_PRICING.get(model)
+    if prices is None:
+        # Dated snapshots (gpt-4o-2024-08-06) are priced like their base model
+        prices = next((p for name, p in MODEL_PRICING.items() if model.startswith(name + '-')), None)
+    if prices is None or input_tokens is None:
+        return None
+    input_price, cached_price, output_price = prices
+    cached_tokens = cached_tokens or 0
+    return (
+        (input_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + (output_tokens or 0) * output_price
+    ) / 1_000_000
+
+
+class CallTelemetry:
+    """Collects measurements for one OpenAI call while the gateway retries it"""
+
+    def __init__(self, model, prompt_version=None, streamed=False):
+        self.model = model
+        self.prompt_version = prompt_version
+        self.streamed = streamed
+        self.endpoint = current_endpoint()
+        self.started = time.monotonic()
+        self.queue_wait = 0.0
+        self.first_token_ms = None
+
+    def mark_first_token(self):
+        if self.first_token_ms is None:
+            self.first_token_ms = int((time.monotonic() - self.started) * 1000)
+
+    def record(self, attempts, usage=None, error=None):
+        """
+        Write the call's telemetry row
+
+        Args:
+            attempts: Number of requests sent to OpenAI
+            usage: The `usage` object from the response, if any
+            error: Exception the call failed with, if any
+        """
+        duration_ms = int((time.monotonic() - self.started) * 1000)
+        input_tokens = getattr(usage, 'prompt_tokens', None)
+        output_tokens = getattr(usage, 'completion_tokens', None)
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', None) if details else None
+        logger.info(
+            f"OpenAI call {self.endpoint} {self.model}: {'ok' if error is None else type(error).__name__} "
+            f"in {duration_ms}ms, {attempts} attempt(s), {input_tokens}/{output_tokens} tokens"
+        )
+        if not has_app_context():
+            return
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(OpenAICallLog.__table__.insert().values(
+                    created_at=datetime.utcnow(),
+                    endpoint=self.endpoint[:100],
+                    model=self.model,
+                    prompt_version=self.prompt_version,
+                    streamed=self.streamed,
+                    status='ok' if error is None else 'error',
+                    error_type=type(error).__name__ if error is not None else None,
+                    attempts=attempts,
+                    input_tokens=input_tokens,
+                    output_tokens=output_tokens,
+                    cached_tokens=cached_tokens,
+                    queue_wait_ms=int(self.queue_wait * 1000),
+                    first_token_ms=self.first_token_ms,
+                    duration_ms=duration_ms,
+                    cost_usd=estimate_cost(self.model, input_tokens, output_tokens, cached_tokens)
+                ))
+        except Exception as e:
+            logger.warning(f"Failed to record OpenAI call telemetry: {str(e)}")
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def usage_report(days=7):
+    """
+    Aggregate OpenAI calls per endpoint per day
+
+    Percentiles are computed in Python so the report works on SQLite as well
+    as PostgreSQL.
+
+    Args:
+        days: Number of days to include, counting today
+
+    Returns:
+        list: One dict per (day, endpoint), newest day first
+    """
+    since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    table = OpenAICallLog.__table__
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            table.select().where(table.c.created_at >= since)
+        ).all()
+
+    groups = defaultdict(list)
+    for row in rows:
+        groups[(row.created_at.date(), row.endpoint)].append(row)
+
+    report = []
+    for (day, endpoint), calls in groups.items():
+        durations = sorted(call.duration_ms for call in calls)
+        first_tokens = sorted(call.first_token_ms for call in calls if call.first_token_ms is not None)
+        report.append({
+            'day': day,
+            'endpoint': endpoint,
+            'calls': len(calls),
+            'errors': sum(1 for call in calls if call.status != 'ok'),
+            'retries': sum(call.attempts - 1 for call in calls if call.attempts),
+            'p50_ms': percentile(durations, 50),
+            'p95_ms': percentile(durations, 95),
+            'p99_ms': percentile(durations, 99),
+            'p50_first_token_ms': percentile(first_tokens, 50),
+            'avg_queue_wait_ms': sum(call.queue_wait_ms or 0 for call in calls) // len(calls),
+            'input_tokens': sum(call.input_tokens or 0 for call in calls),
+            'output_tokens': sum(call.output_tokens or 0 for call in calls),
+            'cached_tokens': sum(call.cached_tokens or 0 for call in calls),
+            'cost_usd': sum(call.cost_usd or 0 for call in calls),
+        })
+    report.sort(key=lambda r: (r['day'], r['cost_usd']), reverse=True)
+    return report
+
+
+def variant_report(prompt_version, days=7):
+    """
+    Compare the variants of one prompt (e.g. 'answer-feedback-v1-composite' against
+    'answer-feedback-v1-separate') over the last `days` days
+
+    Args:
+        prompt_version: Base prompt version; each recorded version starting with it is a variant
+        days: Number of days to include, counting today
+
+    Returns:
+        list: One dict per variant with per-call averages, sorted by prompt version
+    """
+    since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    table = OpenAICallLog.__table__
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            table.select().where(
+                table.c.created_at >= since,
+                table.c.prompt_version.like(f"{prompt_version}-%")
+            )
+        ).all()
+
+    groups = defaultdict(list)
+    for row in rows:
+        groups[row.prompt_version].append(row)
+
+    report = []
+    for version, calls in sorted(groups.items()):
+        succeeded = [call for call in calls if call.status == 'ok']
+        durations = sorted(call.duration_ms for call in succeeded)
+        first_tokens = sorted(call.first_token_ms for call in succeeded if call.first_token_ms is not None)
+        count = max(len(succeeded), 1)
+        report.append({
+            'prompt_version': version,
+            'variant': version[len(prompt_version) + 1:],
+            'calls': len(calls),
+            'errors': len(calls) - len(succeeded),
+            'avg_input_tokens': sum(call.input_tokens or 0 for call in succeeded) // count,
+            'avg_output_tokens': sum(call.output_tokens or 0 for call in succeeded) // count,
+            'p50_ms': percentile(durations, 50),
+            'p95_ms': percentile(durations, 95),
+            'p50_first_token_ms': percentile(first_tokens, 50),
+            'avg_cost_usd': sum(call.cost_usd or 0 for call in succeeded) / count,
+        })
+    return report
@@ -0,0 +1,291 @@
+"""
+Document rectification of captured photos: crop to the page, straighten it and
+trim its empty margins.
+
+A phone photo of a question also shows the desk, the student's hands and the
+room behind, and every one of those pixels is uploaded and paid for in vision
+tiles. rectify_page runs before the photo is stored and sent to the model:
+
+1. page detection: the largest four-cornered contour covering at least
+   RECTIFY_MIN_PAGE_AREA of the frame with nearly all the ink inside it (so a
+   table or graph on the page is not mistaken for the page), found on a
+   brightness (Otsu) mask and, failing that, on closed Canny edges,
+2. perspective correction: the four corners are warped onto an upright
+   rectangle of the page's own size,
+3. deskew: the remaining tilt of the text lines is found by maximising the
+   variance of the row profile of the ink, and rotated away,
+4. margin trimming: the image is cropped to the writing and diagrams plus a
+   small border.
+
+Detection runs on a copy of at most RECTIFY_WORKING_SIDE pixels; only the
+final warp touches the full-resolution photo. A step that finds nothing to do
+is skipped, and a photo needing no step is returned byte-for-byte unchanged.
+
+A rectified photo is returned as a RectifiedImage: the JPEG bytes that are
+stored and hashed, carrying the decoded page so that prepare_vision_image and
+the perceptual hash matcher need not decode the JPEG again.
+"""
+import io
+import os
+import time
+import logging
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from utils.image_preparation import decode_image_data
+
+logger = logging.getLogger(__name__)
+
+PAGE_RECTIFICATION_ENABLED = os.environ.get('PAGE_RECTIFICATION_ENABLED', 'true').lower() == 'true'
+# Smallest page, as a fraction of the frame, accepted as the sheet of paper
+RECTIFY_MIN_PAGE_AREA = float(os.environ.get('RECTIFY_MIN_PAGE_AREA', 0.2))
+# Tilt range searched by the deskew step, in degrees; smaller tilts are left alone
+RECTIFY_MAX_SKEW_DEGREES = float(os.environ.get('RECTIFY_MAX_SKEW_DEGREES', 15))
+RECTIFY_MIN_SKEW_DEGREES = float(os.environ.get('RECTIFY_MIN_SKEW_DEGREES', 0.5))
+# Margins are only trimmed when that removes at least this fraction of the image
+RECTIFY_MIN_TRIM = float(os.environ.get('RECTIFY_MIN_TRIM', 0.1))
+RECTIFY_JPEG_QUALITY = int(os.environ.get('RECTIFY_JPEG_QUALITY', 90))
+
+# A "page" covering more of the frame than this is the frame itself (a scan or screenshot)
+MAX_PAGE_AREA = 0.95
+# A real page holds the writing; a box with more ink than this outside it is a
+# diagram or table on the page
+MAX_INK_OUTSIDE_PAGE = 0.1
+RECTIFY_WORKING_SIDE = 1024
+# Deskew profiles are computed on a smaller copy still
+SKEW_WORKING_SIDE = 512
+
+
+def _working_copy(gray, side):
+    """Downscaled copy of at most `side` pixels, and its scale factor"""
+    scale = min(1.0, side / max(gray.shape))
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+
+def _order_corners(points):
+    """Order four points as top-left, top-right, bottom-right, bottom-left"""
+    points = points.reshape(4, 2).astype(np.float32)
+    sums, diffs = points.sum(axis=1), np.diff(points, axis=1).ravel()
+    return np.array([
+        points[np.argmin(sums)], points[np.argmin(diffs)],
+        points[np.argmax(sums)], points[np.argmax(diffs)]
+    ], dtype=np.float32)
+
+
+def find_page_corners(gray):
+    """
+    Corners of the sheet of paper in a grayscale photo
+
+    Returns:
+        numpy.ndarray: 4x2 corners (top-left, top-right, bottom-right, bottom-left)
+            in the photo's pixels, or None if no page stands out from the background
+    """
+    small, scale = _working_copy(gray, RECTIFY_WORKING_SIDE)
+    blurred = cv2.GaussianBlur(small, (9, 9), 0)
+    _, bright = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # Edges catch a white page on a light desk, where brightness alone does not
+    edges = cv2.dilate(cv2.Canny(blurred, 30, 90), np.ones((5, 5), np.uint8))
+    frame_area = small.shape[0] * small.shape[1]
+    ink = _character_marks(_ink_mask(small))
+    total_ink = max(cv2.countNonZero(ink), 1)
+    # Room around a candidate so its own edge does not count as ink outside it
+    edge_margin = np.ones((15, 15), np.uint8)
+
+    for mask in (bright, edges):
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+            hull = cv2.convexHull(contour)
+            area = cv2.contourArea(hull)
+            if area < RECTIFY_MIN_PAGE_AREA * frame_area:
+                break
+            if area > MAX_PAGE_AREA * frame_area:
+                continue
+            corners = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True)
+            if len(corners) != 4 or not cv2.isContourConvex(corners):
+                continue
+            page = cv2.dilate(cv2.fillConvexPoly(np.zeros_like(small), corners, 255), edge_margin)
+            if cv2.countNonZero(cv2.bitwise_and(ink, cv2.bitwise_not(page))) > MAX_INK_OUTSIDE_PAGE * total_ink:
+                continue
+            return _order_corners(corners) / scale
+    return None
+
+
+def _warp_page(image, corners):
+    """Map the page's four corners onto an upright rectangle of the page's own size"""
+    top_left, top_right, bottom_right, bottom_left = corners
+    width = int(max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left)))
+    height = int(max(np.linalg.norm(bottom_left - top_left), np.linalg.norm(bottom_right - top_right)))
+    target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(corners, target)
+    return cv2.warpPerspective(image, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+
+
+def _ink_mask(gray):
+    return cv2.adaptiveThreshold(
+        cv2.GaussianBlur(gray, (3, 3), 0), 255,
+        cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15
+    )
+
+
+def _character_marks(ink):
+    """Only the character-sized marks of an ink mask (not page edges, shadows or ruled lines)"""
+    height, width = ink.shape
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    keep = (stats[:, cv2.CC_STAT_HEIGHT] < height / 4) & (stats[:, cv2.CC_STAT_WIDTH] < width / 4)
+    keep[0] = False
+    return np.where(keep[labels], 255, 0).astype(np.uint8)
+
+
+def _profile_score(ink, angle):
+    """Variance of the row sums of the ink rotated by `angle`; peaks when text lines are level"""
+    height, width = ink.shape
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    rows = cv2.warpAffine(ink, rotation, (width, height), flags=cv2.INTER_NEAREST).sum(axis=1, dtype=np.float64)
+    return float(np.var(rows))
+
+
+def estimate_skew(gray):
+    """
+    Tilt of the text lines in a grayscale image
+
+    Returns:
+        float: Angle in degrees to rotate the image by (counter-clockwise) to level
+            the text, or 0.0 if there is too little text to tell
+    """
+    small, _ = _working_copy(gray, SKEW_WORKING_SIDE)
+    ink = _ink_mask(small)
+    if cv2.countNonZero(ink) < 0.002 * ink.size:
+        return 0.0
+    # Coarse search in 1 degree steps, then refine around the best angle in 0.1 degree steps
+    coarse = np.arange(-RECTIFY_MAX_SKEW_DEGREES, RECTIFY_MAX_SKEW_DEGREES + 0.5, 1.0)
+    best = max(coarse, key=lambda angle: _profile_score(ink, angle))
+    fine = np.arange(best - 0.5, best + 0.55, 0.1)
+    return round(float(max(fine, key=lambda angle: _profile_score(ink, angle))), 1)
+
+
+def _rotate(image, angle):
+    """Rotate by `angle` degrees, enlarging the canvas so no corner is cut off"""
+    height, width = image.shape[:2]
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    cos, sin = abs(rotation[0, 0]), abs(rotation[0, 1])
+    new_width, new_height = int(height * sin + width * cos), int(height * cos + width * sin)
+    rotation[0, 2] += new_width / 2 - width / 2
+    rotation[1, 2] += new_height / 2 - height / 2
+    return cv2.warpAffine(image, rotation, (new_width, new_height), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+def content_box(gray):
+    """
+    Area of a grayscale image holding the writing, with a small border
+
+    Writing and diagrams are kept; specks and anything touching the border of the
+    image (page edges, shadows, fingers) are ignored.
+
+    Returns:
+        tuple: (x0, y0, x1, y1) in the image's pixels, or None if there is no writing
+    """
+    small, scale = _working_copy(gray, RECTIFY_WORKING_SIDE)
+    height, width = small.shape
+    count, _, stats, _ = cv2.connectedComponentsWithStats(_ink_mask(small), connectivity=8)
+    stats = stats[1:count]
+    left, top = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+    widths, heights, areas = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT], stats[:, cv2.CC_STAT_AREA]
+    marks = (heights >= 3) & (areas >= 6) \
+        & (left > 0) & (top > 0) & (left + widths < width) & (top + heights < height)
+    if np.count_nonzero(marks) < 3:
+        return None
+    x0, y0 = left[marks].min(), top[marks].min()
+    x1, y1 = (left + widths)[marks].max(), (top + heights)[marks].max()
+    pad = max(8, int(0.02 * max(width, height)))
+    return (
+        int(max(0, x0 - pad) / scale), int(max(0, y0 - pad) / scale),
+        int(min(width, x1 + pad) / scale), int(min(height, y1 + pad) / scale)
+    )
+
+
+class RectifiedImage(bytes):
+    """JPEG bytes of a rectified photo, with the decoded page (upright RGB PIL Image) as `image`"""
+
+    def __new__(cls, encoded, image):
+        rectified = super().__new__(cls, encoded)
+        rectified.image = image
+        return rectified
+
+
+def rectify_page(image_data):
+    """
+    Crop a photo to its page, correct its perspective and tilt, and trim its margins
+
+    Args:
+        image_data: Raw bytes, a data URI or a bare base64 string
+
+    Returns:
+        tuple: (image, list of the corrections made) - a RectifiedImage, or the
+            image data as given and an empty list when nothing needed changing,
+            the image cannot be decoded or rectification is disabled
+    """
+    if not PAGE_RECTIFICATION_ENABLED:
+        return image_data, []
+
+    started = time.perf_counter()
+    try:
+        image_bytes, _ = decode_image_data(image_data)
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            transparent = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        if transparent:
+            # Put transparent areas on white, as the vision preparation does
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                rgba = np.asarray(img.convert('RGBA'), dtype=np.float32)
+            alpha = rgba[:, :, 3:] / 255
+            image = cv2.cvtColor((rgba[:, :, :3] * alpha + 255 * (1 - alpha)).astype(np.uint8), cv2.COLOR_RGB2BGR)
+        else:
+            # Applies the EXIF orientation, so the output needs none
+            image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    except Exception:
+        image = None
+    if image is None:
+        return image_data, []
+
+    source_height, source_width = image.shape[:2]
+    corrections = []
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    corners = find_page_corners(gray)
+    if corners is not None:
+        image = _warp_page(image, corners)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        corrections.append('perspective')
+
+    angle = estimate_skew(gray)
+    if abs(angle) >= RECTIFY_MIN_SKEW_DEGREES:
+        image = _rotate(image, angle)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        corrections.append(f'deskew {angle:+.1f}')
+
+    box = content_box(gray)
+    if box:
+        x0, y0, x1, y1 = box
+        if (x1 - x0) * (y1 - y0) <= (1 - RECTIFY_MIN_TRIM) * gray.size:
+            image = image[y0:y1, x0:x1]
+            corrections.append('trim')
+
+    if not corrections:
+        return image_data, []
+
+    # JPEG even for screenshots: the vision preparation re-encodes to JPEG anyway
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, RECTIFY_JPEG_QUALITY])
+    if not ok:
+        return image_data, []
+
+    height, width = image.shape[:2]
+    logger.info(
+        f"Rectified photo ({', '.join(corrections)}): {source_width}x{source_height} {len(image_bytes)} bytes -> "
+        f"{width}x{height} {len(encoded)} bytes in {(time.perf_counter() - started) * 1000:.0f} ms"
+    )
+    return RectifiedImage(encoded.tobytes(), Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))), corrections
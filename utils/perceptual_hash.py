@@ -0,0 +1,373 @@
+"""
+Perceptual-hash matching of student photos to existing questions.
+
+Students photograph the same printed question with different crops, lighting
+and phones, so the exact SHA-256 used by the explanation cache never matches.
+Every question image gets two 64-bit perceptual hashes (QuestionImageHash):
+
+- pHash: signs of the low-frequency DCT coefficients of a 32x32 thumbnail,
+- dHash: signs of horizontal gradients of a 9x8 thumbnail.
+
+Before hashing, the image is converted to grayscale and cropped to the sheet
+of paper and then to its printed content (an adaptive threshold copes with
+uneven lighting), so the desk, margins and framing of a photo do not dominate
+the hash. Rotation beyond a few degrees and strong perspective are not
+normalised; such photos simply fall back to the model.
+
+The pHashes live in an in-process BK-tree, so a lookup only visits the part of
+the tree within the match distance and takes well under a millisecond for a
+typical question bank. A photo matches a question when its
+pHash is within PHASH_MATCH_DISTANCE bits, the dHash confirms it, and no other
+question is nearly as close. The question's existing Explanation is then
+served instead of calling GPT-4o.
+"""
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+
+import cv2
+import numpy as np
+from sqlalchemy import select, delete, func
+
+from app import db
+from models import QuestionImageHash, Question, QuestionPaper, Explanation
+from utils.explanation_cache import normalize_image_bytes
+
+logger = logging.getLogger(__name__)
+
+# Matching thresholds, in differing bits out of 64. Pages of the same paper
+# share a layout and sit only 10-16 pHash bits apart, so these are kept tight:
+# serving the wrong question's explanation is worse than calling the model.
+PHASH_MATCH_DISTANCE = int(os.environ.get('PHASH_MATCH_DISTANCE', 6))
+DHASH_MATCH_DISTANCE = int(os.environ.get('DHASH_MATCH_DISTANCE', 10))
+# A different question this close to the best match makes the match ambiguous
+PHASH_AMBIGUITY_MARGIN = int(os.environ.get('PHASH_AMBIGUITY_MARGIN', 4))
+PERCEPTUAL_MATCH_ENABLED = os.environ.get('PERCEPTUAL_MATCH_ENABLED', 'true').lower() == 'true'
+# How often each process checks the database for new or changed question hashes
+HASH_INDEX_REFRESH_SECONDS = float(os.environ.get('HASH_INDEX_REFRESH_SECONDS', 30))
+
+HASH_MASK = (1 << 64) - 1
+# Photos are shrunk to this before cropping; the hashes only need a 32x32 thumbnail
+MAX_WORKING_SIDE = 1024
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def _to_signed(value):
+    """Fit an unsigned 64-bit hash into a BIGINT column"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _page_mask(gray):
+    """Mask of the sheet of paper in a photo, or None if no page stands out from the background"""
+    _, paper = cv2.threshold(cv2.GaussianBlur(gray, (9, 9), 0), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    contours, _ = cv2.findContours(paper, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    page = max(contours, key=cv2.contourArea)
+    if not 0.2 * gray.size < cv2.contourArea(page) < 0.95 * gray.size:
+        return None
+    mask = np.zeros_like(gray)
+    cv2.drawContours(mask, [page], -1, 255, cv2.FILLED)
+    # Step inside the page so its edge is not mistaken for ink
+    margin = max(3, min(gray.shape) // 40)
+    return cv2.erode(mask, np.ones((margin, margin), np.uint8))
+
+
+def _content_crop(gray):
+    """Crop a grayscale photo or scan to the area of the page containing ink"""
+    ink = cv2.adaptiveThreshold(
+        cv2.GaussianBlur(gray, (5, 5), 0), 255,
+        cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15
+    )
+    page = _page_mask(gray)
+    if page is not None:
+        ink = cv2.bitwise_and(ink, page)
+    ys, xs = np.nonzero(ink)
+    if len(xs) < 50:
+        return gray
+    # Percentiles ignore stray specks and shadows at the edges of a photo
+    x0, x1 = np.percentile(xs, [0.5, 99.5]).astype(int)
+    y0, y1 = np.percentile(ys, [0.5, 99.5]).astype(int)
+    if x1 - x0 < 16 or y1 - y0 < 16:
+        return gray
+    pad_x, pad_y = (x1 - x0) // 50, (y1 - y0) // 50
+    return gray[max(0, y0 - pad_y):y1 + pad_y + 1, max(0, x0 - pad_x):x1 + pad_x + 1]
+
+
+def compute_image_hashes(image_bytes):
+    """
+    Compute the perceptual hashes of an image
+
+    Args:
+        image_bytes: Encoded image (PNG, JPEG, ...), or bytes carrying the decoded
+            image as `image` (a rectified photo), which is used instead
+
+    Returns:
+        tuple: (phash, dhash) as unsigned 64-bit integers
+    """
+    decoded = getattr(image_bytes, 'image', None)
+    if decoded is not None:
+        gray = np.asarray(decoded.convert('L'))
+    else:
+        gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("Could not decode image for perceptual hashing")
+
+    scale = MAX_WORKING_SIDE / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    gray = _content_crop(gray)
+    # Stretch contrast so dim and bright photos of the same page look alike
+    gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
+
+    thumbnail = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = cv2.dct(thumbnail)[:8, :8]
+    median = np.median(low_frequencies.flatten()[1:])  # Exclude the DC term (overall brightness)
+    phash = _bits_to_int(low_frequencies > median)
+
+    gradient = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    dhash = _bits_to_int(gradient[:, 1:] > gradient[:, :-1])
+    return phash, dhash
+
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes with Hamming distance"""
+
+    def __init__(self):
+        self._root = None
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        node = (key, [value], {})
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = hamming(key, current[0])
+            if distance == 0:
+                current[1].append(value)
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, key, max_distance):
+        """
+        Find every value whose key is within max_distance of key
+
+        Returns:
+            list: (distance, value) pairs, closest first
+        """
+        if self._root is None:
+            return []
+        results = []
+        stack = [self._root]
+        while stack:
+            node_key, values, children = stack.pop()
+            distance = hamming(key, node_key)
+            if distance <= max_distance:
+                results.extend((distance, value) for value in values)
+            # Triangle inequality: only subtrees in this distance band can hold matches
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+
+class QuestionHashIndex:
+    """Per-process BK-tree of question pHashes, rebuilt when the QuestionImageHash table changes"""
+
+    def __init__(self, refresh_interval=HASH_INDEX_REFRESH_SECONDS):
+        self.refresh_interval = refresh_interval
+        # (BK-tree of pHashes, question_id -> dHash), replaced as a whole on refresh so a
+        # concurrent match never sees a tree from one load with the dHashes of another
+        self._index = (BKTree(), {})
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def match(self, image_bytes):
+        """
+        Find the question a photo shows
+
+        Returns:
+            tuple: (question_id, phash distance), or None if there is no confident match
+        """
+        self._refresh()
+        tree, dhashes = self._index
+        started = time.perf_counter()
+        phash, dhash = compute_image_hashes(image_bytes)
+        hashed = time.perf_counter()
+
+        candidates = [
+            (distance, question_id)
+            for distance, question_id in tree.search(phash, PHASH_MATCH_DISTANCE + PHASH_AMBIGUITY_MARGIN)
+            if hamming(dhash, dhashes[question_id]) <= DHASH_MATCH_DISTANCE
+        ]
+        looked_up = time.perf_counter()
+        logger.info(
+            f"Perceptual hash lookup: {len(candidates)} candidate(s) among {tree.size} questions "
+            f"(hash {1000 * (hashed - started):.1f}ms, lookup {1000 * (looked_up - hashed):.3f}ms)"
+        )
+        if not candidates or candidates[0][0] > PHASH_MATCH_DISTANCE:
+            return None
+        best_distance, best_question = candidates[0]
+        for distance, question_id in candidates[1:]:
+            if question_id != best_question and distance - best_distance < PHASH_AMBIGUITY_MARGIN:
+                logger.info(f"Perceptual hash match is ambiguous between questions {best_question} and {question_id}")
+                return None
+        return best_question, best_distance
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+                return
+            table = QuestionImageHash.__table__
+            with db.engine.connect() as conn:
+                version = tuple(conn.execute(select(func.count(), func.max(table.c.computed_at))).first())
+                if version != self._version:
+                    rows = conn.execute(select(table.c.question_id, table.c.phash, table.c.dhash)).all()
+                    tree = BKTree()
+                    dhashes = {}
+                    for row in rows:
+                        tree.add(row.phash & HASH_MASK, row.question_id)
+                        dhashes[row.question_id] = row.dhash & HASH_MASK
+                    self._index = (tree, dhashes)
+                    self._version = version
+                    logger.info(f"Loaded perceptual hashes for {len(rows)} questions")
+            self._checked_at = now
+
+
+# Shared index for this process
+question_hash_index = QuestionHashIndex()
+
+
+def index_question_image(question, image_path=None):
+    """
+    Compute and store the perceptual hashes of a question's image
+
+    Args:
+        question: The Question to index
+        image_path: Image to hash (defaults to the question's resolved image)
+
+    Returns:
+        bool: True if the hashes were stored
+    """
+    if image_path is None:
+        # Never hash a sample image in place of the question's own
+        from user import find_question_image_path
+        image_path = find_question_image_path(question, allow_samples=False)
+    if not image_path:
+        logger.warning(f"No image to hash for question {question.id}")
+        return False
+    try:
+        with open(image_path, 'rb') as image_file:
+            phash, dhash = compute_image_hashes(image_file.read())
+    except Exception as e:
+        logger.warning(f"Could not hash image for question {question.id}: {str(e)}")
+        return False
+
+    table = QuestionImageHash.__table__
+    with db.engine.begin() as conn:
+        conn.execute(delete(table).where(table.c.question_id == question.id))
+        conn.execute(table.insert().values(
+            question_id=question.id,
+            phash=_to_signed(phash),
+            dhash=_to_signed(dhash),
+            image_path=question.image_path,
+            computed_at=datetime.utcnow()
+        ))
+    return True
+
+
+def index_questions(questions, force=False):
+    """
+    Hash a set of questions, skipping those already hashed from their current image
+
+    Returns:
+        dict: Counts of 'indexed', 'unchanged' and 'failed' questions
+    """
+    questions = list(questions)
+    hashed_paths = dict(
+        db.session.query(QuestionImageHash.question_id, QuestionImageHash.image_path)
+        .filter(QuestionImageHash.question_id.in_([question.id for question in questions]))
+        .all()
+    ) if questions else {}
+
+    counts = {'indexed': 0, 'unchanged': 0, 'failed': 0}
+    for question in questions:
+        if not force and hashed_paths.get(question.id) == question.image_path:
+            counts['unchanged'] += 1
+        elif index_question_image(question):
+            counts['indexed'] += 1
+        else:
+            counts['failed'] += 1
+    return counts
+
+
+def find_question_explanation(image_data, subject):
+    """
+    Look for an existing question explanation matching a student's photo
+
+    Args:
+        image_data: Data URI, base64 string or raw bytes of the photo
+        subject: Subject the student chose; the matched question's paper must agree
+
+    Returns:
+        str: The question's explanation text, or None to generate one as usual
+    """
+    if not PERCEPTUAL_MATCH_ENABLED:
+        return None
+    try:
+        # A rectified photo is matched as it is, so its decoded page is reused
+        image_bytes = image_data if hasattr(image_data, 'image') else normalize_image_bytes(image_data)
+        match = question_hash_index.match(image_bytes)
+    except Exception as e:
+        logger.warning(f"Perceptual hash lookup failed: {str(e)}")
+        return None
+    if match is None:
+        return None
+
+    question_id, distance = match
+    # Core queries on the engine, so the lookup is safe to run from asyncio.to_thread
+    questions, papers, explanations = Question.__table__, QuestionPaper.__table__, Explanation.__table__
+    with db.engine.connect() as conn:
+        paper_subject = conn.execute(
+            select(papers.c.subject)
+            .select_from(questions.join(papers, questions.c.paper_id == papers.c.id))
+            .where(questions.c.id == question_id)
+        ).scalar()
+        if paper_subject is None or paper_subject.lower().strip() != (subject or '').lower().strip():
+            logger.info(f"Photo matches question {question_id} but its subject {paper_subject!r} is not {subject!r}")
+            return None
+        explanation_text = conn.execute(
+            select(explanations.c.explanation_text)
+            .where(explanations.c.question_id == question_id)
+            .order_by(explanations.c.generated_at.desc())
+            .limit(1)
+        ).scalar()
+    if explanation_text is None:
+        logger.info(f"Photo matches question {question_id} (distance {distance}) but it has no explanation yet")
+        return None
+    logger.info(f"Photo matches question {question_id} (distance {distance}); serving its existing explanation")
+    return explanation_text
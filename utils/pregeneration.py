@@ -0,0 +1,506 @@
+"""
+Bulk pre-generation of question explanations.
+
+Without this, the first student to open a question pays the full GPT-4o
+latency in api_get_explanation. A PregenerationRun generates an Explanation
+for every question in a paper, category or board ahead of time, in one of two
+modes:
+
+- 'concurrent': explanations are generated in the background job worker with
+  bounded concurrency (PREGENERATE_CONCURRENCY), through the same gateway,
+  rate limiter and explanation cache as student requests;
+- 'batch': the requests are written to a JSONL file and submitted to the
+  OpenAI Batch API (half price, results within 24 hours). Results are
+  collected later. Set OPENAI_BATCH_BACKEND=local to use a file-based
+  stand-in that processes the file itself, for testing.
+
+Runs are resumable. Questions that already have an Explanation are always
+skipped, so re-running a stopped run only does the remaining work. A batch
+that has already been submitted is collected rather than submitted again;
+once it has been collected (or has failed or expired), resuming submits a new
+batch for the questions still without an explanation.
+
+Runs are started from the admin pre-generation page or from the command line
+(pregenerate_explanations.py).
+"""
+import os
+import json
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+
+from sqlalchemy import update, select
+
+from app import db
+from models import PregenerationRun, Question, QuestionPaper, PaperCategory, Explanation
+from utils.ai_jobs import register_job_type, enqueue_job
+from utils.explanation_cache import (
+    get_or_generate_explanation_async, store_explanation, save_question_explanation
+)
+from utils.openai_gateway import openai_client, chat_completion
+from utils.vision_payloads import load_vision_image
+from utils.openai_helper import (
+    build_explanation_messages, check_explanation_text, EXPLANATION_MODEL, EXPLANATION_PROMPT_VERSION
+)
+
+logger = logging.getLogger(__name__)
+
+# Explanations generated at once by a concurrent run (the rate limiter still applies)
+PREGENERATE_CONCURRENCY = int(os.environ.get('PREGENERATE_CONCURRENCY', 4))
+# 'openai' submits to the Batch API; 'local' processes batch files in-process
+OPENAI_BATCH_BACKEND = os.environ.get('OPENAI_BATCH_BACKEND', 'openai')
+BATCH_DIR = os.path.join(os.getcwd(), 'data', 'batches')
+
+SCOPES = ('paper', 'category', 'board')
+MODES = ('concurrent', 'batch')
+
+# Same generation settings as generate_explanation
+EXPLANATION_MAX_TOKENS = 1500
+EXPLANATION_TEMPERATURE = 0.3
+
+
+def questions_in_scope(scope, scope_id):
+    """
+    Query the questions covered by a run
+
+    Args:
+        scope: 'paper', 'category' or 'board'
+        scope_id: ID of the paper, category or board
+
+    Returns:
+        Query: Questions ordered by paper and question number
+    """
+    query = Question.query.join(QuestionPaper, Question.paper_id == QuestionPaper.id)
+    if scope == 'paper':
+        query = query.filter(QuestionPaper.id == scope_id)
+    elif scope == 'category':
+        query = query.filter(QuestionPaper.category_id == scope_id)
+    elif scope == 'board':
+        query = query.join(PaperCategory, QuestionPaper.category_id == PaperCategory.id) \
+            .filter(PaperCategory.board_id == scope_id)
+    else:
+        raise ValueError(f"Unknown pre-generation scope: {scope}")
+    return query.order_by(QuestionPaper.id, Question.id)
+
+
+def create_run(scope, scope_id, mode='concurrent', user_id=None, enqueue=True):
+    """
+    Create a pre-generation run and queue it on the background job workers
+
+    Args:
+        enqueue: False when the caller executes the run itself (the CLI)
+
+    Returns:
+        PregenerationRun: The new run
+    """
+    if scope not in SCOPES:
+        raise ValueError(f"Unknown pre-generation scope: {scope}")
+    if mode not in MODES:
+        raise ValueError(f"Unknown pre-generation mode: {mode}")
+    run = PregenerationRun(scope=scope, scope_id=scope_id, mode=mode, created_by=user_id)
+    db.session.add(run)
+    db.session.commit()
+    if enqueue:
+        enqueue_job('pregenerate_explanations', {'run_id': run.id}, user_id=user_id)
+        logger.info(f"Queued pre-generation run {run.id}: {scope} {scope_id} ({mode})")
+    return run
+
+
+def resume_run(run_id, user_id=None, enqueue=True):
+    """
+    Queue a stopped or submitted run again; finished questions are skipped
+
+    Args:
+        enqueue: False when the caller executes the run itself (the CLI)
+    """
+    run = PregenerationRun.query.get(run_id)
+    if run is None:
+        raise ValueError(f"Pre-generation run {run_id} not found")
+    if run.batch_id and run.status != 'completed':
+        # Submitted, or collecting it failed: collect the same batch
+        run.status = 'submitted'
+    else:
+        # Batch results already applied: the remaining questions go in a new batch
+        run.batch_id = None
+        run.status = 'queued'
+    run.finished_at = None
+    db.session.commit()
+    if enqueue:
+        enqueue_job('pregenerate_explanations', {'run_id': run.id}, user_id=user_id)
+    return run
+
+
+async def execute_run(run_id):
+    """
+    Run (or resume) a pre-generation run to completion, or until its batch is submitted
+
+    Returns:
+        dict: The run's final state
+    """
+    mode = await asyncio.to_thread(_run_mode, run_id)
+    try:
+        if mode == 'batch':
+            await asyncio.to_thread(submit_batch, run_id)
+            await asyncio.to_thread(collect_batch, run_id)
+        else:
+            await _generate_concurrently(run_id)
+    except Exception as e:
+        logger.error(f"Pre-generation run {run_id} failed: {str(e)}")
+        await asyncio.to_thread(_update_run, run_id, status='failed', error=str(e), finished_at=datetime.utcnow())
+        raise
+    return await asyncio.to_thread(_run_dict, run_id)
+
+
+async def _generate_concurrently(run_id):
+    pending = await asyncio.to_thread(_start_run, run_id)
+    semaphore = asyncio.Semaphore(PREGENERATE_CONCURRENCY)
+
+    async def generate_one(item):
+        async with semaphore:
+            try:
+                image_data = await asyncio.to_thread(_read_image, item['image_path'])
+                explanation_text, _ = await get_or_generate_explanation_async(image_data, item['subject'])
+                await asyncio.to_thread(_save_explanation, run_id, item['question_id'], explanation_text)
+            except Exception as e:
+                await asyncio.to_thread(_record_failure, run_id, item['question_id'], e)
+
+    await asyncio.gather(*(generate_one(item) for item in pending))
+    await asyncio.to_thread(_finish_run, run_id)
+
+
+def submit_batch(run_id):
+    """Write the run's pending requests to a JSONL file and submit it, unless already submitted"""
+    run = _load_run(run_id)
+    if run.batch_id:
+        logger.info(f"Pre-generation run {run_id} already submitted as batch {run.batch_id}")
+        return
+    pending = _start_run(run_id)
+    if not pending:
+        _finish_run(run_id)
+        return
+
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    input_path = os.path.join(BATCH_DIR, f"run_{run_id}_input.jsonl")
+    with open(input_path, 'w') as batch_file:
+        for item in pending:
+            messages = build_explanation_messages(_read_image(item['image_path']), item['subject'])
+            batch_file.write(json.dumps({
+                'custom_id': f"question-{item['question_id']}",
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': {
+                    'model': EXPLANATION_MODEL,
+                    'messages': messages,
+                    'max_tokens': EXPLANATION_MAX_TOKENS,
+                    'temperature': EXPLANATION_TEMPERATURE
+                }
+            }) + '\n')
+
+    batch_id = get_batch_backend().submit(input_path, metadata={'pregeneration_run': str(run_id)})
+    _update_run(run_id, status='submitted', batch_id=batch_id)
+    logger.info(f"Pre-generation run {run_id}: submitted {len(pending)} requests as batch {batch_id}")
+
+
+def collect_batch(run_id):
+    """
+    Store the results of a submitted batch if it has finished
+
+    Returns:
+        bool: True if the batch has finished and its results were applied
+    """
+    run = _load_run(run_id)
+    if not run.batch_id or run.status != 'submitted':
+        return run.status == 'completed'
+    backend = get_batch_backend()
+    status = backend.poll(run.batch_id)
+    if status not in ('completed', 'failed', 'expired', 'cancelled'):
+        logger.info(f"Pre-generation run {run_id}: batch {run.batch_id} is {status}")
+        return False
+
+    subjects = {
+        question.id: (question, question.paper.subject)
+        for question in questions_in_scope(run.scope, run.scope_id)
+    }
+    # Recount from the results, so collecting again after an interruption does not double count
+    _update_run(run_id, total=len(subjects), skipped=0, generated=0, failed=0, error=None)
+    for custom_id, explanation_text, error in backend.results(run.batch_id):
+        question_id = int(custom_id.split('-', 1)[1])
+        if question_id not in subjects:
+            continue
+        question, subject = subjects.pop(question_id)
+        try:
+            if error:
+                raise Exception(error)
+            explanation_text = check_explanation_text(explanation_text)
+            image_path = _image_path(question)
+            if image_path:
+                # Cache under the same key a student request would use
+                store_explanation(_read_image(image_path), subject, explanation_text)
+            _save_explanation(run_id, question_id, explanation_text)
+        except Exception as e:
+            _record_failure(run_id, question_id, e)
+
+    # Questions the batch returned nothing for: explained meanwhile, or lost with the batch
+    explained = _questions_with_explanations(list(subjects))
+    if explained:
+        _increment(run_id, 'skipped', amount=len(explained))
+    for question_id in subjects:
+        if question_id not in explained:
+            _record_failure(run_id, question_id, Exception(f"No result in batch {run.batch_id} ({status})"))
+
+    if status != 'completed':
+        # Forget the dead batch, so resuming submits the unanswered questions again
+        _update_run(
+            run_id, status='failed', batch_id=None, finished_at=datetime.utcnow(),
+            error=f"Batch {run.batch_id} ended with status {status}"
+        )
+        logger.error(f"Pre-generation run {run_id}: batch {run.batch_id} ended with status {status}")
+        return True
+    _finish_run(run_id)
+    return True
+
+
+def _start_run(run_id):
+    """
+    Count the questions in scope and list those still without an explanation
+
+    Returns:
+        list: dicts with question_id, image_path and subject
+    """
+    run = _load_run(run_id)
+    questions = questions_in_scope(run.scope, run.scope_id).all()
+    existing = _questions_with_explanations([question.id for question in questions])
+
+    pending = []
+    missing_images = []
+    for question in questions:
+        if question.id in existing:
+            continue
+        image_path = _image_path(question)
+        if image_path is None:
+            missing_images.append(question.id)
+            continue
+        pending.append({
+            'question_id': question.id,
+            'image_path': image_path,
+            'subject': question.paper.subject
+        })
+
+    _update_run(
+        run_id, status='running', total=len(questions), skipped=len(existing),
+        generated=0, failed=len(missing_images),
+        error=f"No image found for questions {missing_images}" if missing_images else None
+    )
+    logger.info(
+        f"Pre-generation run {run_id}: {len(questions)} questions, {len(existing)} already explained, "
+        f"{len(pending)} to generate"
+    )
+    return pending
+
+
+def _finish_run(run_id):
+    run = _run_dict(run_id)
+    _update_run(run_id, status='completed', finished_at=datetime.utcnow())
+    logger.info(
+        f"Pre-generation run {run_id} completed: {run['generated']} generated, "
+        f"{run['skipped']} skipped, {run['failed']} failed"
+    )
+
+
+def _save_explanation(run_id, question_id, explanation_text):
+    """Store the explanation unless one appeared meanwhile (e.g. a student requested it)"""
+    with db.engine.begin() as conn:
+        stored = save_question_explanation(conn, question_id, explanation_text)
+    _increment(run_id, 'generated' if stored else 'skipped')
+    table = PregenerationRun.__table__
+    with db.engine.connect() as conn:
+        run = conn.execute(select(table).where(table.c.id == run_id)).first()
+    handled = run.skipped + run.generated + run.failed
+    logger.info(
+        f"Pre-generation run {run_id}: question {question_id} done "
+        f"({handled}/{run.total}, {run.generated} generated, {run.failed} failed)"
+    )
+
+
+def _record_failure(run_id, question_id, error):
+    logger.error(f"Pre-generation run {run_id}: question {question_id} failed: {str(error)}")
+    _increment(run_id, 'failed', error=f"Question {question_id}: {str(error)}")
+
+
+def _increment(run_id, counter, error=None, amount=1):
+    table = PregenerationRun.__table__
+    values = {counter: table.c[counter] + amount, 'updated_at': datetime.utcnow()}
+    if error:
+        values['error'] = error
+    with db.engine.begin() as conn:
+        conn.execute(update(table).where(table.c.id == run_id).values(**values))
+
+
+def _update_run(run_id, **values):
+    table = PregenerationRun.__table__
+    values['updated_at'] = datetime.utcnow()
+    with db.engine.begin() as conn:
+        conn.execute(update(table).where(table.c.id == run_id).values(**values))
+
+
+def _load_run(run_id):
+    # Counters are updated on separate connections, so never trust the session's copy
+    db.session.expire_all()
+    run = PregenerationRun.query.get(run_id)
+    if run is None:
+        raise ValueError(f"Pre-generation run {run_id} not found")
+    return run
+
+
+def _run_dict(run_id):
+    return _load_run(run_id).to_dict()
+
+
+def _run_mode(run_id):
+    return _load_run(run_id).mode
+
+
+def _questions_with_explanations(question_ids):
+    if not question_ids:
+        return set()
+    rows = db.session.query(Explanation.question_id).filter(Explanation.question_id.in_(question_ids)).distinct()
+    return {row.question_id for row in rows}
+
+
+def _image_path(question):
+    # Never fall back to sample images: that would attach the wrong explanation to the question
+    from user import find_question_image_path
+    return find_question_image_path(question, allow_samples=False)
+
+
+def _read_image(image_path):
+    # The prepared payload is cached on disk, so re-runs skip decoding and re-encoding the image
+    return load_vision_image(image_path)
+
+
+class OpenAIBatchBackend:
+    """Submits batch files to the OpenAI Batch API"""
+
+    def submit(self, input_path, metadata=None):
+        with open(input_path, 'rb') as batch_file:
+            uploaded = openai_client.files.create(file=batch_file, purpose='batch')
+        batch = openai_client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h',
+            metadata=metadata
+        )
+        return batch.id
+
+    def poll(self, batch_id):
+        return openai_client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id):
+        """
+        Yields:
+            tuple: (custom_id, response text or None, error message or None)
+        """
+        batch = openai_client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in openai_client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    yield _parse_batch_output_line(json.loads(line))
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the Batch API, for testing
+
+    Batches live in BATCH_DIR/<batch_id>/. poll() processes any requests that
+    have no output line yet through the normal gateway, so an interrupted
+    batch picks up where it stopped, and writes output in the Batch API format.
+    """
+
+    def submit(self, input_path, metadata=None):
+        batch_id = f"local_batch_{uuid.uuid4().hex[:16]}"
+        batch_dir = os.path.join(BATCH_DIR, batch_id)
+        os.makedirs(batch_dir)
+        os.replace(input_path, os.path.join(batch_dir, 'input.jsonl'))
+        with open(os.path.join(batch_dir, 'metadata.json'), 'w') as metadata_file:
+            json.dump(metadata or {}, metadata_file)
+        return batch_id
+
+    def poll(self, batch_id):
+        batch_dir = os.path.join(BATCH_DIR, batch_id)
+        output_path = os.path.join(batch_dir, 'output.jsonl')
+        done = {
+            line['custom_id'] for line in _read_jsonl(output_path)
+        } if os.path.exists(output_path) else set()
+
+        with open(output_path, 'a') as output_file:
+            for request_line in _read_jsonl(os.path.join(batch_dir, 'input.jsonl')):
+                if request_line['custom_id'] in done:
+                    continue
+                output_file.write(json.dumps(self._process(request_line)) + '\n')
+                output_file.flush()
+        return 'completed'
+
+    def results(self, batch_id):
+        for line in _read_jsonl(os.path.join(BATCH_DIR, batch_id, 'output.jsonl')):
+            yield _parse_batch_output_line(line)
+
+    @staticmethod
+    def _process(request_line):
+        body = request_line['body']
+        try:
+            response = chat_completion(
+                body['messages'],
+                model=body['model'],
+                max_tokens=body['max_tokens'],
+                temperature=body['temperature'],
+                prompt_version=EXPLANATION_PROMPT_VERSION
+            )
+            return {
+                'id': f"batch_req_{uuid.uuid4().hex[:16]}",
+                'custom_id': request_line['custom_id'],
+                'response': {'status_code': 200, 'body': response.model_dump()},
+                'error': None
+            }
+        except Exception as e:
+            return {
+                'id': f"batch_req_{uuid.uuid4().hex[:16]}",
+                'custom_id': request_line['custom_id'],
+                'response': None,
+                'error': {'code': type(e).__name__, 'message': str(e)}
+            }
+
+
+def get_batch_backend():
+    return LocalBatchBackend() if OPENAI_BATCH_BACKEND == 'local' else OpenAIBatchBackend()
+
+
+def _parse_batch_output_line(line):
+    custom_id = line.get('custom_id')
+    if line.get('error'):
+        return custom_id, None, line['error'].get('message', 'Batch request failed')
+    response = line.get('response') or {}
+    if response.get('status_code') != 200:
+        return custom_id, None, f"Batch request returned HTTP {response.get('status_code')}"
+    try:
+        return custom_id, response['body']['choices'][0]['message']['content'], None
+    except (KeyError, IndexError, TypeError):
+        return custom_id, None, "Batch response had no content"
+
+
+def _read_jsonl(path):
+    with open(path) as jsonl_file:
+        return [json.loads(line) for line in jsonl_file if line.strip()]
+
+
+async def run_pregeneration_job(payload):
+    return await execute_run(payload['run_id'])
+
+
+def finalize_pregeneration_job(job, run):
+    return {'success': True, 'run': run}, 200
+
+
+register_job_type('pregenerate_explanations', run_pregeneration_job, finalize_pregeneration_job)
@@ -0,0 +1,259 @@
+"""
+In-memory index from question id to the file holding the question's image.
+
+Question.image_path values come from several eras of the app: absolute
+Replit paths (/home/runner/workspace/...), paths under ./data and debug
+copies written next to uploads. Finding the real file used to mean probing up
+to ten candidate paths with os.path.isfile on every image request. The
+resolver probes each question once, keeps the answer in a dict and writes the
+canonical path back to Question.image_path, so later lookups (and other
+processes after a restart) find the file on the first try. Relative paths are
+relative to the application folder (QUESTION_IMAGE_ROOT), not the working
+directory, and are stored that way, so the column stays valid when the app is
+started from another directory or deployed to another location.
+
+Entries are refreshed when admins add, edit or delete questions. Other worker
+processes notice an edit because the row's image_path no longer matches the
+one the entry was resolved from; questions with no image are re-probed after
+QUESTION_IMAGE_MISS_TTL seconds in case the file is restored.
+
+Each image also has a content digest. It is used as the image's strong ETag
+and as the `v` parameter of its URL. A URL carrying the current digest never
+changes meaning, so browsers may cache it for a year; replacing the image
+changes the digest and therefore the URL. For images in the blob store the
+digest is read from the file name instead of the file.
+"""
+import os
+import time
+import logging
+import threading
+
+from flask import url_for
+from sqlalchemy import select, update
+
+from app import db
+from models import Question
+from utils.image_derivatives import file_digest, DERIVATIVE_WIDTHS
+from utils.blob_store import blob_digest, is_blob_path
+
+logger = logging.getLogger(__name__)
+
+# Seconds before a question whose image could not be found is probed again
+QUESTION_IMAGE_MISS_TTL = float(os.environ.get('QUESTION_IMAGE_MISS_TTL', 300))
+# Folder relative image paths are resolved against: the application folder
+QUESTION_IMAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def candidate_paths(image_path, paper_id, question_number):
+    """
+    Places a question's own image may be found, most likely first
+
+    Returns:
+        list: Absolute paths, without duplicates
+    """
+    folder_name = os.path.basename(os.path.dirname(image_path))
+    file_name = os.path.basename(image_path)
+    candidates = [
+        image_path,  # Original path from database
+        image_path.replace('/home/runner/workspace/', './'),  # Relative path
+        os.path.join('data', folder_name, file_name),  # Local data folder
+        os.path.join(folder_name, file_name),  # Direct folder access
+        os.path.join('data', f'paper_{paper_id}', f"{question_number}_debug.png"),  # Debug copy
+    ]
+    unique = []
+    for path in candidates:
+        path = os.path.normpath(os.path.join(QUESTION_IMAGE_ROOT, path))
+        if path not in unique:
+            unique.append(path)
+    return unique
+
+
+def probe_image_path(image_path, paper_id, question_number):
+    """Return the first candidate path that is an existing file, or None"""
+    if not image_path:
+        return None
+    return next(
+        (path for path in candidate_paths(image_path, paper_id, question_number) if os.path.isfile(path)),
+        None
+    )
+
+
+def stored_image_path(path):
+    """
+    Form of a resolved image path to store in Question.image_path
+
+    Returns:
+        str: The path relative to QUESTION_IMAGE_ROOT, or None for a file outside
+            it (its absolute path would not survive a move of the application)
+    """
+    relative = os.path.relpath(path, QUESTION_IMAGE_ROOT)
+    if relative.startswith(os.pardir + os.sep) or os.path.isabs(relative):
+        return None
+    return relative
+
+
+# Hex digits of the content digest used in versioned image URLs
+IMAGE_VERSION_LENGTH = 16
+
+
+class QuestionImageResolver:
+    """Maps question ids to image files; see the module docstring"""
+
+    def __init__(self):
+        # question_id -> (image_path the entry was resolved from, resolved path or None, time resolved)
+        self._entries = {}
+        # path -> (mtime_ns, size, sha256 hex) of files served so far
+        self._digests = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Resolve every question's image and write the canonical paths back to the database"""
+        table = Question.__table__
+        started = time.monotonic()
+        with db.engine.connect() as conn:
+            rows = conn.execute(
+                select(table.c.id, table.c.image_path, table.c.paper_id, table.c.question_number)
+            ).all()
+
+        entries = {}
+        canonical = {}
+        now = time.monotonic()
+        for row in rows:
+            resolved = probe_image_path(row.image_path, row.paper_id, row.question_number)
+            stored = self._canonical(row.image_path, resolved)
+            if stored:
+                canonical[row.id] = stored
+            entries[row.id] = (row.image_path, resolved, now)
+
+        self._write_back(canonical)
+        with self._lock:
+            self._entries = entries
+            self._loaded = True
+        missing = sum(1 for entry in entries.values() if entry[1] is None)
+        logger.info(
+            f"Resolved images for {len(entries)} questions in {time.monotonic() - started:.2f}s "
+            f"({len(canonical)} paths corrected, {missing} missing)"
+        )
+
+    def resolve(self, question):
+        """
+        Path of the question's own image file
+
+        Args:
+            question: The Question (only id, image_path, paper_id and question_number are used)
+
+        Returns:
+            str: Absolute path of the image, or None if the question has no image on disk
+        """
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+        entry = self._entries.get(question.id)
+        if entry is not None:
+            source_path, resolved, resolved_at = entry
+            current = question.image_path in (source_path, resolved) or (
+                resolved is not None and question.image_path == stored_image_path(resolved)
+            )
+            if current and (
+                resolved is not None or time.monotonic() - resolved_at < QUESTION_IMAGE_MISS_TTL
+            ):
+                return resolved
+        return self.refresh(question)
+
+    def refresh(self, question):
+        """Re-resolve one question (after it is added or its image is replaced)"""
+        resolved = probe_image_path(question.image_path, question.paper_id, question.question_number)
+        stored = self._canonical(question.image_path, resolved)
+        if stored:
+            self._write_back({question.id: stored})
+        self._entries[question.id] = (question.image_path, resolved, time.monotonic())
+        if resolved is None:
+            logger.info(f"No image file found for question {question.id} (image_path {question.image_path})")
+        return resolved
+
+    def digest(self, path):
+        """
+        Content digest of an image file, recomputed only when the file changes
+
+        Returns:
+            str: SHA-256 hex digest
+        """
+        # Files in the blob store are named by their digest and never change: no stat
+        digest = blob_digest(path)
+        if digest:
+            return digest
+        stat = os.stat(path)
+        cached = self._digests.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        digest = file_digest(path)
+        self._digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def version(self, question):
+        """
+        The question's image file and its content digest
+
+        Returns:
+            tuple: (path, digest), or None if the question has no image on disk
+        """
+        path = self.resolve(question)
+        if path is None:
+            return None
+        try:
+            return path, self.digest(path)
+        except OSError:
+            # The file was removed since it was resolved; look for it again
+            path = self.refresh(question)
+            try:
+                return (path, self.digest(path)) if path else None
+            except OSError:
+                return None
+
+    def url_for(self, question, **kwargs):
+        """
+        URL of the question's image that changes whenever the image does
+
+        Falls back to the plain (revalidated) URL when the image is missing.
+        """
+        version = self.version(question)
+        if version is not None:
+            kwargs['v'] = version[1][:IMAGE_VERSION_LENGTH]
+        return url_for('user.get_question_image', question_id=question.id, **kwargs)
+
+    def srcset(self, question):
+        """`srcset` attribute offering the question's image at each derivative width"""
+        return ', '.join(f"{self.url_for(question, w=width)} {width}w" for width in DERIVATIVE_WIDTHS)
+
+    def forget(self, question_id):
+        """Drop a deleted question from the index"""
+        self._entries.pop(question_id, None)
+
+    @staticmethod
+    def _canonical(image_path, resolved):
+        """Path to write back for a question whose image was found somewhere else, or None"""
+        if resolved is None:
+            return None
+        # Blob store paths are managed (and reference counted) by the blob store
+        if is_blob_path(image_path):
+            return None
+        stored = stored_image_path(resolved)
+        return stored if stored and stored != image_path else None
+
+    def _write_back(self, canonical):
+        """Store corrected image paths on a separate connection, leaving the caller's session alone"""
+        if not canonical:
+            return
+        table = Question.__table__
+        try:
+            with db.engine.begin() as conn:
+                for question_id, path in canonical.items():
+                    conn.execute(update(table).where(table.c.id == question_id).values(image_path=path))
+        except Exception as e:
+            logger.warning(f"Could not store canonical image paths: {str(e)}")
+
+
+# Shared resolver for this process
+question_images = QuestionImageResolver()
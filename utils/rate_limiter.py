@@ -0,0 +1,343 @@
+"""
+Cross-worker token-bucket rate limiter for the OpenAI API.
+
+Each model has two buckets in the RateLimitBucket table - requests per minute
+and tokens per minute - shared by every gunicorn worker and job thread. Before
+a call the gateway acquires one request and an estimated token count (prompt
+text, image tiles and max_tokens); afterwards the estimate is corrected with
+the actual usage reported by OpenAI. When a bucket is empty the caller queues
+(sleeps until the bucket has refilled) instead of sending a request that would
+be rejected with a 429. If OpenAI still returns a 429, the buckets are drained
+so every worker backs off together.
+
+The limiter is off unless OPENAI_RPM_LIMIT and/or OPENAI_TPM_LIMIT are set to
+the account's actual limits for its usage tier: a guessed default low enough to
+be safe for a new account would throttle an established one far below what it
+may send. It fails open: database problems are logged and the call proceeds.
+"""
+import os
+import re
+import io
+import math
+import time
+import base64
+import random
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+
+from flask import has_app_context
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import RateLimitBucket
+
+logger = logging.getLogger(__name__)
+
+# Account limits per model, from the OpenAI dashboard's limits page; 0 (the default)
+# disables the corresponding bucket
+OPENAI_RPM_LIMIT = int(os.environ.get('OPENAI_RPM_LIMIT', 0))
+OPENAI_TPM_LIMIT = int(os.environ.get('OPENAI_TPM_LIMIT', 0))
+# Longest a call may queue for capacity before failing
+OPENAI_LIMITER_MAX_WAIT = float(os.environ.get('OPENAI_LIMITER_MAX_WAIT', 30))
+
+# Vision token accounting (https://platform.openai.com/docs/guides/vision)
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+DEFAULT_IMAGE_TOKENS = IMAGE_BASE_TOKENS + 4 * IMAGE_TILE_TOKENS  # A 1024x1024 image
+# Base64 characters decoded to read an image's size from its header (a multiple of 4)
+IMAGE_HEADER_BASE64_CHARS = 64 * 1024
+
+
+class RateLimitQueueTimeout(Exception):
+    """Raised when capacity does not free up within the allowed wait"""
+
+
+def image_tokens(width, height, detail='auto'):
+    """Tokens charged for an image of the given size"""
+    if detail == 'low':
+        return IMAGE_BASE_TOKENS
+    # Fit within 2048x2048, then scale the shortest side down to 768
+    scale = min(1.0, 2048.0 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768.0 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+def _image_url_tokens(image_url):
+    url = image_url.get('url', '')
+    detail = image_url.get('detail', 'auto')
+    if detail == 'low':
+        return IMAGE_BASE_TOKENS
+    match = re.match(r'data:[^;]*;base64,', url)
+    if not match:
+        return DEFAULT_IMAGE_TOKENS
+    from PIL import Image
+    start = match.end()
+    # The size is in the header: decode only the start of the data, unless the
+    # header is longer (e.g. a large EXIF block before a JPEG's frame header)
+    header_end = start + IMAGE_HEADER_BASE64_CHARS
+    for end in ((header_end, len(url)) if header_end < len(url) else (len(url),)):
+        try:
+            # Only the header is parsed, the pixels are not decoded
+            with Image.open(io.BytesIO(base64.b64decode(url[start:end]))) as img:
+                return image_tokens(img.width, img.height, detail)
+        except Exception:
+            continue
+    return DEFAULT_IMAGE_TOKENS
+
+
+def estimate_tokens(messages, max_tokens):
+    """
+    Estimate the tokens a chat completion will consume
+
+    Args:
+        messages: Chat messages (text and image_url parts)
+        max_tokens: Completion limit, counted in full
+
+    Returns:
+        int: Estimated prompt + completion tokens
+    """
+    total = max_tokens or 0
+    for message in messages or []:
+        total += 4  # Per-message overhead
+        content = message.get('content')
+        if isinstance(content, str):
+            total += len(content) // 4
+        elif isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'text':
+                    total += len(part.get('text', '')) // 4
+                elif part.get('type') == 'image_url':
+                    total += _image_url_tokens(part.get('image_url', {}))
+    return total
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared through the database"""
+
+    def __init__(self, rpm_limit=OPENAI_RPM_LIMIT, tpm_limit=OPENAI_TPM_LIMIT, max_wait=OPENAI_LIMITER_MAX_WAIT):
+        self.limits = {'rpm': rpm_limit, 'tpm': tpm_limit}
+        self.max_wait = max_wait
+        self._ensured = set()
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return any(self.limits.values()) and has_app_context()
+
+    @property
+    def counts_tokens(self):
+        """Whether calls need a token estimate (only the tokens-per-minute bucket uses one)"""
+        return bool(self.limits['tpm']) and self.enabled
+
+    @property
+    def queue_depth(self):
+        """Number of calls in this process currently waiting for capacity"""
+        return self._waiting
+
+    def acquire(self, model, estimated_tokens, max_wait=None):
+        """
+        Reserve capacity for one call, waiting if the buckets are empty
+
+        Returns:
+            float: Seconds spent queued
+
+        Raises:
+            RateLimitQueueTimeout: if capacity will not be available within max_wait
+        """
+        if not self.enabled:
+            return 0.0
+        started = time.monotonic()
+        deadline = started + min(self.max_wait, max_wait or self.max_wait)
+        with self._queued() as mark_waiting:
+            while True:
+                wait = self._try_acquire(model, estimated_tokens)
+                if wait <= 0:
+                    return time.monotonic() - started
+                self._check_wait(model, wait, deadline)
+                mark_waiting()
+                time.sleep(wait + random.uniform(0, 0.05))
+
+    async def acquire_async(self, model, estimated_tokens, max_wait=None):
+        """Async variant of acquire() for the background AI job workers"""
+        if not self.enabled:
+            return 0.0
+        started = time.monotonic()
+        deadline = started + min(self.max_wait, max_wait or self.max_wait)
+        with self._queued() as mark_waiting:
+            while True:
+                wait = await asyncio.to_thread(self._try_acquire, model, estimated_tokens)
+                if wait <= 0:
+                    return time.monotonic() - started
+                self._check_wait(model, wait, deadline)
+                mark_waiting()
+                await asyncio.sleep(wait + random.uniform(0, 0.05))
+
+    def record_usage(self, model, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real usage of a call is known"""
+        if not self.enabled or not self.limits['tpm'] or actual_tokens is None:
+            return
+        table = RateLimitBucket.__table__
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    update(table)
+                    .where(table.c.name == self._bucket_name(model, 'tpm'))
+                    .values(tokens=table.c.tokens + (estimated_tokens - actual_tokens))
+                )
+        except Exception as e:
+            logger.warning(f"Failed to record OpenAI token usage: {str(e)}")
+
+    def drain(self, model, retry_after=None):
+        """Empty the buckets after a 429 so all workers wait before calling again"""
+        if not self.enabled:
+            return
+        retry_after = retry_after if retry_after is not None else 1.0
+        table = RateLimitBucket.__table__
+        now = time.time()
+        try:
+            with db.engine.begin() as conn:
+                for kind in self._active_kinds():
+                    conn.execute(
+                        update(table)
+                        .where(table.c.name == self._bucket_name(model, kind))
+                        .values(tokens=-table.c.refill_per_second * retry_after, updated_at=now)
+                    )
+            logger.warning(f"OpenAI rate limit hit for {model}; all workers paused for {retry_after:.1f}s")
+        except Exception as e:
+            logger.warning(f"Failed to drain OpenAI rate limit buckets: {str(e)}")
+
+    def status(self):
+        """
+        Current bucket levels, for monitoring. The buckets are shared by all
+        workers; the queue depth is only that of the process answering.
+        """
+        table = RateLimitBucket.__table__
+        now = time.time()
+        with db.engine.connect() as conn:
+            rows = conn.execute(select(table).order_by(table.c.name)).all()
+        return {
+            'enabled': any(self.limits.values()),
+            'limits': self.limits,
+            'process': {'pid': os.getpid(), 'queue_depth': self.queue_depth},
+            'buckets': [
+                {
+                    'name': row.name,
+                    'available': round(min(row.capacity, row.tokens + (now - row.updated_at) * row.refill_per_second), 1),
+                    'capacity': row.capacity
+                }
+                for row in rows
+            ]
+        }
+
+    def _try_acquire(self, model, estimated_tokens):
+        """
+        Take one request and the estimated tokens if both buckets have them
+
+        Returns:
+            float: 0 if acquired, otherwise seconds until there should be enough capacity
+        """
+        needs = {'rpm': 1, 'tpm': estimated_tokens}
+        kinds = self._active_kinds()
+        names = {kind: self._bucket_name(model, kind) for kind in kinds}
+        table = RateLimitBucket.__table__
+        now = time.time()
+        try:
+            self._ensure_buckets(model, now)
+            with db.engine.begin() as conn:
+                # Touch the rows first: this takes the row locks on PostgreSQL (and the
+                # write lock on SQLite) so concurrent workers serialize on the buckets
+                conn.execute(
+                    update(table)
+                    .where(table.c.name.in_(list(names.values())))
+                    .values(updated_at=table.c.updated_at)
+                )
+                rows = {row.name: row for row in conn.execute(
+                    select(table).where(table.c.name.in_(list(names.values())))
+                )}
+
+                levels = {}
+                wait = 0.0
+                for kind, name in names.items():
+                    row = rows[name]
+                    level = min(row.capacity, row.tokens + (now - row.updated_at) * row.refill_per_second)
+                    # A call larger than the whole bucket waits for a full bucket rather than forever
+                    need = min(needs[kind], row.capacity)
+                    if level < need:
+                        wait = max(wait, (need - level) / row.refill_per_second)
+                    levels[name] = (level, need)
+
+                for name, (level, need) in levels.items():
+                    conn.execute(
+                        update(table)
+                        .where(table.c.name == name)
+                        .values(tokens=level - need if wait == 0 else level, updated_at=now)
+                    )
+                return wait
+        except Exception as e:
+            logger.warning(f"OpenAI rate limiter unavailable, continuing without it: {str(e)}")
+            return 0.0
+
+    def _ensure_buckets(self, model, now):
+        for kind in self._active_kinds():
+            name = self._bucket_name(model, kind)
+            if name in self._ensured:
+                continue
+            limit = self.limits[kind]
+            table = RateLimitBucket.__table__
+            try:
+                with db.engine.begin() as conn:
+                    exists = conn.execute(
+                        update(table)
+                        .where(table.c.name == name)
+                        .values(capacity=float(limit), refill_per_second=limit / 60.0)
+                    ).rowcount
+                    if not exists:
+                        conn.execute(table.insert().values(
+                            name=name, tokens=float(limit), capacity=float(limit),
+                            refill_per_second=limit / 60.0, updated_at=now
+                        ))
+            except IntegrityError:
+                pass  # Created concurrently by another worker
+            self._ensured.add(name)
+
+    def _check_wait(self, model, wait, deadline):
+        if time.monotonic() + wait > deadline:
+            raise RateLimitQueueTimeout(
+                f"OpenAI rate limit budget for {model} is exhausted; capacity frees up in {wait:.0f}s"
+            )
+
+    def _active_kinds(self):
+        return [kind for kind, limit in self.limits.items() if limit]
+
+    @staticmethod
+    def _bucket_name(model, kind):
+        return f"openai:{model}:{kind}"
+
+    @contextmanager
+    def _queued(self):
+        waiting = []
+
+        def mark_waiting():
+            if not waiting:
+                waiting.append(True)
+                with self._lock:
+                    self._waiting += 1
+                logger.info(f"OpenAI call queued for rate limit capacity (queue depth {self._waiting})")
+
+        try:
+            yield mark_waiting
+        finally:
+            if waiting:
+                with self._lock:
+                    self._waiting -= 1
+
+
+# Shared limiter instance for this process
+rate_limiter = RateLimiter()
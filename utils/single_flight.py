@@ -0,0 +1,257 @@
+"""
+Single-flight request coalescing.
+
+When many requests need the same expensive result at once (e.g. a shared
+question link opened by a whole class), only the first one - the leader -
+does the work; the others wait for its result.
+
+Coalescing happens at two levels:
+- threads in one process join the leader's in-flight call directly,
+- gunicorn workers serialize on a cross-process lock (a PostgreSQL advisory
+  lock, or a lock file when running on another database). A leader that gets
+  the lock after another worker first calls check(), so the result that worker
+  already stored is reused instead of generated again.
+"""
+import os
+import time
+import fcntl
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for another request's result before giving up on coalescing
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 120))
+SINGLE_FLIGHT_POLL_INTERVAL = 0.1
+SINGLE_FLIGHT_LOCK_DIR = os.environ.get(
+    'SINGLE_FLIGHT_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'a-level-ai-locks')
+)
+
+
+class LeaderAbortedError(Exception):
+    """The leader stopped without producing a result (e.g. its client disconnected)"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key"""
+
+    def __init__(self, namespace, timeout=SINGLE_FLIGHT_TIMEOUT):
+        self.namespace = namespace
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, check=None):
+        """
+        Run fn() once for all concurrent callers with the same key
+
+        Args:
+            key: Identifies identical work
+            fn: Produces the result (and should store it where check() can find it)
+            check: Optional function returning a result stored by another worker, or None
+
+        Returns:
+            The leader's result
+        """
+        while True:
+            call, is_leader = self._join(key)
+            if not is_leader:
+                try:
+                    return self._wait(call)
+                except LeaderAbortedError:
+                    continue
+
+            try:
+                with self.worker_lock(key):
+                    result = check() if check else None
+                    if result is None:
+                        result = fn()
+                    else:
+                        logger.info(f"Single-flight {self.namespace}: reused result from another worker")
+                call.result = result
+                return result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                self._finish(key, call)
+
+    async def do_async(self, key, coro_fn, check=None):
+        """
+        Async variant of do() for the background AI job workers
+
+        Args:
+            coro_fn: Returns an awaitable producing the result
+            check: Optional synchronous function, run in a thread
+        """
+        while True:
+            call, is_leader = self._join(key)
+            if not is_leader:
+                try:
+                    return await asyncio.to_thread(self._wait, call)
+                except LeaderAbortedError:
+                    continue
+
+            lock = self.worker_lock(key)
+            try:
+                await asyncio.to_thread(lock.__enter__)
+                try:
+                    result = await asyncio.to_thread(check) if check else None
+                    if result is None:
+                        result = await coro_fn()
+                finally:
+                    await asyncio.to_thread(lock.__exit__, None, None, None)
+                call.result = result
+                return result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                self._finish(key, call)
+
+    def stream(self, key, stream_fn, check=None, store=None):
+        """
+        Generator variant of do() for streamed results
+
+        The leader yields text deltas from stream_fn() as they arrive and calls
+        store(full_text) before releasing the lock. Followers yield the finished
+        text in one piece.
+
+        Yields:
+            str: Text deltas
+        """
+        while True:
+            call, is_leader = self._join(key)
+            if not is_leader:
+                try:
+                    result = self._wait(call)
+                except LeaderAbortedError:
+                    continue
+                yield result
+                return
+
+            try:
+                with self.worker_lock(key):
+                    result = check() if check else None
+                    if result is not None:
+                        logger.info(f"Single-flight {self.namespace}: reused result from another worker")
+                        yield result
+                    else:
+                        parts = []
+                        for delta in stream_fn():
+                            parts.append(delta)
+                            yield delta
+                        result = ''.join(parts)
+                        if store:
+                            store(result)
+                call.result = result
+                return
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                self._finish(key, call)
+
+    def _join(self, key):
+        """Return (call, True) if the caller is the leader, else (in-flight call, False)"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = _Call()
+            self._calls[key] = call
+            return call, True
+
+    def _finish(self, key, call):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.done.set()
+
+    def _wait(self, call):
+        logger.info(f"Single-flight {self.namespace}: waiting for in-flight request")
+        if not call.done.wait(self.timeout):
+            raise TimeoutError("Timed out waiting for an identical request to finish (timeout)")
+        if call.error is not None:
+            if not isinstance(call.error, Exception):
+                # GeneratorExit / KeyboardInterrupt in the leader - let a follower take over
+                raise LeaderAbortedError()
+            raise call.error
+        return call.result
+
+    @contextmanager
+    def worker_lock(self, key):
+        """
+        Hold a lock on the key across gunicorn workers
+
+        Falls back to running unlocked if the lock cannot be acquired within the
+        timeout, so a stuck worker never blocks everyone else indefinitely.
+        """
+        digest = hashlib.sha256(f"{self.namespace}:{key}".encode('utf-8')).digest()
+        if db.engine.dialect.name == 'postgresql':
+            lock = _advisory_lock(int.from_bytes(digest[:8], 'big', signed=True), self.timeout)
+        else:
+            lock = _file_lock(os.path.join(SINGLE_FLIGHT_LOCK_DIR, f"{digest.hex()[:32]}.lock"), self.timeout)
+        with lock:
+            yield
+
+
+@contextmanager
+def _advisory_lock(lock_id, timeout):
+    conn = db.engine.connect()
+    acquired = False
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            acquired = conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {'id': lock_id}).scalar()
+            conn.commit()
+            if acquired or time.monotonic() >= deadline:
+                break
+            time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        if not acquired:
+            logger.warning(f"Could not acquire advisory lock {lock_id} within {timeout}s, continuing unlocked")
+        yield
+    finally:
+        if acquired:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {'id': lock_id})
+            conn.commit()
+        conn.close()
+
+
+@contextmanager
+def _file_lock(path, timeout):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock_file:
+        acquired = False
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        if not acquired:
+            logger.warning(f"Could not acquire lock file {path} within {timeout}s, continuing unlocked")
+        try:
+            yield
+        finally:
+            if acquired:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,73 @@
+"""
+Helpers for streaming AI responses to the browser as server-sent events.
+
+Tokens are forwarded as they arrive ('token' events). Because the math/markdown
+formatting in process_math_notation only works on whole constructs, the text
+is also cut into completed blocks - paragraphs that do not end inside a $$...$$
+display equation or a ``` code fence - which are formatted and sent as 'block'
+events. A final 'done' (or 'error') event carries the same body the
+non-streaming endpoint returns.
+"""
+import json
+
+
+def sse_event(event, data):
+    """
+    Format one server-sent event
+
+    Args:
+        event: Event name (e.g. 'token', 'block', 'done', 'error')
+        data: JSON-serializable payload
+
+    Returns:
+        str: The encoded event
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class BlockBuffer:
+    """Accumulates streamed text and releases it in completed markdown blocks"""
+
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, text):
+        """
+        Add streamed text
+
+        Returns:
+            list: Blocks completed by this text (possibly empty)
+        """
+        self._buffer += text
+        blocks = []
+        search_from = 0
+        while True:
+            boundary = self._buffer.find('\n\n', search_from)
+            if boundary == -1:
+                break
+            candidate = self._buffer[:boundary]
+            if _is_balanced(candidate):
+                if candidate.strip():
+                    blocks.append(candidate)
+                self._buffer = self._buffer[boundary + 2:].lstrip('\n')
+                search_from = 0
+            else:
+                # The blank line is inside an equation or code block - keep reading
+                search_from = boundary + 2
+        return blocks
+
+    def flush(self):
+        """Return whatever is left once the stream has finished"""
+        remaining, self._buffer = self._buffer, ''
+        return [remaining] if remaining.strip() else []
+
+
+def _is_balanced(text):
+    return text.count('$$') % 2 == 0 and text.count('```') % 2 == 0
+
+
+STREAM_HEADERS = {
+    'Cache-Control': 'no-cache',
+    # Stop nginx-style proxies from buffering the event stream
+    'X-Accel-Buffering': 'no'
+}
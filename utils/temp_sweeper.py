@@ -0,0 +1,153 @@
+"""
+Background sweeper that keeps temp_uploads/ bounded.
+
+Snap uploads are no longer written there, but test uploads, older code paths
+and interrupted requests can still leave files behind, and nothing removed
+them. Each process runs one daemon thread that, every
+TEMP_SWEEP_INTERVAL_SECONDS, deletes files older than
+TEMP_UPLOAD_MAX_AGE_SECONDS and then the oldest remaining files until the
+folder is under TEMP_UPLOAD_MAX_BYTES. Several processes sweeping the same
+folder is harmless.
+
+Other periodic cleanup (blob garbage collection, expired upload sessions) is
+registered with add_task and runs on the same thread, in an app context. The
+first run of each such task is delayed by a random part of its interval, so
+workers started together do not all run it at once.
+"""
+import os
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+TEMP_UPLOAD_FOLDER = os.environ.get('TEMP_UPLOAD_FOLDER', os.path.join(os.getcwd(), 'temp_uploads'))
+TEMP_UPLOAD_MAX_AGE_SECONDS = float(os.environ.get('TEMP_UPLOAD_MAX_AGE_SECONDS', 3600))
+TEMP_UPLOAD_MAX_BYTES = int(os.environ.get('TEMP_UPLOAD_MAX_BYTES', 200 * 1024 * 1024))
+# 0 disables the background thread
+TEMP_SWEEP_INTERVAL_SECONDS = float(os.environ.get('TEMP_SWEEP_INTERVAL_SECONDS', 600))
+
+
+def sweep_folder(folder=TEMP_UPLOAD_FOLDER, max_age_seconds=TEMP_UPLOAD_MAX_AGE_SECONDS,
+                 max_bytes=TEMP_UPLOAD_MAX_BYTES):
+    """
+    Delete expired files, then the oldest files while the folder is over max_bytes
+
+    Returns:
+        dict: Counts of 'deleted' files and 'bytes' freed
+    """
+    counts = {'deleted': 0, 'bytes': 0}
+    try:
+        entries = [entry for entry in os.scandir(folder) if entry.is_file(follow_symlinks=False)]
+    except FileNotFoundError:
+        return counts
+
+    files = []
+    for entry in entries:
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+
+    cutoff = time.time() - max_age_seconds
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in files:
+        if mtime >= cutoff and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete temp file {path}: {str(e)}")
+            continue
+        total -= size
+        counts['deleted'] += 1
+        counts['bytes'] += size
+
+    if counts['deleted']:
+        logger.info(f"Swept {counts['deleted']} temp files ({counts['bytes'] / 1e6:.1f} MB) from {folder}")
+    return counts
+
+
+class TempSweeper:
+    """Daemon thread that runs sweep_folder, and any added tasks, periodically"""
+
+    def __init__(self, folder=TEMP_UPLOAD_FOLDER, interval=TEMP_SWEEP_INTERVAL_SECONDS):
+        self.folder = folder
+        self.interval = interval
+        self.app = None
+        # [name, function, interval, next run (monotonic)]
+        self._tasks = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add_task(self, name, function, interval):
+        """
+        Run function() every interval seconds in an app context (0 disables it)
+
+        Args:
+            name: Used in log messages
+            function: Called without arguments; its result is logged
+            interval: Seconds between runs
+        """
+        if interval <= 0:
+            return
+        with self._lock:
+            self._tasks.append([name, function, interval, time.monotonic() + random.uniform(0, interval)])
+
+    def start(self, app=None):
+        """Start the thread if anything is enabled and it is not already running"""
+        self.app = app or self.app
+        if self.interval <= 0 and not self._tasks:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='temp-sweeper', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        next_sweep = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if self.interval > 0 and now >= next_sweep:
+                try:
+                    sweep_folder(self.folder)
+                except Exception as e:
+                    logger.error(f"Temp sweeper error: {str(e)}")
+                next_sweep = now + self.interval
+
+            with self._lock:
+                due = [task for task in self._tasks if now >= task[3]]
+                for task in due:
+                    task[3] = now + task[2]
+            for name, function, _, _ in due:
+                self._run_task(name, function)
+
+            with self._lock:
+                next_runs = [task[3] for task in self._tasks]
+            if self.interval > 0:
+                next_runs.append(next_sweep)
+            time.sleep(max(1.0, min(next_runs) - time.monotonic()))
+
+    def _run_task(self, name, function):
+        if self.app is None:
+            logger.error(f"Cannot run {name}: the sweeper was started without an app")
+            return
+        from app import db
+        with self.app.app_context():
+            try:
+                result = function()
+                logger.info(f"Ran {name}: {result}")
+            except Exception as e:
+                logger.error(f"Error running {name}: {str(e)}")
+            finally:
+                db.session.remove()
+
+
+# Shared sweeper for this process
+temp_sweeper = TempSweeper()
@@ -0,0 +1,125 @@
+"""
+Binary (multipart/form-data) image uploads for the analysis endpoints.
+
+The analysis endpoints used to receive photos only as base64 data URIs inside
+JSON: a third larger on the wire, parsed as one multi-MB JSON document, and
+held as the data URI, the bare base64 string and the decoded bytes at once.
+They now also accept the image as a file part of a multipart form. Werkzeug
+spools large parts to a temporary file, and store_uploaded_image copies that
+into the blob store in chunks, so the upload is never decoded or held as a
+whole string. Clients on unreliable connections can instead upload the image
+in resumable chunks beforehand and send its upload id (uploaded_image). JSON
+requests keep working for older clients.
+
+Request bodies above MAX_CONTENT_LENGTH (MAX_UPLOAD_BYTES, see app.py) are
+rejected with 413 before they are read. A single photo is further limited to
+MAX_IMAGE_UPLOAD_BYTES: the capture page compresses photos to the size the
+vision model uses (a few hundred KB), so anything near the limit is an
+uncompressed camera frame that would only be shrunk again on the server.
+"""
+import os
+import mimetypes
+
+from flask import request
+from flask_login import current_user
+
+from utils.blob_store import store_stream
+from utils.chunked_uploads import completed_upload_image
+
+MAX_IMAGE_UPLOAD_BYTES = int(os.environ.get('MAX_IMAGE_UPLOAD_BYTES', 10 * 1024 * 1024))
+
+
+def is_multipart_upload():
+    """True if the current request is a multipart form (binary upload) rather than JSON"""
+    return request.mimetype == 'multipart/form-data'
+
+
+def request_fields():
+    """
+    The non-file fields of the current request, from the form or the JSON body
+
+    Returns:
+        dict-like: Field values (empty if there are none)
+    """
+    if is_multipart_upload() or request.mimetype == 'application/x-www-form-urlencoded':
+        return request.form
+    return request.get_json(silent=True) or {}
+
+
+def field_flag(fields, name):
+    """A boolean field, which is a string in forms ('true'/'1') and a bool in JSON"""
+    value = fields.get(name, False)
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def oversized_image_message(size):
+    """
+    The error to show for an image of the given size, if it is over the limit
+
+    Args:
+        size: Image size in bytes (decoded, for data URIs)
+
+    Returns:
+        str: A message for the user, or None if the image is small enough
+    """
+    if size <= MAX_IMAGE_UPLOAD_BYTES:
+        return None
+    return (
+        f"The photo is too large ({size / (1024 * 1024):.1f} MB; the limit is "
+        f"{MAX_IMAGE_UPLOAD_BYTES / (1024 * 1024):.0f} MB). Please retake it at a lower resolution "
+        f"or reload the page so it can be compressed before uploading."
+    )
+
+
+def store_uploaded_image(field_name):
+    """
+    Stream an uploaded image into the blob store, unreferenced (it is kept for
+    background jobs and garbage collected later)
+
+    Args:
+        field_name: Name of the file part
+
+    Returns:
+        tuple: (blob path, MIME type), or (None, None) if the part is missing
+
+    Raises:
+        ValueError: If the uploaded file is not an image
+    """
+    upload = request.files.get(field_name)
+    if upload is None or (not upload.filename and not upload.mimetype):
+        return None, None
+    path = store_stream(upload.stream, referenced=False)
+    if path.endswith('.bin'):
+        raise ValueError("The uploaded file is not a supported image")
+    return path, mimetypes.guess_type(path)[0] or 'image/jpeg'
+
+
+def uploaded_image(fields, field_name):
+    """
+    An image sent as a file part, or as the id of a finished chunked upload
+    (`<field_name>_upload_id`, see utils/chunked_uploads.py)
+
+    Args:
+        fields: The request fields (see request_fields)
+        field_name: Name of the image field
+
+    Returns:
+        tuple: (blob path, MIME type), or (None, None) if neither was sent
+
+    Raises:
+        ValueError: If the file is not an image or the upload is unknown or unfinished
+    """
+    upload_id = fields.get(f'{field_name}_upload_id')
+    if upload_id:
+        return completed_upload_image(upload_id, current_user.id)
+    if is_multipart_upload():
+        return store_uploaded_image(field_name)
+    return None, None
+
+
+def read_stored_image(path):
+    """The bytes of a stored upload, for the synchronous AI calls"""
+    with open(path, 'rb') as image_file:
+        return image_file.read()
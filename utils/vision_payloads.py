@@ -0,0 +1,173 @@
+"""
+Cache of the model-ready form of stored question images.
+
+Explaining a stored question used to read the PNG, base64-encode it into a
+data URI, decode that again to hash it for the explanation cache, and decode
+it once more to resize and re-encode it for the vision model, all on every
+request. Stored images never change under the same content digest, so the
+prepared `image_url` part (see utils/image_preparation.py) is computed once,
+when the question is added, and kept:
+
+- on disk, as data/vision_payloads/ab/<digest>_<settings>.json, shared by
+  every worker and surviving restarts;
+- in memory, in an LRU bounded by VISION_PAYLOAD_MEMORY_BYTES.
+
+Entries are keyed by the image's content digest and by a signature of the
+preparation settings, so a replaced image or a change of VISION_IMAGE_* settings
+simply misses. Callers pass a StoredVisionImage wherever the AI helpers accept
+a data URI; it carries its digest, so the explanation cache never hashes the
+image either.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from utils.image_preparation import (
+    prepare_vision_image, VISION_IMAGE_FORMAT, VISION_IMAGE_QUALITY, VISION_IMAGE_DETAIL,
+    VISION_TILE_SNAP, MAX_LONG_SIDE, MAX_SHORT_SIDE
+)
+from utils.question_images import question_images
+
+logger = logging.getLogger(__name__)
+
+VISION_PAYLOAD_FOLDER = os.environ.get(
+    'VISION_PAYLOAD_FOLDER', os.path.join(os.getcwd(), 'data', 'vision_payloads')
+)
+VISION_PAYLOAD_MEMORY_BYTES = int(os.environ.get('VISION_PAYLOAD_MEMORY_BYTES', 64 * 1024 * 1024))
+
+# Changes whenever a setting that affects the prepared image does
+PAYLOAD_SIGNATURE = hashlib.sha256(repr((
+    VISION_IMAGE_FORMAT, VISION_IMAGE_QUALITY, VISION_IMAGE_DETAIL, VISION_TILE_SNAP, MAX_LONG_SIDE, MAX_SHORT_SIDE
+)).encode('utf-8')).hexdigest()[:8]
+
+
+def payload_path(digest):
+    return os.path.join(VISION_PAYLOAD_FOLDER, digest[:2], f"{digest}_{PAYLOAD_SIGNATURE}.json")
+
+
+class VisionPayloadCache:
+    """Prepared vision payloads by image digest: memory LRU over files on disk"""
+
+    def __init__(self, max_bytes=VISION_PAYLOAD_MEMORY_BYTES):
+        self.max_bytes = max_bytes
+        self._lru = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path, digest):
+        """
+        The prepared `image_url` part for an image file
+
+        Args:
+            path: The image file (only read on a miss)
+            digest: SHA-256 of the file
+
+        Returns:
+            dict: {'url': data URI, 'detail': level}
+        """
+        with self._lock:
+            payload = self._lru.get(digest)
+            if payload is not None:
+                self._lru.move_to_end(digest)
+                return payload
+
+        payload = self._read(digest)
+        if payload is None:
+            payload = self.prepare(path, digest)
+        self._remember(digest, payload)
+        return payload
+
+    def prepare(self, path, digest):
+        """Prepare an image and write its payload to disk (called at ingest; no-op if already there)"""
+        payload = self._read(digest)
+        if payload is not None:
+            return payload
+        with open(path, 'rb') as image_file:
+            payload = prepare_vision_image(image_file.read())
+        target = payload_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as payload_file:
+            json.dump(payload, payload_file)
+        os.replace(temp_path, target)
+        return payload
+
+    def prepare_safely(self, path, digest):
+        """Prepare at ingest time; a failure only means the payload is built on first use"""
+        try:
+            self.prepare(path, digest)
+        except Exception as e:
+            logger.warning(f"Could not prepare vision payload for {path}: {str(e)}")
+
+    def forget(self, digest):
+        """Drop the payload of an image that was replaced or deleted"""
+        with self._lock:
+            payload = self._lru.pop(digest, None)
+            if payload is not None:
+                self._bytes -= len(payload['url'])
+        try:
+            os.remove(payload_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _read(self, digest):
+        try:
+            with open(payload_path(digest)) as payload_file:
+                return json.load(payload_file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning(f"Discarding unreadable vision payload for {digest[:12]}")
+            return None
+
+    def _remember(self, digest, payload):
+        size = len(payload['url'])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if digest not in self._lru:
+                self._lru[digest] = payload
+                self._bytes += size
+            self._lru.move_to_end(digest)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._lru.popitem(last=False)
+                self._bytes -= len(evicted['url'])
+
+
+# Shared cache for this process
+vision_payloads = VisionPayloadCache()
+
+
+class StoredVisionImage:
+    """A stored image, accepted by the AI helpers in place of a data URI"""
+
+    __slots__ = ('path', 'sha256', '_payload')
+
+    def __init__(self, path, sha256):
+        self.path = path
+        self.sha256 = sha256
+        self._payload = None
+
+    def vision_payload(self):
+        if self._payload is None:
+            self._payload = vision_payloads.get(self.path, self.sha256)
+        return self._payload
+
+    def __repr__(self):
+        return f'<StoredVisionImage {self.sha256[:12]} {self.path}>'
+
+
+def load_vision_image(image_path):
+    """
+    A stored image with its prepared payload loaded (reads or builds it, so call
+    it off the event loop in async code)
+
+    Returns:
+        StoredVisionImage: The image
+    """
+    image = StoredVisionImage(image_path, question_images.digest(image_path))
+    image.vision_payload()
+    return image